@@ -0,0 +1,278 @@
+"""
+Common subexpression elimination.
+
+After inlining, the same transcendental function calls often appear several
+times in a single block of code, for example "exp((v+40)/-10)". This module
+finds identical calls within a block, computes each one once into a new local
+variable, and replaces all of the calls with that variable.
+"""
+import nmodl
+import nmodl.ast
+import nmodl.dsl
+
+from nmodl_preprocessor.utils import *
+from nmodl_preprocessor.nmodl_to_python import nmodl_builtins
+
+# The functions which are expensive enough to be worth eliminating.
+expensive_functions = {
+    'exp', 'log', 'log10', 'pow', 'sqrt',
+    'sin', 'cos', 'tan', 'asin', 'acos', 'atan', 'atan2',
+    'sinh', 'cosh', 'tanh',
+}
+
+def eliminate_common_subexpressions(statement_block, reserved_names, exclude_vars=()) -> dict:
+    """
+    Find and eliminate the repeated expensive subexpressions in a block of code.
+    The AST is modified in place.
+
+    Argument reserved_names is the set of all names which are already in use.
+             New names are added to it.
+    Argument exclude_vars is a set of variables which must not be read by any
+             eliminated expression, such as the STATE variables in a DERIVATIVE block.
+
+    Returns a dict of the new local variables, mapping from name to the text
+    of the expression which it holds. The caller is responsible for declaring
+    them as local variables.
+    """
+    new_locals = {}
+    _eliminate(statement_block, reserved_names, set(exclude_vars), new_locals)
+    return new_locals
+
+def _eliminate(statement_block, reserved_names, exclude_vars, new_locals):
+    while True:
+        statements = list(statement_block.statements)
+        # Find all of the candidate expressions in each statement.
+        occurrences = {} # Maps from expression text to list of statement indices.
+        variables = {} # Maps from expression text to the set of variables it reads.
+        for idx, stmt in enumerate(statements):
+            for expr in find_candidates(stmt):
+                text = STR(nmodl.to_nmodl(expr))
+                occurrences.setdefault(text, []).append(idx)
+                if text not in variables:
+                    variables[text] = read_variables(expr)
+        writes = [written_variables(stmt) for stmt in statements]
+        unconditional = [unconditional_candidates(stmt) for stmt in statements]
+        # Eliminate the largest expressions first, because they might contain
+        # other candidates.
+        for text in sorted(occurrences, key=lambda text: (-len(text), text)):
+            indices = occurrences[text]
+            if len(indices) < 2:
+                continue
+            if variables[text] & exclude_vars:
+                continue
+            # The new variable is computed before the first use, so the first use
+            # must run whenever that statement runs. Otherwise it would add the
+            # expression to the paths which did not compute it before, for
+            # example when it's only used inside of IF statements.
+            first, last = min(indices), max(indices)
+            if text not in unconditional[first]:
+                continue
+            # The variables must not change in between the first and last uses.
+            if any(w is None or (w & variables[text]) for w in writes[first:last+1]):
+                continue
+            name = make_name(reserved_names)
+            new_locals[name] = text
+            replacement = parse_expression(name)
+            for stmt in statements[first:last+1]:
+                replace_expressions(stmt, lambda expr: (
+                        replacement.clone() if is_candidate(expr) and STR(nmodl.to_nmodl(expr)) == text else None))
+            statement_block.statements = (
+                    statements[:first] + [parse_statement(f'{name} = {text}')] + statements[first:])
+            break # Rescan the block.
+        else:
+            break
+    # Recursively search any nested blocks of code.
+    for stmt in statement_block.statements:
+        for nested_block in nested_statement_blocks(stmt):
+            _eliminate(nested_block, reserved_names, exclude_vars, new_locals)
+
+def make_name(reserved_names, prefix='cse_'):
+    idx = 0
+    while (name := f'{prefix}{idx}') in reserved_names:
+        idx += 1
+    reserved_names.add(name)
+    return name
+
+def parse_statement(text):
+    program = nmodl.NmodlDriver().parse_string('PROCEDURE cse() {\n' + text + '\n}')
+    return program.blocks[0].statement_block.statements[0].clone()
+
+def parse_expression(text):
+    return parse_statement('cse = ' + text).expression.rhs.clone()
+
+def is_pure(node):
+    """ Is this expression free of side effects and user defined function calls? """
+    if node.is_double() or node.is_integer() or node.is_double_unit():
+        return True
+    elif node.is_var_name():
+        return not node.name.is_indexed_name()
+    elif node.is_wrapped_expression() or node.is_paren_expression() or node.is_unary_expression():
+        return is_pure(node.expression)
+    elif node.is_binary_expression():
+        return node.op.eval() != '=' and is_pure(node.lhs) and is_pure(node.rhs)
+    elif node.is_function_call():
+        name = STR(node.name.get_node_name())
+        return (name in nmodl_builtins) and all(is_pure(arg) for arg in node.arguments)
+    else:
+        return False
+
+def is_candidate(node):
+    if node.is_function_call():
+        if STR(node.name.get_node_name()) not in expensive_functions:
+            return False
+    elif node.is_binary_expression():
+        if node.op.eval() != '^':
+            return False
+    else:
+        return False
+    return is_pure(node)
+
+def find_candidates(stmt):
+    candidates = []
+    def visit(expr):
+        if is_candidate(expr):
+            candidates.append(expr)
+        return None
+    if stmt.is_expression() and not stmt.is_statement_block():
+        _replace(stmt, visit)
+    else:
+        replace_expressions(stmt, visit)
+    return candidates
+
+def unconditional_candidates(stmt) -> set:
+    """ Returns the text of the candidate expressions which are computed whenever the statement runs. """
+    if stmt.is_statement_block():
+        return set().union(*(unconditional_candidates(x) for x in stmt.statements))
+    elif stmt.is_expression_statement() and stmt.expression.is_statement_block():
+        return unconditional_candidates(stmt.expression)
+    elif stmt.is_if_statement():
+        # Each condition is computed only if the previous conditions are false.
+        # An expression in every branch, including the ELSE, is always computed.
+        branches = [(stmt.condition, stmt.statement_block)]
+        branches.extend((x.condition, x.statement_block) for x in stmt.elseifs)
+        texts = unconditional_candidates(stmt.elses.statement_block) if stmt.elses else set()
+        for condition, block in reversed(branches):
+            texts = candidate_texts(condition) | (texts & unconditional_candidates(block))
+        return texts
+    elif stmt.is_while_statement():
+        return candidate_texts(stmt.condition) # The loop body may never run.
+    elif stmt.is_from_statement():
+        return set()
+    else:
+        return candidate_texts(stmt)
+
+def candidate_texts(node) -> set:
+    """ Returns the text of every candidate expression in the statement or expression. """
+    return {STR(nmodl.to_nmodl(x)) for x in find_candidates(node)}
+
+def read_variables(expr):
+    return set(STR(x.get_node_name()) for x in
+            nmodl.dsl.visitor.AstLookupVisitor().lookup(expr, nmodl.ast.AstNodeType.VAR_NAME))
+
+class WriteVisitor(nmodl.dsl.visitor.AstVisitor):
+    """ Determines which variables a statement might write to. """
+    def __init__(self):
+        super().__init__()
+        self.writes = set()
+        self.unknown = False # Does the statement have unknown side effects?
+
+    def visit_binary_expression(self, node):
+        if node.op.eval() == '=':
+            if node.lhs.is_var_name():
+                self.writes.add(STR(node.lhs.name.get_node_name()))
+            elif not node.lhs.is_prime_name(): # Derivatives are never read from.
+                self.unknown = True
+        node.visit_children(self)
+
+    def visit_from_statement(self, node):
+        self.writes.add(STR(node.name.get_node_name()))
+        node.visit_children(self)
+
+    def visit_local_var(self, node):
+        self.writes.add(STR(node.name.get_node_name()))
+
+    def visit_function_call(self, node):
+        if STR(node.name.get_node_name()) not in nmodl_builtins:
+            self.unknown = True
+        node.visit_children(self)
+
+    def visit_solve_block(self, node):
+        self.unknown = True
+
+    def visit_verbatim(self, node):
+        self.unknown = True
+
+    def visit_reaction_statement(self, node):
+        self.unknown = True
+
+    def visit_lin_equation(self, node):
+        self.unknown = True
+
+    def visit_non_lin_equation(self, node):
+        self.unknown = True
+
+def written_variables(stmt):
+    """ Returns the set of variables that the statement writes to, or None if unknown. """
+    visitor = WriteVisitor()
+    stmt.accept(visitor)
+    if visitor.unknown:
+        return None
+    return visitor.writes
+
+def nested_statement_blocks(stmt):
+    if stmt.is_statement_block():
+        yield stmt
+    elif stmt.is_expression_statement() and stmt.expression.is_statement_block():
+        yield stmt.expression
+    elif stmt.is_if_statement():
+        yield stmt.statement_block
+        for elif_node in stmt.elseifs:
+            yield elif_node.statement_block
+        if else_node := stmt.elses:
+            yield else_node.statement_block
+    elif stmt.is_while_statement() or stmt.is_from_statement():
+        yield stmt.statement_block
+
+def replace_expressions(node, replace):
+    """
+    Walk the statements and expressions under the given node. Each expression
+    for which replace(expression) returns a new node is replaced by that node.
+    """
+    if node.is_statement_block():
+        for stmt in node.statements:
+            replace_expressions(stmt, replace)
+    elif node.is_expression_statement() or node.is_protect_statement():
+        if node.expression.is_solve_block():
+            return
+        elif node.expression.is_statement_block():
+            replace_expressions(node.expression, replace)
+            return
+        node.expression = _replace(node.expression, replace)
+    elif node.is_if_statement():
+        node.condition = _replace(node.condition, replace)
+        replace_expressions(node.statement_block, replace)
+        for elif_node in node.elseifs:
+            elif_node.condition = _replace(elif_node.condition, replace)
+            replace_expressions(elif_node.statement_block, replace)
+        if else_node := node.elses:
+            replace_expressions(else_node.statement_block, replace)
+    elif node.is_while_statement():
+        node.condition = _replace(node.condition, replace)
+        replace_expressions(node.statement_block, replace)
+    elif node.is_from_statement():
+        replace_expressions(node.statement_block, replace)
+
+def _replace(node, replace):
+    if (new_node := replace(node)) is not None:
+        return new_node
+    if node.is_binary_expression():
+        if node.op.eval() != '=':
+            node.lhs = _replace(node.lhs, replace)
+        node.rhs = _replace(node.rhs, replace)
+    elif node.is_wrapped_expression() or node.is_paren_expression() or node.is_unary_expression():
+        node.expression = _replace(node.expression, replace)
+    elif node.is_diff_eq_expression():
+        node.expression = _replace(node.expression, replace)
+    elif node.is_function_call():
+        node.arguments = [_replace(arg, replace) for arg in node.arguments]
+    return node
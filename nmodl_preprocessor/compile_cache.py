@@ -0,0 +1,120 @@
+"""
+Share the compiled mechanisms between projects.
+
+After optimization, many projects contain identical mechanisms, and each of them
+would otherwise be translated into C++ and compiled separately. The cache stores
+the files which nrnivmodl makes for each mechanism, in a directory named after
+the hash of everything which affects them: the optimized NMODL text, the include
+files, the NEURON version, and the compiler settings.
+
+Before running nrnivmodl, the cached files are copied into the build directory
+with new modification times so that make considers them to be up to date.
+The least recently used entries are deleted when the cache exceeds its size.
+"""
+from pathlib import Path
+import functools
+import os
+import platform
+import shutil
+import subprocess
+import time
+
+from nmodl_preprocessor.manifest import hash_bytes, hash_file, tool_version
+
+# The files which nrnivmodl makes for each mechanism.
+build_suffixes = ('.c', '.cpp', '.o', '.lo')
+
+# The environment variables which affect the compiler.
+compiler_env_vars = ('CC', 'CXX', 'CFLAGS', 'CXXFLAGS', 'CPPFLAGS', 'LDFLAGS', 'NRNIVMODL_FLAGS')
+
+default_cache_dir = Path.home().joinpath('.cache', 'nmodl_preprocessor')
+
+@functools.lru_cache(maxsize=None)
+def neuron_version() -> str:
+    try:
+        result = subprocess.run(['nrniv', '--version'], capture_output=True, text=True, timeout=60)
+        return result.stdout.strip()
+    except (OSError, subprocess.SubprocessError):
+        return ''
+
+class CompileCache:
+    def __init__(self, cache_dir, max_size):
+        self.cache_dir  = Path(cache_dir)
+        self.max_size   = int(max_size) # In bytes.
+        self.num_hits   = 0
+        self.num_misses = 0
+        self.cache_dir.mkdir(parents=True, exist_ok=True)
+
+    def key(self, mod_file, include_files=()) -> str:
+        """ Hash everything which can affect the compiled mechanism. """
+        settings = [
+            Path(mod_file).name,
+            hash_file(mod_file),
+            tool_version(),
+            neuron_version(),
+            platform.machine(),
+            shutil.which('nrnivmodl') or '',
+        ]
+        settings.extend(f'{name}={os.environ.get(name, "")}' for name in compiler_env_vars)
+        settings.extend(f'{Path(x).name}:{hash_file(x)}' for x in sorted(include_files))
+        return hash_bytes('\n'.join(settings).encode())
+
+    def restore(self, mod_file, build_dir, key) -> bool:
+        """ Copy the cached files for the mechanism into the build directory, if they exist. """
+        entry = self.cache_dir.joinpath(key)
+        files = sorted(entry.glob('*')) if entry.is_dir() else []
+        if not files:
+            self.num_misses += 1
+            return False
+        Path(build_dir).mkdir(parents=True, exist_ok=True)
+        now = time.time()
+        for src in files:
+            dst = Path(build_dir).joinpath(src.name)
+            shutil.copyfile(src, dst)
+            # Make the files newer than the mod file, so that make does not rebuild them.
+            os.utime(dst, (now, now))
+        os.utime(entry) # Mark as recently used.
+        self.num_hits += 1
+        return True
+
+    def store(self, mod_file, build_dir, key):
+        """ Save the files which nrnivmodl made for the mechanism. """
+        entry = self.cache_dir.joinpath(key)
+        if entry.is_dir():
+            os.utime(entry)
+            return
+        stem  = Path(mod_file).stem
+        files = [Path(build_dir).joinpath(stem + suffix) for suffix in build_suffixes]
+        files = [x for x in files if x.is_file()]
+        if not files:
+            return
+        # Write into a temporary directory and then move it into place, so
+        # that concurrent runs never see an incomplete entry.
+        tmp_entry = self.cache_dir.joinpath(f'{key}.{os.getpid()}.tmp')
+        tmp_entry.mkdir(exist_ok=True)
+        for src in files:
+            shutil.copyfile(src, tmp_entry.joinpath(src.name))
+        try:
+            os.rename(tmp_entry, entry)
+        except OSError:
+            shutil.rmtree(tmp_entry, ignore_errors=True)
+
+    def evict(self):
+        """ Delete the least recently used entries until the cache fits in its maximum size. """
+        entries = []
+        total_size = 0
+        for entry in self.cache_dir.iterdir():
+            if not entry.is_dir() or entry.name.endswith('.tmp'):
+                continue
+            try:
+                size = sum(x.stat().st_size for x in entry.iterdir())
+                entries.append((entry.stat().st_mtime, size, entry))
+            except OSError:
+                continue
+            total_size += size
+        entries.sort()
+        for _, size, entry in entries:
+            if total_size <= self.max_size:
+                break
+            shutil.rmtree(entry, ignore_errors=True)
+            total_size -= size
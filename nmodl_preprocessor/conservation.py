@@ -0,0 +1,249 @@
+"""
+Eliminate the STATE variables which are determined by a conservation law.
+
+A KINETIC block with a statement like "CONSERVE C1 + C2 + O = 1" has one more
+STATE variable than it needs, because any one of the conserved states can be
+computed from the others, for example "O = 1 - C1 - C2". Each STATE variable
+costs memory for its value and its derivative, and adds an equation to the solver.
+
+The NMODL language does not allow a reaction to refer to a variable which is not
+a STATE, so this module rewrites the kinetic scheme into the equivalent
+differential equations in a DERIVATIVE block, without the eliminated states.
+The DERIVATIVE block is solved with the "derivimplicit" method, which is the
+implicit Euler method like the "sparse" method for KINETIC blocks. The eliminated
+states are replaced by their expressions wherever they're used.
+"""
+from types import SimpleNamespace
+import re
+import textwrap
+import nmodl
+import nmodl.ast
+import nmodl.dsl
+ANT = nmodl.ast.AstNodeType
+
+from nmodl_preprocessor.utils import *
+from nmodl_preprocessor.common_subexpressions import make_name
+from nmodl_preprocessor.dataflow import lookup, used_names
+
+def eliminate_conserved_states(program, external_refs) -> SimpleNamespace:
+    """
+    Eliminate one STATE variable for each CONSERVE statement in the KINETIC
+    blocks. The AST is modified in place, and the caller is responsible for
+    rebuilding the symbol table.
+
+    Argument external_refs is the set of names which are used outside of this
+             file. These STATE variables and their initial values are kept.
+
+    Returns a namespace with the attributes:
+        states      - dict of the eliminated STATE variables, mapping from name
+                      to the text of the expression which replaces it
+        blocks      - list of the names of the KINETIC blocks which were
+                      rewritten into DERIVATIVE blocks, which are solved with
+                      the "derivimplicit" method instead of "sparse"
+        rejected    - dict mapping from the name of each KINETIC block which
+                      could not be rewritten to the reason why
+    """
+    result = SimpleNamespace(states={}, rejected={}, blocks=[])
+    state_block = next((x for x in program.blocks if x.is_state_block()), None)
+    if state_block is None:
+        return result
+    state_vars = {STR(x.name) for x in state_block.definitions}
+    # Find the variables which can not be eliminated because they're written to,
+    # shadowed, or visible to NEURON.
+    written = set()
+    for x in lookup(program, ANT.BINARY_EXPRESSION):
+        if x.op.eval() == '=' and x.lhs.is_var_name():
+            written.add(STR(x.lhs.name.get_node_name()))
+    for x in lookup(program, ANT.FROM_STATEMENT) + lookup(program, ANT.PRIME_NAME):
+        written.add(STR(x.get_node_name()) if x.is_prime_name() else STR(x.name.get_node_name()))
+    for x in lookup(program, ANT.LOCAL_VAR) + lookup(program, ANT.ARGUMENT):
+        written.add(STR(x.name.get_node_name()))
+    for block in program.blocks:
+        if block.is_neuron_block():
+            written |= used_names(block)
+    # Find how each KINETIC block is solved.
+    methods = {}
+    for x in lookup(program, ANT.SOLVE_BLOCK):
+        method = x.method or x.steadystate
+        methods.setdefault(STR(x.block_name.get_node_name()), set()).add(STR(method.get_node_name()) if method else None)
+    kinetic_blocks = [x for x in program.blocks if x.is_kinetic_block()]
+    reaction_vars  = {get_block_name(x): {STR(y.get_node_name()) for y in lookup(x, ANT.REACT_VAR_NAME)}
+                      for x in kinetic_blocks}
+    reserved_names = used_names(program)
+    new_blocks = {}
+    for block in kinetic_blocks:
+        name = get_block_name(block)
+        if not lookup(block, ANT.CONSERVE):
+            continue
+        if methods.get(name) != {'sparse'}:
+            result.rejected[name] = 'not solved with the sparse method'
+            continue
+        # Don't eliminate the states which other blocks use as STATE variables.
+        other_vars = set().union(*(v for k, v in reaction_vars.items() if k != name))
+        exclude_vars = written | other_vars | {x for x in state_vars
+                if x in external_refs or (x + '0') in external_refs or (x + '0') in reserved_names}
+        try:
+            text, states = rewrite_kinetic_block(block, state_vars, exclude_vars, reserved_names)
+        except ValueError as error:
+            result.rejected[name] = str(error)
+            continue
+        if states:
+            new_blocks[name] = text
+            result.states.update(states)
+            result.blocks.append(name)
+    if not result.states:
+        return result
+    # Rewrite the other blocks to use the expressions instead of the eliminated
+    # states, and to solve the new DERIVATIVE blocks.
+    solve_regex = re.compile(r'\bSOLVE\s+(?P<name>\w+)\s+(?P<kind>METHOD|STEADYSTATE)\s+sparse\b')
+    def rewrite_solve(match):
+        if match['name'] not in new_blocks:
+            return match.group()
+        return f'SOLVE {match["name"]} {match["kind"]} derivimplicit'
+    driver = nmodl.NmodlDriver()
+    blocks = []
+    for block in program.blocks:
+        if block.is_state_block():
+            text = 'STATE {\n' + ''.join(f'    {STR(nmodl.to_nmodl(x))}\n' for x in block.definitions
+                                        if STR(x.name) not in result.states) + '}'
+        elif block.is_kinetic_block() and get_block_name(block) in new_blocks:
+            text = new_blocks[get_block_name(block)]
+        elif getattr(getattr(block, 'bablock', block), 'statement_block', None) is not None and not block.is_neuron_block():
+            text = STR(nmodl.to_nmodl(block))
+            declaration, brace, body = text.partition('{')
+            body = re.sub(solve_regex, rewrite_solve, substitute(body, result.states))
+            if declaration + brace + body == text:
+                blocks.append(block)
+                continue
+            text = declaration + brace + body
+        else:
+            blocks.append(block)
+            continue
+        blocks.append(driver.parse_string(text).blocks[0].clone())
+    program.blocks = blocks
+    return result
+
+def substitute(text, substitutions):
+    return re.sub(r'\b\w+\b', lambda m: substitutions.get(m.group(), m.group()), text)
+
+def reaction_terms(node) -> dict:
+    """ Returns a dict mapping from the name of each species in one side of a reaction to its coefficient. """
+    if node.is_binary_expression():
+        terms = reaction_terms(node.lhs)
+        for species, coefficient in reaction_terms(node.rhs).items():
+            terms[species] = terms.get(species, 0) + coefficient
+        return terms
+    if node.name.is_indexed_name() or (node.name.is_var_name() and node.name.name.is_indexed_name()):
+        raise ValueError('reaction with an array variable')
+    coefficient = int(STR(nmodl.to_nmodl(node.value))) if node.value else 1
+    return {STR(node.get_node_name()): coefficient}
+
+def operand(node, substitutions):
+    """ Returns the text of an expression, in parentheses unless it's a single variable or number. """
+    text = substitute(STR(nmodl.to_nmodl(node)), substitutions)
+    if (node.is_var_name() or node.is_integer() or node.is_double()) and text == STR(nmodl.to_nmodl(node)):
+        return text
+    return f'({text})'
+
+def rewrite_kinetic_block(block, state_vars, exclude_vars, reserved_names):
+    """
+    Returns the pair of (text of the new DERIVATIVE block, dict of eliminated states).
+    Raises ValueError if the block can not be rewritten.
+    """
+    statements = list(block.statement_block.statements)
+    if 'f_flux' in used_names(block) or 'b_flux' in used_names(block):
+        raise ValueError('uses f_flux or b_flux')
+    # Sort the statements into reactions, conservation laws, and everything else.
+    reactions = [] # List of (statement, left hand side terms, right hand side terms)
+    conserves = [] # List of (statement, terms)
+    for stmt in statements:
+        if stmt.is_reaction_statement():
+            op = STR(stmt.op.eval())
+            if op == '<->':
+                reactions.append((stmt, reaction_terms(stmt.reaction1), reaction_terms(stmt.reaction2)))
+            elif op == '<<':
+                reactions.append((stmt, {}, reaction_terms(stmt.reaction1)))
+            else:
+                raise ValueError(f'unsupported reaction "{op}"')
+        elif stmt.is_conserve():
+            conserves.append((stmt, reaction_terms(stmt.react)))
+        elif (lookup(stmt, ANT.REACTION_STATEMENT) or lookup(stmt, ANT.CONSERVE) or
+              lookup(stmt, ANT.COMPARTMENT) or lookup(stmt, ANT.LON_DIFUSE) or
+              lookup(stmt, ANT.DIFF_EQ_EXPRESSION)):
+            raise ValueError('unsupported statement ' + STR(nmodl.to_nmodl(stmt)).strip())
+    if not conserves:
+        return None, {}
+    species = {}
+    for stmt, lhs, rhs in reactions:
+        for name in list(lhs) + list(rhs):
+            species.setdefault(name, None)
+    for stmt, terms in conserves:
+        for name in terms:
+            species.setdefault(name, None)
+    if set(species) - state_vars:
+        raise ValueError('reaction with a variable which is not a STATE')
+    # Check that the reactions really do conserve the total, otherwise the
+    # solver's treatment of the CONSERVE statement matters.
+    for stmt, weights in conserves:
+        for reaction, lhs, rhs in reactions:
+            before = sum(coefficient * weights.get(name, 0) for name, coefficient in lhs.items())
+            after  = sum(coefficient * weights.get(name, 0) for name, coefficient in rhs.items())
+            if before != after:
+                raise ValueError('reactions do not conserve ' + STR(nmodl.to_nmodl(stmt.react)))
+    # Choose which state to eliminate for each conservation law. Prefer the
+    # last state, and don't use any state which is in another conservation law.
+    eliminated = {}
+    for idx, (stmt, terms) in enumerate(conserves):
+        others = set().union(*(t for i, (s, t) in enumerate(conserves) if i != idx))
+        if used_names(stmt.expr) & (exclude_vars | set(species)):
+            raise ValueError('total is not constant in ' + STR(nmodl.to_nmodl(stmt)).strip())
+        candidates = [name for name in terms if name not in exclude_vars and name not in others]
+        if not candidates:
+            raise ValueError('no STATE can be eliminated from ' + STR(nmodl.to_nmodl(stmt.react)))
+        name  = candidates[-1]
+        total = operand(stmt.expr, {})
+        rest  = ''.join(('-' if coefficient == 1 else f'-{coefficient}*') + other
+                        for other, coefficient in terms.items() if other != name)
+        text = f'({total}{rest})'
+        if terms[name] != 1:
+            text = f'({text}/{terms[name]})'
+        eliminated[name] = text
+    # Write the new block.
+    fluxes = [] # The name of the local variable for each reaction.
+    body   = []
+    derivatives = {name: '' for name in species if name not in eliminated}
+    for stmt in statements:
+        if stmt.is_conserve():
+            continue
+        elif stmt.is_reaction_statement():
+            flux = make_name(reserved_names, 'flux_')
+            fluxes.append(flux)
+            if STR(stmt.op.eval()) == '<<':
+                lhs, rhs = {}, reaction_terms(stmt.reaction1)
+                body.append(f'{flux} = {operand(stmt.expression1, eliminated)}')
+            else:
+                lhs, rhs = reaction_terms(stmt.reaction1), reaction_terms(stmt.reaction2)
+                forward  = rate(stmt.expression1, lhs, eliminated)
+                backward = rate(stmt.expression2, rhs, eliminated)
+                body.append(f'{flux} = {forward}-{backward}')
+            for terms, sign in ((lhs, '-'), (rhs, '+')):
+                for name, coefficient in terms.items():
+                    if name in derivatives:
+                        coefficient = '' if coefficient == 1 else f'{coefficient}*'
+                        derivatives[name] += f'{sign}{coefficient}{flux}'
+        else:
+            body.append(substitute(STR(nmodl.to_nmodl(stmt)), eliminated))
+    for name, derivative in derivatives.items():
+        body.append(f"{name}' = {derivative.lstrip('+') or 0}")
+    if fluxes:
+        body.insert(0, 'LOCAL ' + ', '.join(fluxes))
+    text = f'DERIVATIVE {get_block_name(block)} {{\n' + textwrap.indent('\n'.join(body), '    ') + '\n}'
+    return text, eliminated
+
+def rate(expression, terms, substitutions):
+    """ Returns the text of the rate constant multiplied by the concentrations of the reactants. """
+    factors = [operand(expression, substitutions)]
+    for name, coefficient in terms.items():
+        name = substitutions.get(name, name)
+        factors.append(name if coefficient == 1 else f'{name}^{coefficient}')
+    return '*'.join(factors)
@@ -0,0 +1,207 @@
+"""
+Evaluate constant subexpressions ahead of time.
+
+After the parameters are hardcoded, the NMODL code is full of expressions which
+only contain numbers, such as "0.5*(1.0/3.0)*exp(2.3*(6.3-22)/10)". This module
+evaluates them using the same IEEE double precision arithmetic as the generated
+C/C++ code, and replaces them with their resulting values.
+
+Integer literals are treated carefully because the generated code might use
+integer arithmetic for them: integer division is never folded and the results
+of integer arithmetic are printed as integers.
+"""
+import math
+import nmodl
+import nmodl.ast
+
+from nmodl_preprocessor.nmodl_to_python import nmodl_builtins
+
+# Don't fold calls to "abs" because the C/C++ function may return an integer.
+foldable_functions = {name: function for name, function in nmodl_builtins.items()
+                      if callable(function) and name != 'abs'}
+
+max_int = 2 ** 31
+
+def fold_constants(program) -> int:
+    """
+    Fold the constant subexpressions in all of the blocks of the given program.
+    The AST is modified in place. VERBATIM statements are never modified.
+
+    Returns the number of expressions which were folded.
+    """
+    folder = ConstantFolder()
+    for block in program.blocks:
+        if statement_block := getattr(block, 'statement_block', None):
+            folder.fold_statement_block(statement_block)
+    return folder.num_folded
+
+def is_literal(node):
+    if node.is_double() or node.is_integer() or node.is_double_unit():
+        return True
+    if node.is_wrapped_expression() or node.is_paren_expression():
+        return is_literal(node.expression)
+    if node.is_unary_expression() and node.op.eval() == '-':
+        return is_literal(node.expression)
+    return False
+
+def make_literal(value, is_int):
+    if is_int:
+        text = str(int(value))
+    else:
+        text = repr(float(value))
+    node = nmodl.ast.Double(text)
+    if value < 0:
+        node = nmodl.ast.ParenExpression(node)
+    return node
+
+class ConstantFolder:
+    def __init__(self):
+        self.num_folded = 0
+
+    def fold_statement_block(self, node):
+        for stmt in node.statements:
+            self.fold_statement(stmt)
+
+    def fold_statement(self, node):
+        if node.is_expression_statement() or node.is_protect_statement():
+            node.expression = self.fold_and_replace(node.expression)
+        elif node.is_if_statement():
+            node.condition = self.fold_and_replace(node.condition)
+            self.fold_statement_block(node.statement_block)
+            for elif_node in node.elseifs:
+                elif_node.condition = self.fold_and_replace(elif_node.condition)
+                self.fold_statement_block(elif_node.statement_block)
+            if else_node := node.elses:
+                self.fold_statement_block(else_node.statement_block)
+        elif node.is_while_statement():
+            node.condition = self.fold_and_replace(node.condition)
+            self.fold_statement_block(node.statement_block)
+        elif node.is_from_statement():
+            self.fold_statement_block(node.statement_block)
+        elif node.is_statement_block():
+            self.fold_statement_block(node)
+
+    def fold_and_replace(self, node):
+        """ Fold an expression and replace it with a literal if it's constant. """
+        node, constant = self.fold(node)
+        return self.replace(node, constant)
+
+    def replace(self, node, constant):
+        if constant is None or is_literal(node):
+            return node
+        self.num_folded += 1
+        return make_literal(*constant)
+
+    def fold(self, node):
+        """
+        Fold the constant subexpressions inside of the given expression.
+
+        Returns the pair (node, constant) where constant is either None or the
+        pair (value, is_int). Constant nodes are not replaced here, instead the
+        caller replaces the largest constant expression which contains them.
+        """
+        if node.is_double():
+            text = nmodl.to_nmodl(node)
+            return node, (float(text), text.isdigit())
+        elif node.is_integer():
+            return node, (float(nmodl.to_nmodl(node)), True)
+        elif node.is_double_unit():
+            return node, self.fold(node.value)[1]
+        elif node.is_initial_block() or node.is_for_netcon():
+            # Special case for blocks of code hiding inside of net receive blocks.
+            self.fold_statement_block(node.statement_block)
+            return node, None
+        elif node.is_statement_block():
+            # Nested blocks of code, for example from inlining.
+            self.fold_statement_block(node)
+            return node, None
+        elif node.is_diff_eq_expression():
+            node.expression = self.fold(node.expression)[0]
+            return node, None
+        elif node.is_wrapped_expression() or node.is_paren_expression():
+            node.expression, constant = self.fold(node.expression)
+            return node, constant
+        elif node.is_unary_expression():
+            expression, constant = self.fold(node.expression)
+            result = None
+            if constant is not None:
+                value, is_int = constant
+                op = node.op.eval()
+                if op == '-':
+                    result = (-value, is_int)
+                elif op == '!':
+                    result = (float(not value), True)
+            if result is None:
+                expression = self.replace(expression, constant)
+            node.expression = expression
+            return node, result
+        elif node.is_binary_expression():
+            op = node.op.eval()
+            if op == '=':
+                node.rhs = self.fold_and_replace(node.rhs)
+                return node, None
+            lhs, lhs_constant = self.fold(node.lhs)
+            rhs, rhs_constant = self.fold(node.rhs)
+            result = None
+            if lhs_constant is not None and rhs_constant is not None:
+                result = evaluate_binary(op, lhs_constant, rhs_constant)
+            if result is None:
+                lhs = self.replace(lhs, lhs_constant)
+                rhs = self.replace(rhs, rhs_constant)
+            node.lhs = lhs
+            node.rhs = rhs
+            return node, result
+        elif node.is_function_call():
+            name = node.name.get_node_name()
+            arguments = [self.fold(arg) for arg in node.arguments]
+            result = None
+            if name in foldable_functions and all(c is not None for _, c in arguments):
+                try:
+                    value = float(foldable_functions[name](*(c[0] for _, c in arguments)))
+                except (ValueError, OverflowError, ZeroDivisionError, TypeError):
+                    value = math.nan
+                if math.isfinite(value):
+                    result = (value, False)
+            if result is None:
+                node.arguments = [self.replace(arg, c) for arg, c in arguments]
+            return node, result
+        else:
+            return node, None
+
+def evaluate_binary(op, lhs, rhs):
+    """ Returns the pair (value, is_int) or None if the result can not be folded. """
+    (a, a_is_int), (b, b_is_int) = lhs, rhs
+    is_int = a_is_int and b_is_int
+    try:
+        if   op == '+': value = a + b
+        elif op == '-': value = a - b
+        elif op == '*': value = a * b
+        elif op == '/':
+            if is_int:
+                return None # Might be integer division.
+            value = a / b
+        elif op == '^':
+            value, is_int = math.pow(a, b), False
+        elif op in ('<', '>', '<=', '>=', '==', '!=', '&&', '||'):
+            if math.isnan(a) or math.isnan(b):
+                return None
+            value = {
+                '<':  lambda: a < b,
+                '>':  lambda: a > b,
+                '<=': lambda: a <= b,
+                '>=': lambda: a >= b,
+                '==': lambda: a == b,
+                '!=': lambda: a != b,
+                '&&': lambda: bool(a) and bool(b),
+                '||': lambda: bool(a) or bool(b),
+            }[op]()
+            value, is_int = float(value), True
+        else:
+            return None
+    except (ValueError, OverflowError, ZeroDivisionError):
+        return None
+    if not math.isfinite(value):
+        return None
+    if is_int and abs(value) >= max_int:
+        return None
+    return (value, is_int)
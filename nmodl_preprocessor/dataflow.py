@@ -0,0 +1,283 @@
+"""
+Dataflow analysis of the ASSIGNED variables.
+
+An ASSIGNED variable can be converted into a LOCAL variable if its value never
+flows from one execution of a block of code to another execution of a block.
+NEURON runs the INITIAL, BREAKPOINT, NET_RECEIVE, BEFORE and AFTER blocks and
+the blocks which they SOLVE many times and in an interleaved order, and each
+block has its own LOCAL variables, so a value can be kept in a LOCAL variable
+only if every block writes it before reading it.
+
+This module computes which variables are live (may be read before they're
+written) at the start of each block, using a backwards liveness analysis of each
+statement. Reads which only ever flow into dead assignments do not count, and
+neither do the blocks which will be removed as unused. A call to a FUNCTION or
+PROCEDURE which was not inlined may write to the variables that the caller
+reads after it, and then those variables must remain ASSIGNED. So must the
+variables which the differential equations and kinetic reactions read, because
+the solver may move the equations into different code blocks.
+
+The analysis does not model the order in which NEURON runs the blocks. Each
+block is analyzed on its own, as if any block could run before it, so a variable
+which is live at the start of any block must remain ASSIGNED.
+"""
+from types import SimpleNamespace
+import nmodl
+import nmodl.ast
+import nmodl.dsl
+ANT = nmodl.ast.AstNodeType
+
+from nmodl_preprocessor.utils import *
+from nmodl_preprocessor.common_subexpressions import is_pure
+
+def lookup(node, ast_node_type):
+    return nmodl.dsl.visitor.AstLookupVisitor().lookup(node, ast_node_type)
+
+def used_names(node) -> set:
+    """ Returns every name which appears in the node, which includes all of the variables it reads. """
+    return {STR(x.get_node_name()) for x in lookup(node, ANT.NAME)}
+
+def scope_names(statement_block) -> set:
+    """ Returns the names of the LOCAL variables which are declared directly in the statement block. """
+    return {STR(x.name.get_node_name()) for stmt in statement_block.statements
+            if stmt.is_local_list_statement() for x in stmt.variables}
+
+def declared_names(block) -> set:
+    """
+    Returns the names of the top-level LOCAL variables and arguments of the
+    block, which shadow the ASSIGNED variables. LOCAL variables in nested
+    statement blocks only shadow them within their own statement block.
+    """
+    names = scope_names(block.statement_block)
+    names.update(STR(x.get_node_name()) for x in getattr(block, 'parameters', []))
+    # The name of a function is also the local variable for its return value.
+    if block.is_function_block():
+        names.add(get_block_name(block))
+    return names
+
+def is_nested_initial(stmt):
+    """ Is this statement the INITIAL block inside of a NET_RECEIVE block? """
+    return stmt.is_expression_statement() and stmt.expression.is_initial_block()
+
+def code_blocks(program):
+    """ Yields the pairs of (block name, block node) for every top-level block of code. """
+    for node in program.blocks:
+        block = getattr(node, 'bablock', node) # BEFORE and AFTER blocks.
+        if node.is_neuron_block() or getattr(block, 'statement_block', None) is None:
+            continue
+        yield get_block_name(node), block
+        if node.is_net_receive_block():
+            for x in lookup(node, ANT.INITIAL_BLOCK):
+                yield 'NET_RECEIVE INITIAL', x
+
+def find_local_variables(program, candidates, exclude_blocks=()):
+    """
+    Find the candidate variables which can be converted into LOCAL variables.
+
+    Argument candidates is a set of the names of ASSIGNED variables.
+    Argument exclude_blocks is a set of the names of blocks which will be
+             removed, so their reads can be ignored.
+
+    Returns a namespace with the attributes:
+        variables   - the set of variables which can be converted into LOCAL variables
+        blocks      - maps from block name to the set of those variables which
+                      the block uses, and which therefore need to be declared
+                      LOCAL in that block
+    """
+    candidates  = set(candidates)
+    blocks      = dict(code_blocks(program))
+    declared    = {name: declared_names(node) for name, node in blocks.items()}
+    functions   = {name: node for name, node in blocks.items()
+                   if node.is_function_block() or node.is_procedure_block()}
+    call_writes = function_writes(functions, declared)
+    # Removing a variable from the candidates can make more reads live, so
+    # repeat until nothing changes.
+    while True:
+        persistent = set()
+        for name, node in blocks.items():
+            if name in exclude_blocks:
+                continue
+            analysis = Liveness(candidates | declared[name], call_writes, nested=(name == 'NET_RECEIVE'))
+            live = analysis.statement_block(node.statement_block, set())
+            persistent |= (live | analysis.persistent) - declared[name]
+        if not (persistent & candidates):
+            break
+        candidates -= persistent
+    uses = {}
+    for name, node in blocks.items():
+        if name == 'NET_RECEIVE':
+            used = set()
+            for stmt in node.statement_block.statements:
+                if not is_nested_initial(stmt):
+                    used |= used_names(stmt)
+        else:
+            used = used_names(node.statement_block)
+        uses[name] = (used - declared[name]) & candidates
+    return SimpleNamespace(variables=candidates, blocks=uses)
+
+def function_writes(functions, declared) -> dict:
+    """ Returns a dict mapping from function name to every variable which calling it may write to. """
+    writes = {}
+    calls  = {}
+    for name, node in functions.items():
+        writes[name] = set()
+        for x in lookup(node, ANT.BINARY_EXPRESSION):
+            if x.op.eval() == '=' and x.lhs.is_var_name():
+                writes[name].add(STR(x.lhs.name.get_node_name()))
+        writes[name].update(STR(x.name.get_node_name()) for x in lookup(node, ANT.FROM_STATEMENT))
+        writes[name] -= declared[name]
+        calls[name] = {STR(x.name.get_node_name()) for x in lookup(node, ANT.FUNCTION_CALL)} & functions.keys()
+    # Include the writes of the functions which each function calls.
+    while True:
+        changed = False
+        for name in functions:
+            for callee in calls[name]:
+                if not writes[callee] <= writes[name]:
+                    writes[name] |= writes[callee]
+                    changed = True
+        if not changed:
+            return writes
+
+def constant_bounds(stmt):
+    """ Returns True if the FROM loop has integer bounds and always runs at least once. """
+    try:
+        start = int(STR(nmodl.to_nmodl(getattr(stmt, 'from'))))
+        stop  = int(STR(nmodl.to_nmodl(stmt.to)))
+        step  = int(STR(nmodl.to_nmodl(stmt.increment))) if stmt.increment else 1
+    except ValueError:
+        return False
+    return step > 0 and start <= stop
+
+class Liveness:
+    """
+    Backwards liveness analysis of one block of code. Each method takes a
+    statement and the set of variables which are live after it, and returns the
+    set of variables which are live before it.
+    """
+    def __init__(self, local_vars, call_writes, nested=False):
+        self.local_vars  = local_vars # Variables whose values are discarded at the end of the block.
+        self.call_writes = call_writes
+        self.nested      = nested # Skip over the INITIAL block inside of a NET_RECEIVE block.
+        # Variables which must persist regardless of where they're written.
+        # This includes the variables which a call may overwrite before they're
+        # read, and the variables which are read by the equations.
+        self.persistent  = set()
+        self.scopes      = [] # Stack of the LOCAL variables of the enclosing statement blocks.
+
+    def shadowed(self) -> set:
+        """ Returns the names which currently refer to LOCAL variables instead of the ASSIGNED variables. """
+        return set().union(*self.scopes)
+
+    def calls(self, node, live_after):
+        """ Check the function calls in the node for writes to variables which are read afterwards. """
+        for x in lookup(node, ANT.FUNCTION_CALL):
+            name = STR(x.name.get_node_name())
+            if name in self.call_writes:
+                self.persistent |= (self.call_writes[name] & (live_after | used_names(node))) - self.shadowed()
+
+    def statement_block(self, node, live):
+        # The LOCAL variables of this statement block are distinct from any
+        # variables with the same names outside of it.
+        scope = scope_names(node)
+        outer = live & scope
+        live  = live - scope
+        self.scopes.append(scope)
+        for stmt in reversed(node.statements):
+            live = self.statement(stmt, live)
+        self.scopes.pop()
+        return (live - scope) | outer
+
+    def statement(self, stmt, live):
+        if stmt.is_expression_statement() and stmt.expression.is_binary_expression():
+            return self.assignment(stmt.expression, live)
+        elif stmt.is_expression_statement() and stmt.expression.is_statement_block():
+            return self.statement_block(stmt.expression, live)
+        elif stmt.is_if_statement():
+            return self.if_statement(stmt, live)
+        elif stmt.is_from_statement():
+            return self.from_statement(stmt, live)
+        elif stmt.is_while_statement():
+            return self.while_statement(stmt, live)
+        elif stmt.is_local_list_statement() or stmt.is_table_statement():
+            return live
+        elif is_nested_initial(stmt) and self.nested:
+            return live # Analyzed separately.
+        elif stmt.is_expression_statement() and stmt.expression.is_for_netcon():
+            return self.for_netcon(stmt.expression, live)
+        else:
+            # Any other kind of statement reads all of its variables and does not
+            # overwrite any of them.
+            self.calls(stmt, live)
+            # The solver may move the equations into different code blocks.
+            for x in lookup(stmt, ANT.DIFF_EQ_EXPRESSION) + lookup(stmt, ANT.REACTION_STATEMENT):
+                self.persistent |= used_names(x) - self.shadowed()
+            return live | used_names(stmt)
+
+    def assignment(self, node, live):
+        if node.op.eval() != '=':
+            self.calls(node, live)
+            return live | used_names(node)
+        name = STR(node.lhs.name.get_node_name())
+        self.calls(node, live)
+        # Assignments to local variables which are never read are dead, unless
+        # they have other side effects.
+        is_local = name in self.local_vars or name in self.shadowed()
+        if is_local and name not in live and is_pure(node.rhs):
+            return live
+        # Writing to one element of an array counts as writing the whole array.
+        live = live - {name}
+        live |= used_names(node.rhs)
+        if node.lhs.name.is_indexed_name():
+            live |= used_names(node.lhs.name.length)
+        return live
+
+    def if_statement(self, node, live):
+        branches = [node.statement_block] + [x.statement_block for x in node.elseifs]
+        if node.elses:
+            branches.append(node.elses.statement_block)
+        live_before = set().union(*(self.statement_block(x, live) for x in branches))
+        if not node.elses:
+            live_before |= live
+        conditions = [node.condition] + [x.condition for x in node.elseifs]
+        for condition in reversed(conditions):
+            self.calls(condition, live_before)
+            live_before |= used_names(condition)
+        return live_before
+
+    def loop(self, body, live, runs_once, loop_var=None):
+        # Each iteration of the loop is followed by either the next iteration
+        # or the rest of the block. Repeat until the set of live variables
+        # at the start of the loop body stops growing.
+        live_body = set()
+        while True:
+            new_live = self.statement_block(body, live | (live_body - {loop_var}))
+            if new_live == live_body:
+                break
+            live_body = new_live
+        # If the loop may never run then its body may not overwrite anything.
+        if not runs_once:
+            live_body |= live
+        return live_body - {loop_var}
+
+    def for_netcon(self, node, live):
+        # The loop runs once for each NetCon, and there may be none. Its
+        # arguments are local to it.
+        scope = {STR(x.get_node_name()) for x in node.parameters}
+        self.scopes.append(scope)
+        live_before = self.loop(node.statement_block, live - scope, False)
+        self.scopes.pop()
+        return (live_before - scope) | (live & scope)
+
+    def from_statement(self, node, live):
+        name = STR(node.name.get_node_name())
+        live_before = self.loop(node.statement_block, live, constant_bounds(node), name)
+        for x in (getattr(node, 'from'), node.to, node.increment):
+            if x is not None:
+                live_before |= used_names(x)
+        return live_before
+
+    def while_statement(self, node, live):
+        condition   = used_names(node.condition)
+        live_before = self.loop(node.statement_block, live | condition, False)
+        self.calls(node.condition, live_before)
+        return live_before | condition
@@ -0,0 +1,220 @@
+"""
+Dead code elimination.
+
+After the parameters are hardcoded and the constant expressions are folded, some
+conditional statements have constant conditions, for example "IF (0 > 1) {...}".
+This module removes the branches which can never execute, the assignments to
+local variables which are never read, and the unused local variables.
+"""
+import nmodl
+import nmodl.ast
+import nmodl.dsl
+ANT = nmodl.ast.AstNodeType
+
+from nmodl_preprocessor.utils import *
+from nmodl_preprocessor.constant_folding import ConstantFolder
+from nmodl_preprocessor.common_subexpressions import is_pure
+
+def eliminate_dead_code(program) -> int:
+    """
+    Remove the dead code from all of the blocks of the given program.
+    The AST is modified in place. Blocks with VERBATIM statements are never modified.
+
+    Returns the number of statements and local variables which were removed.
+    """
+    eliminator = DeadCodeEliminator()
+    for block in program.blocks:
+        if statement_block := getattr(block, 'statement_block', None):
+            eliminator.eliminate(statement_block)
+    return eliminator.num_removed
+
+def evaluate_condition(node):
+    """ Returns True or False if the condition is constant, otherwise None. """
+    constant = ConstantFolder().fold(node.clone())[1]
+    if constant is None:
+        return None
+    return bool(constant[0])
+
+def lookup(node, ast_node_type):
+    return nmodl.dsl.visitor.AstLookupVisitor().lookup(node, ast_node_type)
+
+def scope_names(statement_block) -> set:
+    """ Returns the names of the LOCAL variables which are declared directly in the statement block. """
+    return {STR(x.name.get_node_name()) for stmt in statement_block.statements
+            if stmt.is_local_list_statement() for x in stmt.variables}
+
+def count_variables(statement_block, names, num_uses, num_writes):
+    """
+    Count the reads and writes of the given variables, excluding the nested
+    blocks of code which declare their own local variables with those names.
+    """
+    if not names:
+        return
+    for stmt in statement_block.statements:
+        # Count the statement without its nested blocks, and then count each
+        # nested block without the variables which it redeclares.
+        nested = list(nested_blocks(stmt))
+        count_all_variables(stmt, names, num_uses, num_writes, 1)
+        for nested_block in nested:
+            count_all_variables(nested_block, names, num_uses, num_writes, -1)
+            count_variables(nested_block, names - scope_names(nested_block), num_uses, num_writes)
+
+def count_all_variables(node, names, num_uses, num_writes, sign):
+    for x in lookup(node, ANT.VAR_NAME):
+        name = STR(x.name.get_node_name())
+        if name in names:
+            num_uses[name] = num_uses.get(name, 0) + sign
+    for x in lookup(node, ANT.BINARY_EXPRESSION):
+        if x.op.eval() == '=' and x.lhs.is_var_name():
+            name = STR(x.lhs.name.get_node_name())
+            if name in names:
+                num_writes[name] = num_writes.get(name, 0) + sign
+
+def make_nested_block(statement_block):
+    return nmodl.ast.ExpressionStatement(statement_block.clone())
+
+class DeadCodeEliminator:
+    def __init__(self):
+        self.num_removed = 0
+
+    def eliminate(self, statement_block):
+        if lookup(statement_block, ANT.VERBATIM):
+            return
+        self.remove_branches(statement_block)
+        # Removing an assignment can make other local variables unused, so
+        # repeat until nothing changes.
+        while True:
+            num_removed = self.num_removed
+            self.remove_unused_locals(statement_block)
+            if self.num_removed == num_removed:
+                break
+
+    def remove_unused_locals(self, statement_block):
+        """
+        Remove the local variables which are declared in the given block of code
+        and which are never read, and then search the nested blocks of code.
+        A LOCAL statement in a nested block hides any variables with the same
+        names outside of it, so each name refers to its innermost declaration.
+        """
+        local_vars = scope_names(statement_block)
+        if local_vars:
+            loop_vars  = {STR(x.name.get_node_name()) for x in lookup(statement_block, ANT.FROM_STATEMENT)}
+            num_uses   = {}
+            num_writes = {}
+            count_variables(statement_block, local_vars, num_uses, num_writes)
+            unread_vars = {name for name in local_vars - loop_vars
+                           if num_uses.get(name, 0) == num_writes.get(name, 0)}
+            unused_vars = {name for name in local_vars - loop_vars
+                           if num_uses.get(name, 0) == 0}
+            self.remove_assignments(statement_block, unread_vars)
+            self.remove_locals(statement_block, unused_vars)
+        for stmt in statement_block.statements:
+            for nested_block in nested_blocks(stmt):
+                self.remove_unused_locals(nested_block)
+
+    def remove_branches(self, statement_block):
+        """ Remove the IF and WHILE statements with constant conditions. """
+        statements = []
+        for stmt in statement_block.statements:
+            if stmt.is_if_statement():
+                stmt = self.simplify_if_statement(stmt)
+                if stmt is None:
+                    continue
+            elif stmt.is_while_statement():
+                if evaluate_condition(stmt.condition) is False:
+                    self.num_removed += 1
+                    continue
+            statements.append(stmt)
+        if len(statements) != len(statement_block.statements) or any(
+                a is not b for a, b in zip(statements, statement_block.statements)):
+            statement_block.statements = statements
+        # Recursively search any nested blocks of code.
+        for stmt in statement_block.statements:
+            for nested_block in nested_blocks(stmt):
+                self.remove_branches(nested_block)
+
+    def simplify_if_statement(self, stmt):
+        """
+        Returns the replacement for the given IF statement, which is either the
+        original statement, a new statement, or None to remove it.
+        """
+        branches = [(stmt.condition, stmt.statement_block)]
+        branches.extend((x.condition, x.statement_block) for x in stmt.elseifs)
+        reachable = []
+        else_block = stmt.elses.statement_block if stmt.elses else None
+        for condition, block in branches:
+            value = evaluate_condition(condition)
+            if value is None:
+                reachable.append((condition, block))
+            elif value:
+                # All of the following branches are unreachable.
+                else_block = block
+                break
+        if len(reachable) == len(branches):
+            return stmt
+        self.num_removed += 1
+        if not reachable:
+            if else_block is None:
+                return None
+            return make_nested_block(else_block)
+        (condition, block), *elseifs = reachable
+        return nmodl.ast.IfStatement(
+                condition.clone(),
+                block.clone(),
+                [nmodl.ast.ElseIfStatement(c.clone(), b.clone()) for c, b in elseifs],
+                nmodl.ast.ElseStatement(else_block.clone()) if else_block is not None else None)
+
+    def remove_assignments(self, statement_block, names):
+        """ Remove the assignments to the given variables, if they have no side effects. """
+        if not names:
+            return
+        statements = []
+        for stmt in statement_block.statements:
+            if stmt.is_expression_statement():
+                expr = stmt.expression
+                if (expr.is_binary_expression() and expr.op.eval() == '=' and
+                        expr.lhs.is_var_name() and not expr.lhs.name.is_indexed_name() and
+                        STR(expr.lhs.name.get_node_name()) in names and is_pure(expr.rhs)):
+                    self.num_removed += 1
+                    continue
+            statements.append(stmt)
+        if len(statements) != len(statement_block.statements):
+            statement_block.statements = statements
+        for stmt in statement_block.statements:
+            for nested_block in nested_blocks(stmt):
+                self.remove_assignments(nested_block, names - scope_names(nested_block))
+
+    def remove_locals(self, statement_block, names):
+        """ Remove the given variables from the LOCAL statements of the block, but not from its nested blocks. """
+        if not names:
+            return
+        statements = []
+        for stmt in statement_block.statements:
+            if stmt.is_local_list_statement():
+                variables = [x for x in stmt.variables if STR(x.name.get_node_name()) not in names]
+                if len(variables) != len(stmt.variables):
+                    self.num_removed += len(stmt.variables) - len(variables)
+                    if not variables:
+                        continue
+                    stmt.variables = variables
+            statements.append(stmt)
+        if len(statements) != len(statement_block.statements):
+            statement_block.statements = statements
+
+def nested_blocks(stmt):
+    """ Find the blocks of code directly inside of the given statement. """
+    if stmt.is_expression_statement():
+        expr = stmt.expression
+        if expr.is_statement_block():
+            yield expr
+        elif expr.is_initial_block() or expr.is_for_netcon():
+            # Special case for blocks of code hiding inside of net receive blocks.
+            yield expr.statement_block
+    elif stmt.is_if_statement():
+        yield stmt.statement_block
+        for elif_node in stmt.elseifs:
+            yield elif_node.statement_block
+        if else_node := stmt.elses:
+            yield else_node.statement_block
+    elif stmt.is_while_statement() or stmt.is_from_statement():
+        yield stmt.statement_block
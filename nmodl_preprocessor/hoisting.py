@@ -0,0 +1,98 @@
+"""
+Hoist loop-invariant assignments out of the per-timestep blocks of code.
+
+Some ASSIGNED variables are computed in the BREAKPOINT, DERIVATIVE, or KINETIC
+blocks from nothing but GLOBAL parameters and constants, for example
+"tadj = q10^((celsius-23)/10)". Their values are the same for every instance of
+the mechanism and for every time step, yet they are recomputed for every
+compartment on every time step. This module moves these assignments into the
+INITIAL block, so that they are computed once per run.
+"""
+import nmodl
+import nmodl.ast
+import nmodl.dsl
+ANT = nmodl.ast.AstNodeType
+
+from nmodl_preprocessor.utils import *
+from nmodl_preprocessor.common_subexpressions import is_pure, read_variables
+
+def hoist_invariant_assignments(program, targets, invariant_vars) -> dict:
+    """
+    Move the assignments to the target variables out of the per-timestep blocks
+    of code and into the INITIAL block, if they only depend on invariant
+    variables. The AST is modified in place.
+
+    Argument targets is the set of ASSIGNED variables which may be hoisted.
+    Argument invariant_vars is the set of variables which never change
+    during a simulation run.
+
+    Returns a dict of the hoisted variables, mapping from name to the name of
+    the block that they were hoisted out of. The dict is in the same order as
+    the new assignments in the INITIAL block.
+    """
+    lookup = nmodl.dsl.visitor.AstLookupVisitor().lookup
+    # Only hoist variables which are always assigned the same value. The
+    # assignments in INITIAL blocks and in any remaining procedures are left
+    # alone, they recompute the same value.
+    assigned_values = {} # Maps from variable name to set of expressions assigned to it.
+    for node in lookup(program, ANT.BINARY_EXPRESSION):
+        if node.op.eval() == '=' and node.lhs.is_var_name():
+            name = STR(node.lhs.name.get_node_name())
+            assigned_values.setdefault(name, set()).add(STR(nmodl.to_nmodl(node.rhs)))
+    other_writes = set()
+    for node in lookup(program, ANT.FROM_STATEMENT):
+        other_writes.add(STR(node.name.get_node_name()))
+    # Local variables and arguments can shadow the target variables.
+    for node in lookup(program, ANT.LOCAL_VAR) + lookup(program, ANT.ARGUMENT):
+        other_writes.add(STR(node.name.get_node_name()))
+    targets = {name for name in targets
+               if len(assigned_values.get(name, ())) == 1 and name not in other_writes}
+    invariant_vars = {name for name in invariant_vars
+                      if name not in assigned_values and name not in other_writes}
+    # Hoisted variables are also invariant, so repeat until nothing changes.
+    hoisted = {}
+    hoisted_stmts = []
+    while True:
+        num_hoisted = len(hoisted)
+        for block in program.blocks:
+            if not (block.is_breakpoint_block() or block.is_derivative_block() or block.is_kinetic_block()):
+                continue
+            _hoist(block.statement_block, get_block_name(block), targets,
+                   invariant_vars | set(hoisted), hoisted, hoisted_stmts)
+        if len(hoisted) == num_hoisted:
+            break
+    if not hoisted:
+        return hoisted
+    # Insert the hoisted statements at the start of the INITIAL block.
+    for initial_block in program.blocks:
+        if initial_block.is_initial_block():
+            break
+    else:
+        initial_block = nmodl.NmodlDriver().parse_string('INITIAL {\n}').blocks[0].clone()
+        program.blocks = list(program.blocks) + [initial_block]
+    statement_block = initial_block.statement_block
+    statement_block.statements = hoisted_stmts + list(statement_block.statements)
+    return hoisted
+
+def _hoist(statement_block, block_name, targets, invariant_vars, hoisted, hoisted_stmts):
+    """ Search the unconditional statements of a block, including any nested blocks. """
+    keep = []
+    for stmt in statement_block.statements:
+        if stmt.is_expression_statement():
+            expr = stmt.expression
+            if expr.is_statement_block():
+                _hoist(expr, block_name, targets, invariant_vars, hoisted, hoisted_stmts)
+            elif (expr.is_binary_expression() and expr.op.eval() == '=' and
+                    expr.lhs.is_var_name() and not expr.lhs.name.is_indexed_name()):
+                name = STR(expr.lhs.name.get_node_name())
+                if name in hoisted:
+                    continue # Remove the duplicate assignments too.
+                if (name in targets and is_pure(expr.rhs) and
+                        read_variables(expr.rhs) <= invariant_vars):
+                    hoisted[name] = block_name
+                    hoisted_stmts.append(stmt.clone())
+                    invariant_vars.add(name)
+                    continue
+        keep.append(stmt)
+    if len(keep) != len(statement_block.statements):
+        statement_block.statements = keep
@@ -0,0 +1,208 @@
+"""
+Incremental builds.
+
+The manifest is stored in the output directory and it records a hash of all of
+the inputs that produced each output file. Mechanisms whose inputs have not
+changed are neither re-optimized nor rewritten, which preserves their
+modification times so that nrnivmodl does not needlessly recompile them.
+
+The compile record is also stored in the output directory and it records the
+mechanisms which were given to nrnivmodl the last time that it succeeded. If
+none of them have changed, then nrnivmodl does not need to run at all.
+"""
+from importlib import metadata
+from pathlib import Path
+from types import SimpleNamespace
+import functools
+import hashlib
+import json
+import os
+import platform
+import re
+import shutil
+
+import nmodl
+
+from nmodl_preprocessor.optimize_nmodl import include_regex, find_include_file
+from nmodl_preprocessor.project_files import include_suffixes
+
+manifest_file_name = 'manifest.json'
+compile_record_file_name = 'compiled.json'
+
+word_regex = re.compile(br'\b\w+\b')
+
+def hash_bytes(data) -> str:
+    return hashlib.sha256(data).hexdigest()
+
+def hash_file(path) -> str:
+    with open(path, 'rb') as f:
+        return hash_bytes(f.read())
+
+@functools.lru_cache(maxsize=None)
+def tool_version() -> str:
+    """ Identify this program and the NMODL library, including any local modifications. """
+    try:
+        version = metadata.version('nmodl_preprocessor')
+    except metadata.PackageNotFoundError:
+        version = ''
+    source_code = b''.join(path.read_bytes() for path in sorted(Path(__file__).parent.glob('*.py')))
+    return f'{version} {getattr(nmodl, "__version__", "")} {hash_bytes(source_code)}'
+
+def relevant_symbols(words, symbols) -> list:
+    """
+    Filter the symbols down to the ones which could refer to any of the words,
+    either directly or after removing a mechanism's suffix from the symbol.
+    """
+    relevant = []
+    for x in symbols:
+        if x[:1].isdigit():
+            continue # Numbers are not symbols.
+        if x in words:
+            relevant.append(x)
+            continue
+        idx = x.find('_', 1)
+        while idx > 0:
+            if x[:idx] in words:
+                relevant.append(x)
+                break
+            idx = x.find('_', idx + 1)
+    return sorted(relevant)
+
+def read_inputs(input_file, nmodl_text=None) -> SimpleNamespace:
+    """
+    Read an nmodl file and the files which it includes.
+    Optional argument nmodl_text is the contents of the input_file, if already known.
+
+    Returns a namespace with the attributes:
+        text        - the contents of the input_file
+        includes    - dict mapping from each included file name to the hash of
+                      its contents, or None if it could not be read
+        words       - set of all of the words in the file and its includes
+    """
+    input_file = Path(input_file)
+    if nmodl_text is None:
+        with open(input_file, 'rb') as f:
+            nmodl_text = f.read()
+    words = set(word_regex.findall(nmodl_text))
+    includes = {}
+    for match in re.finditer(include_regex, nmodl_text):
+        file = match.groups()[0].decode(errors='replace')
+        try:
+            with open(find_include_file(file, input_file), 'rb') as f:
+                include_text = f.read()
+        except (OSError, ValueError):
+            includes[file] = None
+            continue
+        includes[file] = hash_bytes(include_text)
+        words.update(word_regex.findall(include_text))
+    words = {x.decode(errors='replace') for x in words}
+    # The initial values of the STATE variables are implicitly named with a "0" suffix.
+    words.update([x + '0' for x in words])
+    return SimpleNamespace(text=nmodl_text, includes=includes, words=words)
+
+def hash_inputs(inputs, external_refs, other_nmodl_refs, celsius, range_assignments=None, **options) -> str:
+    """
+    Hash everything which can affect the result of optimizing an nmodl file.
+
+    Argument inputs is the result of read_inputs().
+    Arguments external_refs and other_nmodl_refs are the symbols which could
+              refer to the words of the inputs.
+    """
+    if range_assignments is not None:
+        range_assignments = {x: range_assignments[x] for x in relevant_symbols(inputs.words, range_assignments)}
+    key = {
+        'version':           tool_version(),
+        'input':             hash_bytes(inputs.text),
+        'includes':          inputs.includes,
+        'external_symbols':  sorted(external_refs),
+        'other_nmodl_refs':  sorted(other_nmodl_refs),
+        'celsius':           celsius,
+        'range_assignments': range_assignments,
+        'options':           options,
+    }
+    return hash_bytes(json.dumps(key, sort_keys=True).encode())
+
+def copy_if_changed(src, dst):
+    """ Copy a file, unless the destination already has the same contents. """
+    try:
+        if hash_file(src) == hash_file(dst):
+            return
+    except OSError:
+        pass
+    shutil.copy(src, dst)
+
+class Manifest:
+    def __init__(self, output_dir):
+        self.path = Path(output_dir).joinpath(manifest_file_name)
+        try:
+            with open(self.path, 'rt') as f:
+                self.entries = json.load(f)
+        except (OSError, ValueError):
+            self.entries = {}
+
+    def is_current(self, output_file, key) -> bool:
+        """ Check if the output file was made from the given inputs and has not been modified since. """
+        entry = self.entries.get(Path(output_file).name)
+        if entry is None or entry['key'] != key:
+            return False
+        try:
+            return hash_file(output_file) == entry['output']
+        except OSError:
+            return False
+
+    def update(self, output_file, key, footprint=None):
+        name = Path(output_file).name
+        try:
+            self.entries[name] = {'key': key, 'output': hash_file(output_file), 'footprint': footprint}
+        except OSError:
+            self.entries.pop(name, None)
+
+    def footprint(self, output_file):
+        """ Returns the memory footprints which were recorded with the output file. """
+        entry = self.entries.get(Path(output_file).name) or {}
+        return entry.get('footprint')
+
+    def retain(self, output_files):
+        """ Forget about all files except for these ones. """
+        names = {Path(x).name for x in output_files}
+        self.entries = {k: v for k, v in self.entries.items() if k in names}
+
+    def save(self):
+        tmp_path = self.path.with_name(self.path.name + '.tmp')
+        with open(tmp_path, 'wt') as f:
+            json.dump(self.entries, f, indent=4, sort_keys=True)
+        os.replace(tmp_path, self.path)
+
+class CompileRecord:
+    def __init__(self, output_dir, cwd):
+        self.path = Path(output_dir).joinpath(compile_record_file_name)
+        self.mod_files = sorted(Path(output_dir).glob('*.mod'))
+        # The C/C++ files which the mechanisms may include.
+        self.include_files = sorted(x for x in Path(output_dir).iterdir()
+                                    if x.suffix in include_suffixes and x.is_file())
+        # nrnivmodl builds into a directory named after the machine architecture.
+        self.build_dir = Path(cwd).joinpath(platform.machine())
+        self.entry = {
+            'cwd':       str(Path(cwd).resolve()),
+            'nrnivmodl': shutil.which('nrnivmodl'),
+            'mod_files': {x.name: hash_file(x) for x in self.mod_files},
+            'includes':  {x.name: hash_file(x) for x in self.include_files},
+        }
+
+    def is_current(self) -> bool:
+        """ Check if nrnivmodl has already compiled exactly these mechanisms. """
+        if not self.build_dir.joinpath('special').exists():
+            return False
+        try:
+            with open(self.path, 'rt') as f:
+                return json.load(f) == self.entry
+        except (OSError, ValueError):
+            return False
+
+    def save(self):
+        with open(self.path, 'wt') as f:
+            json.dump(self.entry, f, indent=4, sort_keys=True)
+
+    def discard(self):
+        if self.path.exists():
+            self.path.unlink()
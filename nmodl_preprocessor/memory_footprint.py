@@ -0,0 +1,113 @@
+"""
+Measure the memory footprint of each instance of a mechanism.
+
+NEURON allocates storage for every instance of a mechanism: one double for each
+RANGE variable, STATE variable, and the derivative of each STATE variable, and
+one pointer for each ion variable. This module counts them in the NMODL source
+code so that the memory savings of the optimizations can be reported.
+
+The counts are approximate because NEURON also allocates some bookkeeping data
+which is not visible in the NMODL code, and which the optimizations never change.
+"""
+import json
+import os
+
+import nmodl
+import nmodl.symtab
+
+from nmodl_preprocessor.utils import *
+
+report_file_name = 'memory.json'
+
+bytes_per_double  = 8
+bytes_per_pointer = 8
+
+def measure_footprint(program) -> dict:
+    """
+    Count the per-instance storage of a mechanism.
+    Argument program is an AST which has a symbol table.
+    """
+    sym_table           = program.get_symbol_table()
+    sym_type            = nmodl.symtab.NmodlType
+    get_vars_with_prop  = lambda prop: set(STR(x.get_name()) for x in sym_table.get_variables_with_properties(prop))
+    range_vars          = get_vars_with_prop(sym_type.range_var)
+    parameter_vars      = get_vars_with_prop(sym_type.param_assign)
+    assigned_vars       = get_vars_with_prop(sym_type.assigned_definition)
+    state_vars          = get_vars_with_prop(sym_type.state_var)
+    read_ion_vars       = get_vars_with_prop(sym_type.read_ion_var)
+    write_ion_vars      = get_vars_with_prop(sym_type.write_ion_var)
+    nonspecific_vars    = get_vars_with_prop(sym_type.nonspecific_cur_var)
+    electrode_cur_vars  = get_vars_with_prop(sym_type.electrode_cur_var)
+    pointer_vars        = get_vars_with_prop(sym_type.pointer_var) | get_vars_with_prop(sym_type.bbcore_pointer_var)
+    ion_names           = get_vars_with_prop(sym_type.useion)
+    # Find the size of every variable, arrays have more than one element.
+    sizes = {}
+    for symbol in sym_table.get_variables_with_properties(
+            sym_type.param_assign | sym_type.assigned_definition | sym_type.state_var):
+        for decl in symbol.get_nodes():
+            if length := getattr(decl, 'length', None):
+                try:
+                    sizes[STR(symbol.get_name())] = int(nmodl.to_nmodl(length))
+                except ValueError:
+                    pass
+    count = lambda names: sum(sizes.get(name, 1) for name in names)
+    # ASSIGNED variables which are not declared RANGE are stored globally,
+    # except for the variables which NEURON shares with this mechanism.
+    instance_assigned = (assigned_vars - state_vars - parameter_vars) & (
+            range_vars | read_ion_vars | write_ion_vars | nonspecific_vars | electrode_cur_vars | {'v'})
+    # Each ion variable is accessed through a pointer, and so is the
+    # derivative of each ion current with respect to the voltage.
+    ion_currents = {name for name in write_ion_vars if any(name == 'i' + ion for ion in ion_names)}
+    footprint = {
+        'range_parameters': count(parameter_vars & range_vars - state_vars),
+        'assigned':         count(instance_assigned),
+        'states':           count(state_vars),
+        'derivatives':      count(state_vars),
+        'ion_pointers':     len(read_ion_vars | write_ion_vars) + len(ion_currents),
+        'pointers':         len(pointer_vars),
+        'arrays':           {name: size for name, size in sorted(sizes.items())
+                             if name in (parameter_vars & range_vars) | instance_assigned | state_vars},
+    }
+    footprint['doubles'] = (footprint['range_parameters'] + footprint['assigned'] +
+                            footprint['states'] + footprint['derivatives'])
+    footprint['bytes'] = (footprint['doubles'] * bytes_per_double +
+                          (footprint['ion_pointers'] + footprint['pointers']) * bytes_per_pointer)
+    return footprint
+
+def measure_nmodl(nmodl_text):
+    """ Returns the footprint of the given NMODL code, or None if it can not be parsed. """
+    try:
+        program = nmodl.NmodlDriver().parse_string(nmodl_text)
+        nmodl.symtab.SymtabVisitor().visit_program(program)
+    except RuntimeError:
+        return None
+    return measure_footprint(program)
+
+def save_report(output_dir, footprints):
+    """
+    Write the memory report for all of the mechanisms into the output directory.
+    Argument footprints maps from file name to the pair of footprints (before, after).
+
+    Returns the report.
+    """
+    mechanisms = {}
+    total = {'before': 0, 'after': 0}
+    for name, (before, after) in sorted(footprints.items()):
+        if before is None or after is None:
+            mechanisms[name] = {'before': before, 'after': after}
+            continue
+        mechanisms[name] = {'before': before, 'after': after,
+                            'saved_bytes': before['bytes'] - after['bytes']}
+        total['before'] += before['bytes']
+        total['after']  += after['bytes']
+    total['saved_bytes'] = total['before'] - total['after']
+    report = {
+        'bytes_per_double':  bytes_per_double,
+        'bytes_per_pointer': bytes_per_pointer,
+        'mechanisms':        mechanisms,
+        'total_bytes_per_instance': total,
+    }
+    path = os.path.join(output_dir, report_file_name)
+    with open(path, 'wt') as f:
+        json.dump(report, f, indent=4)
+    return report
@@ -6,6 +6,11 @@ import math
 import textwrap
 import nmodl.dsl
 
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
 nmodl_builtins = {
     # This list of NMODL's built-in functions was copied from the documentation at:
     # https://github.com/neuronsimulator/nrn/blob/master/docs/guide/nmodls_built_in_functions.rst
@@ -40,16 +45,105 @@ nmodl_builtins = {
     "R":        8.31441, # molar gas constant, joules/mole/deg-K
 }
 
+# These procedures do not change any variables, so they're ignored.
+noop_functions = {"net_send", "net_event", "net_move", "printf"}
+
+# The longest FROM loop to execute.
+max_loop_iterations = 100000
+
 class VerbatimError(ValueError): pass
 
 class ComplexityError(ValueError): pass
 
+def from_range(start, stop, step=1):
+    """ Returns the values of the variable of a FROM loop, which includes both ends. """
+    start, stop, step = int(start), int(stop), int(step)
+    values = range(start, stop + (1 if step > 0 else -1), step)
+    if len(values) > max_loop_iterations:
+        raise ComplexityError('from_statement')
+    return values
+
+# Helpers for the generated code.
+python_helpers = {
+    "_index":       lambda value: int(value),
+    "_from":        from_range,
+    "_noop":        lambda: 0.0,
+    "_undefined":   math.nan,
+}
+
+def vector_index(value):
+    """ Array indices must be the same in every sample. """
+    values = numpy.unique(value)
+    if len(values) != 1:
+        raise ComplexityError('indexed_name')
+    return int(values[0])
+
+# The same built-in functions, but operating on arrays of samples.
+if numpy is not None:
+    numpy_builtins = dict(nmodl_builtins)
+    numpy_builtins.update({
+        "abs":      numpy.fabs,
+        "acos":     numpy.arccos,
+        "asin":     numpy.arcsin,
+        "atan":     numpy.arctan,
+        "atan2":    numpy.arctan2,
+        "ceil":     numpy.ceil,
+        "cos":      numpy.cos,
+        "cosh":     numpy.cosh,
+        "exp":      numpy.exp,
+        "fabs":     numpy.fabs,
+        "floor":    numpy.floor,
+        "fmod":     numpy.fmod,
+        "log":      numpy.log,
+        "log10":    numpy.log10,
+        "pow":      numpy.power,
+        "sin":      numpy.sin,
+        "sinh":     numpy.sinh,
+        "sqrt":     numpy.sqrt,
+        "tan":      numpy.tan,
+        "tanh":     numpy.tanh,
+        # Helpers for the vectorized control flow.
+        "_bool":    lambda x: numpy.asarray(x) != 0,
+        "_and":     lambda a, b: numpy.logical_and(a, b),
+        "_or":      lambda a, b: numpy.logical_or(a, b),
+        "_not":     lambda x: numpy.logical_not(x),
+        "_where":   numpy.where,
+    })
+    numpy_builtins.update(python_helpers)
+    numpy_builtins.update({
+        "_index":   vector_index,
+        "_from":    lambda *bounds: from_range(*(vector_index(x) for x in bounds)),
+    })
+
 
 class PyGenerator(nmodl.dsl.visitor.AstVisitor):
-    def __init__(self):
+    """
+    Argument vectorized generates code which operates on numpy arrays. Instead
+             of branching, the IF statements compute a boolean mask of the
+             samples which take each branch, and the assignments only update
+             the samples in the current mask, which is named "_mask". After
+             each branch, the code calls "_branch(_mask, names, calls)" with
+             the variables which the branch assigns to and the functions which
+             it calls, so that the caller can find the branches which no
+             sample takes.
+    Argument functions maps from name to the FUNCTION and PROCEDURE blocks
+             which can be called, because they were not inlined. After
+             visiting the code, call generate_functions() to define them.
+
+    The generated code uses the helpers in python_helpers or numpy_builtins.
+    """
+    def __init__(self, vectorized=False, functions=None):
         super().__init__()
         self.code_stack = []
         self.pycode = ""
+        self.vectorized = vectorized
+        self.functions = functions or {}
+        self.mask_depth = 0
+        self.assigned_names = {} # Ordered set, in the order of the first assignment.
+        self.local_names = set()
+        self.called = set()
+        self.branches = [] # Stack of (assigned names, called functions) for the enclosing branches.
+        self.function_writes = {} # Maps from function name to the global variables which calling it may write to.
 
     def push_block(self):
         self.code_stack.append(self.pycode)
@@ -58,7 +152,7 @@ class PyGenerator(nmodl.dsl.visitor.AstVisitor):
     def pop_block(self):
         parent_block = self.code_stack.pop()
         if parent_block.rstrip().endswith(':'):
-            self.pycode = textwrap.indent(self.pycode, '    ')
+            self.pycode = textwrap.indent(self.pycode or 'pass\n', '    ')
         self.pycode = parent_block + self.pycode
 
     def visit_statement_block(self, node):
@@ -72,16 +166,67 @@ class PyGenerator(nmodl.dsl.visitor.AstVisitor):
 
     def visit_wrapped_expression(self, node):
         self.pycode += '('
-        node.visit_children(self)
+        # The InlineVisitor replaces function calls with the bare name of the
+        # variable which holds the return value.
+        if node.expression.is_name():
+            self.pycode += node.expression.get_node_name()
+        else:
+            node.visit_children(self)
         self.pycode += ')'
 
+    def visit_operand(self, node):
+        # Pybind11 does not call a python method which is already running with
+        # the same self, so visit_binary_expression() can not directly visit
+        # another binary expression. Go through this method instead.
+        node.accept(self)
+
     def visit_binary_expression(self, node):
         op = node.op.eval()
+        if op == "=" and node.lhs.is_var_name() and not node.lhs.name.is_indexed_name():
+            self.assign(node.lhs.name.get_node_name())
+        if self.vectorized:
+            if op in ("&&", "||"):
+                self.pycode += ("_and(" if op == "&&" else "_or(")
+                self.visit_operand(node.lhs)
+                self.pycode += ", "
+                self.visit_operand(node.rhs)
+                self.pycode += ")"
+                return
+            elif op == "=" and self.mask_depth:
+                self.visit_operand(node.lhs)
+                self.pycode += " = _where(_mask, "
+                self.visit_operand(node.rhs)
+                self.pycode += ", "
+                self.visit_operand(node.lhs)
+                self.pycode += ")"
+                return
         if op == "^":
             op = '**'
-        node.lhs.accept(self)
+        elif op == "&&":
+            op = 'and'
+        elif op == "||":
+            op = 'or'
+        self.visit_operand(node.lhs)
         self.pycode += f" {op} "
-        node.rhs.accept(self)
+        self.visit_operand(node.rhs)
+
+    def assign(self, name):
+        self.assigned_names[name] = None
+        for names, calls in self.branches:
+            names.add(name)
+
+    def visit_unary_expression(self, node):
+        op = node.op.eval()
+        if op == "!":
+            if self.vectorized:
+                self.pycode += '_not('
+                node.expression.accept(self)
+                self.pycode += ')'
+                return
+            op = 'not '
+        self.pycode += '(' + op
+        node.expression.accept(self)
+        self.pycode += ')'
 
     def visit_var_name(self, node):
         if node.name.is_indexed_name():
@@ -99,6 +244,9 @@ class PyGenerator(nmodl.dsl.visitor.AstVisitor):
         raise VerbatimError()
 
     def visit_if_statement(self, node):
+        if self.vectorized:
+            self.visit_if_statement_vectorized(node)
+            return
         self.pycode += "if "
         node.condition.accept(self)
         self.pycode += ":\n"
@@ -112,18 +260,51 @@ class PyGenerator(nmodl.dsl.visitor.AstVisitor):
             self.pycode += "else:\n"
             else_node.statement_block.accept(self)
 
+    def visit_if_statement_vectorized(self, node):
+        depth = self.mask_depth
+        self.mask_depth += 1
+        # Save the mask of the enclosing block, and track which of its samples
+        # have not yet taken any of the branches.
+        self.pycode += f"_outer{depth} = _mask\n"
+        self.pycode += f"_rest{depth} = _mask\n"
+        branches = [(node.condition, node.statement_block)]
+        branches.extend((x.condition, x.statement_block) for x in node.elseifs)
+        for condition, block in branches:
+            self.pycode += f"_cond{depth} = _bool("
+            condition.accept(self)
+            self.pycode += ")\n"
+            self.pycode += f"_mask = _and(_rest{depth}, _cond{depth})\n"
+            self.pycode += f"_rest{depth} = _and(_rest{depth}, _not(_cond{depth}))\n"
+            self.visit_branch(block)
+        if else_node := node.elses:
+            self.pycode += f"_mask = _rest{depth}\n"
+            self.visit_branch(else_node.statement_block)
+        self.pycode += f"_mask = _outer{depth}\n"
+        self.mask_depth -= 1
+
+    def visit_branch(self, block):
+        names, calls = set(), set()
+        self.branches.append((names, calls))
+        block.accept(self)
+        self.branches.pop()
+        # The enclosing blocks restore the mask to this branch's mask.
+        names = sorted(names - self.local_names)
+        self.pycode += f"_branch(_mask, {names!r}, {sorted(calls)!r})\n"
+
     def visit_function_call(self, node):
         name = node.name.get_node_name()
         if name in nmodl_builtins:
             pass
-        elif name == "net_send":
-            raise ComplexityError(f'call {name}')
-        else:
+        elif name in noop_functions:
+            self.pycode += "_noop()"
+            return
+        elif name in self.functions:
             # All functions and procedures should have been inlined already.
             # The exceptions mostly involve TABLE statements.
-            # I could attempt to evaluate these calls, but that would be very
-            # complicated, especially because python does not support ASSIGNED
-            # variables, which would need to be communicated back to the caller.
+            self.called.add(name)
+            for names, calls in self.branches:
+                calls.add(name)
+        else:
             raise ComplexityError(f'call {name}')
         # 
         self.pycode += name + "("
@@ -136,6 +317,169 @@ class PyGenerator(nmodl.dsl.visitor.AstVisitor):
         # Can not guarantee correct results BC the condition might reference unknown values.
         raise ComplexityError('while_statement')
 
+    def visit_integer_expression(self, node):
+        # Array indices and loop bounds can be bare names instead of variables.
+        if node.is_name():
+            self.pycode += node.get_node_name()
+        else:
+            node.accept(self)
+
     def visit_indexed_name(self, node):
-        raise ComplexityError('indexed_name')
+        self.pycode += node.name.get_node_name() + "[_index("
+        self.visit_integer_expression(node.length)
+        self.pycode += ")]"
+
+    def visit_from_statement(self, node):
+        name = node.name.get_node_name()
+        self.assign(name)
+        self.pycode += f"for {name} in _from("
+        self.visit_integer_expression(getattr(node, 'from'))
+        self.pycode += ", "
+        self.visit_integer_expression(node.to)
+        if node.increment:
+            self.pycode += ", "
+            self.visit_integer_expression(node.increment)
+        self.pycode += "):\n"
+        node.statement_block.accept(self)
+
+    def visit_local_list_statement(self, node):
+        # Local variables are not initialized, so their values are unknown.
+        for var in node.variables:
+            name = var.name.get_node_name()
+            self.local_names.add(name)
+            if var.name.is_indexed_name():
+                self.pycode += f"{name} = [_undefined] * _index("
+                self.visit_integer_expression(var.name.length)
+                self.pycode += ")"
+                self.pycode += "\n"
+            else:
+                self.pycode += f"{name} = _undefined\n"
+
+    def visit_table_statement(self, node):
+        pass # Calculate the function instead of interpolating.
 
+    def generate_function(self, node):
+        """ Generate the python definition of a FUNCTION or PROCEDURE block. """
+        name = node.get_node_name()
+        args = [arg.get_node_name() for arg in node.parameters]
+        self.local_names.update(args)
+        if node.is_function_block():
+            self.local_names.add(name)
+        # The caller might be inside of a branch.
+        if self.vectorized:
+            self.mask_depth = 1
+        node.statement_block.accept(self)
+        header = []
+        if self.vectorized:
+            header.append("global _mask")
+        if global_names := sorted(self.assigned_names.keys() - self.local_names):
+            header.append("global " + ", ".join(global_names))
+        if node.is_function_block():
+            header.append(f"{name} = _undefined")
+            footer = f"return {name}\n"
+        else:
+            footer = "return 0.0\n"
+        body = ''.join(x + '\n' for x in header) + self.pycode + footer
+        self.pycode = f"def {name}({', '.join(args)}):\n" + textwrap.indent(body, '    ')
+        return global_names
+
+    def generate_functions(self):
+        """ Define all of the functions which the code calls, before the code. """
+        definitions = ""
+        calls = {}
+        done = set()
+        todo = sorted(self.called)
+        while todo:
+            name = todo.pop()
+            if name in done:
+                continue
+            done.add(name)
+            x = PyGenerator(self.vectorized, self.functions)
+            # Writes to global variables are visible to the caller.
+            self.function_writes[name] = set(x.generate_function(self.functions[name]))
+            self.assigned_names.update(dict.fromkeys(self.function_writes[name]))
+            definitions += x.pycode
+            calls[name] = x.called
+            todo.extend(sorted(x.called - done))
+        # Include the writes of the functions which each function calls.
+        changed = True
+        while changed:
+            changed = False
+            for name, callees in calls.items():
+                for callee in callees:
+                    if not self.function_writes[callee] <= self.function_writes[name]:
+                        self.function_writes[name] |= self.function_writes[callee]
+                        changed = True
+        self.pycode = definitions + self.pycode
+
+
+
+def evaluate_samples(node, scope, unknowns, num_samples, tolerance, functions=None, seed=0) -> dict:
+    """
+    Execute the block of code on many random samples of the unknown input values
+    at once, using numpy arrays.
+
+    Argument scope is the global scope for the code.
+    Argument unknowns is the names of the input variables to randomize.
+    Argument tolerance is the largest relative difference between the samples
+             of a value which is considered to be constant.
+    Argument functions is passed to the PyGenerator.
+
+    Returns the local scope after executing the code. The values which do not
+    depend on the unknowns are unchanged, the values which are the same in every
+    sample are floats, and all other values are NaN. The variables which are
+    assigned to in a branch which none of the samples take are also NaN, because
+    the samples do not show what happens when it is taken.
+    """
+    assert numpy is not None
+    x = PyGenerator(vectorized=True, functions=functions)
+    node.accept(x)
+    x.generate_functions()
+    # Copy the arrays, which the code modifies in place.
+    scope = {name: (list(value) if isinstance(value, list) else value) for name, value in scope.items()}
+    scope.update(numpy_builtins)
+    scope['_mask'] = numpy.True_
+    unexercised = set()
+    def branch(mask, names, calls):
+        # A mask which does not depend on the unknowns is not an array, and
+        # then the branch is never taken for any values of the unknowns.
+        if isinstance(mask, numpy.ndarray) and not numpy.any(mask):
+            unexercised.update(names, *(x.function_writes[name] for name in calls))
+    scope['_branch'] = branch
+    rng = numpy.random.default_rng(seed)
+    def sample():
+        # Cover many orders of magnitude, with both signs.
+        magnitude = 10.0 ** rng.uniform(-3, 3, num_samples)
+        sign      = rng.choice([-1.0, 1.0], num_samples)
+        return sign * magnitude
+    for name in sorted(unknowns):
+        if isinstance(scope[name], list):
+            scope[name] = [sample() for _ in scope[name]]
+        else:
+            scope[name] = sample()
+    # Variables can be assigned inside of a branch before they're defined.
+    for name in x.assigned_names.keys() - scope.keys():
+        scope[name] = numpy.full(num_samples, math.nan)
+    with numpy.errstate(all='ignore'):
+        exec(x.pycode, scope)
+    results = {}
+    for name in x.assigned_names:
+        value = scope[name]
+        if isinstance(value, list):
+            continue
+        if name in unexercised:
+            results[name] = math.nan
+            continue
+        if isinstance(value, (numpy.generic, numpy.ndarray)) and numpy.ndim(value) == 0:
+            value = value.item()
+        # Values which do not depend on the unknowns are not arrays.
+        if not isinstance(value, numpy.ndarray):
+            results[name] = value
+            continue
+        value = value.astype(float)
+        lo, hi = numpy.min(value), numpy.max(value)
+        if numpy.all(numpy.isfinite(value)) and hi - lo <= tolerance * max(abs(lo), abs(hi)):
+            results[name] = float(numpy.median(value))
+        else:
+            results[name] = math.nan
+    return results
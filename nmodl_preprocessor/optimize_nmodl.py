@@ -1,8 +1,11 @@
 from types import SimpleNamespace
 from pathlib import Path
 import math
+import os
 import re
 import shutil
+import sys
+import tempfile
 import textwrap
 
 import nmodl.ast
@@ -14,20 +17,103 @@ from nmodl_preprocessor.utils import *
 from nmodl_preprocessor.rw_patterns import RW_Visitor
 from nmodl_preprocessor.cpp_keywords import cpp_keywords
 from nmodl_preprocessor import nmodl_to_python
+from nmodl_preprocessor import constant_folding
+from nmodl_preprocessor import dead_code
+from nmodl_preprocessor import dataflow
+from nmodl_preprocessor import common_subexpressions
+from nmodl_preprocessor import rate_tables
+from nmodl_preprocessor import hoisting
+from nmodl_preprocessor import conservation
+from nmodl_preprocessor import memory_footprint
+from nmodl_preprocessor import profiling
 
 # Don't remove parameters with these names, because of unexpected name conflicts
 # caused by auto-generated initial values.
 parameter_name_conflicts = {'y0', 'j0'}
 
-def optimize_nmodl(input_file, output_file, external_refs, other_nmodl_refs, celsius=None) -> bool:
-    # 
+include_regex = re.compile(br'\bINCLUDE\s*"(.*)"')
+
+identifier_regex = re.compile(r'\b\w+\b')
+
+def find_include_file(file, input_file) -> Path:
+    """ Resolve the file name of an INCLUDE statement in the given nmodl file. """
+    # TODO: This is supposed to search the environment variable "MODL_INCLUDES".
+    for path in (Path.cwd(), input_file.parent,):
+        include_file = path.joinpath(file)
+        if include_file.exists():
+            return include_file
+    raise ValueError(f'file not found {file}')
+
+def is_code_block(node):
+    """ Does this top-level block contain source code? """
+    return not (
+            node.is_model() or
+            node.is_block_comment() or
+            node.is_neuron_block() or
+            node.is_unit_block() or
+            node.is_unit_state() or
+            node.is_param_block() or
+            node.is_constant_block() or
+            node.is_state_block() or
+            node.is_assigned_block() or
+            node.is_local_list_statement() or
+            node.is_define())
+
+def optimize_nmodl_captured(*args, **kwargs):
+    """
+    Run optimize_nmodl() and capture everything that it prints, including the
+    messages which the NMODL library writes directly to the stdout & stderr
+    file descriptors. This is intended for use in worker processes.
+
+    Returns the tuple (log, result, error, events) where result is the return
+    value of optimize_nmodl(), error is the exception which was raised or None
+    if there was no error, and events are the phases which were profiled.
+    """
+    sys.stdout.flush()
+    sys.stderr.flush()
+    saved_fds = (os.dup(1), os.dup(2))
+    result = None
+    error = None
+    with tempfile.TemporaryFile() as log:
+        os.dup2(log.fileno(), 1)
+        os.dup2(log.fileno(), 2)
+        try:
+            result = profiling.call(args[0], optimize_nmodl, *args, **kwargs)
+        except Exception as x:
+            error = x
+        finally:
+            sys.stdout.flush()
+            sys.stderr.flush()
+            os.dup2(saved_fds[0], 1)
+            os.dup2(saved_fds[1], 2)
+            for fd in saved_fds:
+                os.close(fd)
+        log.seek(0)
+        return log.read().decode(errors='replace'), result, error, profiling.collect()
+
+def optimize_nmodl(input_file, output_file, external_refs, other_nmodl_refs, celsius=None, nmodl_text=None,
+                   fold_constants=True, remove_dead_code=True, cse=False, hoist=False, conserve=False,
+                   tabulate=False, table_range=(-100.0, 100.0), table_size=200,
+                   range_assignments=None, initial_samples=64, initial_tolerance=1e-12) -> tuple:
+    """
+    Returns the pair of memory footprints from before and after optimizing the
+    mechanism, see memory_footprint.measure_footprint(). Either may be None.
+
+    Argument initial_samples is the number of random values of the unknown inputs
+             to evaluate the INITIAL block with, or zero to represent them as NaN.
+    Argument initial_tolerance is the largest relative difference between the
+             samples of an ASSIGNED variable which is still considered constant.
+    """
     def print(*strings, **kwargs):
         __builtins__['print'](input_file.name+':', *strings, **kwargs)
+    timer = profiling.PhaseTimer(input_file.name)
+    timer.phase('read')
 
     # First read the file as binary and discard as much of it as possible, in
-    # case it contains invalid utf-8.
-    with open(input_file, 'rb') as f:
-        nmodl_text = f.read()
+    # case it contains invalid utf-8. The caller may have already read the file.
+    if nmodl_text is None:
+        with open(input_file, 'rb') as f:
+            nmodl_text = f.read()
 
     def clean_nmodl(nmodl_text):
         # Remove comments.
@@ -39,16 +125,9 @@ def optimize_nmodl(input_file, output_file, external_refs, other_nmodl_refs, cel
     nmodl_text = clean_nmodl(nmodl_text)
 
     # Substitute INCLUDE statements with the file that they point to.
-    include_regex = re.compile(br'\bINCLUDE\s*"(.*)"')
     def include_file(match):
-        file = match.groups()[0].decode()
-        # TODO: This is supposed to search the environment variable "MODL_INCLUDES".
-        for path in (Path.cwd(), input_file.parent,):
-            include_file = path.joinpath(file)
-            if include_file.exists():
-                with open(include_file, 'rb') as f:
-                    return f.read()
-        raise ValueError(f'file not found {file}')
+        with open(find_include_file(match.groups()[0].decode(), input_file), 'rb') as f:
+            return f.read()
     nmodl_text = re.sub(include_regex, include_file, nmodl_text)
 
     nmodl_text = clean_nmodl(nmodl_text)
@@ -56,18 +135,23 @@ def optimize_nmodl(input_file, output_file, external_refs, other_nmodl_refs, cel
     nmodl_text = ''.join(filter((lambda x: x.isprintable() or x.isspace()), nmodl_text))
 
     # Parse the nmodl file into an AST.
+    timer.phase('parse')
     try:
         AST = nmodl.NmodlDriver().parse_string(nmodl_text)
     except RuntimeError as error:
         print("warning: could not parse file:", str(error))
         shutil.copy(input_file, output_file.parent.joinpath(input_file.name))
+        timer.stop()
         return
+    timer.phase('symtab')
     try:
         nmodl.symtab.SymtabVisitor().visit_program(AST)
     except RuntimeError as error:
         print("warning: could not build symbol table:", str(error))
         shutil.copy(input_file, output_file.parent.joinpath(input_file.name))
+        timer.stop()
         return
+    footprint = memory_footprint.measure_footprint(AST)
 
     visitor = nmodl.dsl.visitor.AstLookupVisitor()
     lookup  = lambda ast_node_type: visitor.lookup(AST, ast_node_type)
@@ -93,7 +177,8 @@ def optimize_nmodl(input_file, output_file, external_refs, other_nmodl_refs, cel
     if verbatim_length / len(nmodl_text) > .50:
         print('warning: too much VERBATIM, will not optimize')
         shutil.copy(input_file, output_file.parent.joinpath(input_file.name))
-        return
+        timer.stop()
+        return (footprint, footprint)
     # Let's get this warning out of the way. As chunks of arbitrary C/C++ code,
     # VERBATIM blocks can not be analysed. Assume that all symbols in VERBATIM
     # blocks are publicly visible and are both read from and written to.
@@ -102,28 +187,50 @@ def optimize_nmodl(input_file, output_file, external_refs, other_nmodl_refs, cel
         print('warning: VERBATIM may prevent optimization')
 
     # Inline all of the functions and procedures
+    timer.phase('inline')
     if not verbatim_vars: # The NMODL library fails to correctly analyze VERBATIM blocks.
         try:
             nmodl.dsl.visitor.InlineVisitor().visit_program(AST)
         except RuntimeError as error:
             print("warning: could not inline all functions and procedures:", str(error))
+            # Discard the partially inlined AST so that the NMODL library starts from a clean state.
+            AST = nmodl.NmodlDriver().parse_string(nmodl_text)
+            nmodl.symtab.SymtabVisitor().visit_program(AST)
         else:
-            nmodl_text = nmodl.to_nmodl(AST)
-        # Reload the modified AST so that the NMODL library starts from a clean state.
-        AST    = nmodl.NmodlDriver().parse_string(nmodl_text)
-        lookup = lambda ast_node_type: visitor.lookup(AST, ast_node_type)
-        nmodl.symtab.SymtabVisitor().visit_program(AST)
+            # Reuse the inlined AST instead of printing and re-parsing it.
+            # Only the symbol table needs to be refreshed.
+            nmodl.symtab.SymtabVisitor(update=True).visit_program(AST)
 
     # Find all external references to this mechanism.
+    timer.phase('analysis')
     try:
-        suffix = '_' + STR(next(iter(lookup(ANT.SUFFIX))).get_node_name())
+        suffix_node = next(iter(lookup(ANT.SUFFIX)))
+        suffix      = '_' + STR(suffix_node.get_node_name())
+        is_density  = STR(suffix_node.type.get_node_name()) == 'SUFFIX'
     except StopIteration:
-        suffix = ''
+        suffix      = ''
+        is_density  = False
     external_refs = set(external_refs) # Will mutate, don't alter the original version.
     for x in list(external_refs) + list(other_nmodl_refs):
         if x.endswith(suffix):
             external_refs.add(x[:-len(suffix)])
 
+    # Eliminate one STATE variable for each conservation law in the KINETIC blocks.
+    if conserve and not verbatim_vars:
+        timer.phase('conserve')
+        conserved = conservation.eliminate_conserved_states(AST, external_refs)
+        for block_name, reason in conserved.rejected.items():
+            print(f'warning: can not eliminate CONSERVE in {block_name}: {reason}')
+        for name, text in conserved.states.items():
+            print(f'eliminate conserved STATE: {name} = {text}')
+        for block_name in conserved.blocks:
+            print(f'solve {block_name} with derivimplicit instead of sparse')
+        if conserved.states:
+            # Rebuild the symbol table from scratch, without the eliminated states.
+            # Only the rewritten blocks were parsed again, not the whole program.
+            nmodl.symtab.SymtabVisitor().visit_program(AST)
+        timer.phase('analysis')
+
     # Extract important data from the symbol table.
     sym_table           = AST.get_symbol_table()
     sym_type            = nmodl.symtab.NmodlType
@@ -172,11 +279,52 @@ def optimize_nmodl(input_file, output_file, external_refs, other_nmodl_refs, cel
     for stmt in lookup(ANT.ASSIGNED_DEFINITION):
         if stmt.unit:
             assigned_units[STR(stmt.name)] = STR(stmt.unit)
+    # Move the assignments which do not depend on the instance or the time step
+    # out of the per-timestep code blocks and into the INITIAL block.
+    hoisted_vars = {} # Maps from variable name to the block it was hoisted out of.
+    if hoist:
+        timer.phase('hoist')
+        hoist_targets = (assigned_vars - neuron_vars - read_ion_vars - write_ion_vars -
+                nonspecific_vars - electrode_cur_vars - state_vars - pointer_vars - verbatim_vars -
+                set(array_vars) - {'celsius'})
+        # Don't change the storage of global variables which are used externally.
+        hoist_targets -= (external_refs - range_vars)
+        # Variables which NEURON or other mechanisms can change during a run are
+        # not invariant, even if the file declares them as PARAMETERs.
+        invariant_vars = ((parameter_vars | constant_vars) - range_vars - verbatim_vars -
+                neuron_vars - read_ion_vars - write_ion_vars - nonspecific_vars -
+                electrode_cur_vars - state_vars - pointer_vars)
+        invariant_vars |= {'celsius'} - state_vars
+        invariant_vars |= {name for name, value in nmodl_to_python.nmodl_builtins.items() if not callable(value)}
+        hoisted_vars = hoisting.hoist_invariant_assignments(AST, hoist_targets, invariant_vars)
+        for name, block_name in hoisted_vars.items():
+            print(f'hoist from {block_name} to INITIAL: {name}')
     # Code analysis: determine the read/write usage patterns for each variable.
+    timer.phase('rw patterns')
     rw = RW_Visitor()
     rw.visit_program(AST)
+    # Compute each repeated subexpression once and store it in a new local variable.
+    cse_locals = {} # Maps from block name to set of names of new local variables.
+    if cse:
+        timer.phase('cse')
+        reserved_names = {STR(x.get_node_name()) for x in lookup(ANT.NAME)}
+        for node in AST.blocks:
+            if not (node.is_breakpoint_block() or node.is_derivative_block() or
+                    node.is_procedure_block() or node.is_function_block()):
+                continue
+            # Don't hide the STATE variables from the ODE solvers.
+            exclude_vars = state_vars if node.is_derivative_block() else ()
+            block_name = get_block_name(node)
+            new_vars = common_subexpressions.eliminate_common_subexpressions(
+                    node.statement_block, reserved_names, exclude_vars)
+            for name, text in new_vars.items():
+                print(f'common subexpression in {block_name}: {name} = {text}')
+            cse_locals[block_name] = set(new_vars)
     # Split the document into its top-level blocks for easier manipulation.
-    blocks_list = [SimpleNamespace(node=x, text=nmodl.to_nmodl(x)) for x in AST.blocks]
+    timer.phase('analysis')
+    # Each block remembers the text which its node prints as, so that the node
+    # can be reused instead of parsing the text again if it's not rewritten.
+    blocks_list = [SimpleNamespace(node=x, text=(text := nmodl.to_nmodl(x)), node_text=text) for x in AST.blocks]
     blocks      = {get_block_name(x.node): x for x in blocks_list}
     # 
     if block := blocks.get('NET_RECEIVE', None):
@@ -220,8 +368,36 @@ def optimize_nmodl(input_file, output_file, external_refs, other_nmodl_refs, cel
                 else:
                     raise RuntimeError(type(node))
 
+    # Demote RANGE parameters to GLOBAL if the project always assigns the same
+    # value to every instance. Argument range_assignments maps from the hoc name
+    # of each variable to the pair of lists: [values assigned to every section,
+    # values assigned to the currently accessed section].
+    demoted_vars = set()
+    if range_assignments is not None and is_density:
+        demote_candidates = (range_vars & parameter_vars & external_refs) - rw.all_writes - (
+                neuron_vars | read_ion_vars | write_ion_vars | pointer_vars | verbatim_vars)
+        for name in sorted(demote_candidates):
+            if (uses := range_assignments.get(name + suffix)) is None:
+                continue
+            if name in other_nmodl_refs or (name + suffix) in other_nmodl_refs:
+                continue
+            forall_values, section_values = set(uses[0]), set(uses[1])
+            default_value = 0.0
+            for node in sym_table.lookup(name).get_nodes():
+                if node.is_param_assign() and node.value is not None:
+                    default_value = float(STR(node.value))
+            # Sections which are not explicitly assigned a value keep the default value.
+            if forall_values:
+                is_uniform = len(forall_values | section_values) == 1
+            else:
+                is_uniform = section_values <= {default_value}
+            if is_uniform:
+                demoted_vars.add(name)
+                print(f'demote RANGE to GLOBAL: {name}')
+
     # Inline celsius if it's given and if this nmodl file uses it.
-    if celsius is not None and 'celsius' in parameter_vars:
+    # Some mechanisms declare it as an ASSIGNED variable instead of a PARAMETER.
+    if celsius is not None and 'celsius' in (parameter_vars | assigned_vars):
         if 'celsius' in verbatim_vars:
             pass # Can not inline into VERBATIM blocks.
         else:
@@ -231,12 +407,17 @@ def optimize_nmodl(input_file, output_file, external_refs, other_nmodl_refs, cel
 
     # Inline Q10. Detect and inline assigned variables with known constant
     # values that are set in the initial block.
+    timer.phase('evaluate initial')
     assigned_const_value = {}
     if initial_block := blocks.get('INITIAL', None):
-        # Convert the INITIAL block into python.
-        x = nmodl_to_python.PyGenerator()
+        # Convert the INITIAL block into python, including any functions which
+        # it calls that were not inlined.
+        functions = {get_block_name(node): node for node in AST.blocks
+                     if node.is_function_block() or node.is_procedure_block()}
+        x = nmodl_to_python.PyGenerator(functions=functions)
         try:
             x.visit_initial_block(initial_block.node)
+            x.generate_functions()
             can_exec = True
         except nmodl_to_python.VerbatimError:
             can_exec = False
@@ -245,20 +426,45 @@ def optimize_nmodl(input_file, output_file, external_refs, other_nmodl_refs, cel
             print('warning: complex INITIAL block may prevent optimization:', error.args[0])
         # 
         global_scope  = dict(nmodl_to_python.nmodl_builtins)
+        global_scope.update(nmodl_to_python.python_helpers)
         initial_scope = {}
         # Represent unknown external input values as NaN's.
-        for name in external_vars | parameter_vars:
+        for name in external_vars | parameter_vars | {'celsius'}:
             global_scope[name] = math.nan
         # Only use the parameters which we've committed to hard-coding.
         for name, (value, units) in parameters.items():
             global_scope[name] = value
         # Zero initialize the ASSIGNED and STATE variables.
-        for name in assigned_vars | state_vars:
+        # The temperature is always set externally, even if it's declared as ASSIGNED.
+        for name in (assigned_vars | state_vars) - {'celsius'}:
             global_scope[name] = 0.0
+        # Represent the arrays as lists.
+        for symbol in sym_table.get_variables_with_properties(sym_type.assigned_definition | sym_type.state_var):
+            name = STR(symbol.get_name())
+            for decl in symbol.get_nodes():
+                if (length := getattr(decl, 'length', None)) and name in global_scope:
+                    global_scope[name] = [global_scope[name]] * int(STR(length))
         # 
+        # Run the INITIAL block on many random samples of the unknown values at
+        # once, and find the results which are the same in every sample. If
+        # numpy is not available then run it once with the unknowns as NaN.
+        if can_exec and initial_samples and nmodl_to_python.numpy is not None:
+            unknowns = set()
+            for name, value in global_scope.items():
+                if isinstance(value, list) and value:
+                    value = value[0]
+                if isinstance(value, float) and math.isnan(value):
+                    unknowns.add(name)
+            try:
+                initial_scope = nmodl_to_python.evaluate_samples(initial_block.node, global_scope,
+                        unknowns, initial_samples, initial_tolerance, functions)
+                can_exec = False
+            except Exception:
+                initial_scope = {}
         if can_exec:
             try:
-                exec(x.pycode, global_scope, initial_scope)
+                exec(x.pycode, global_scope)
+                initial_scope = {name: global_scope[name] for name in x.assigned_names if name in global_scope}
             except Exception as error:
                 pycode = prepend_line_numbers(x.pycode.rstrip())
                 print("warning: could not execute INITIAL block:\n" + pycode)
@@ -275,6 +481,7 @@ def optimize_nmodl(input_file, output_file, external_refs, other_nmodl_refs, cel
             if name in assigned_vars:
                 if name in external_vars: continue
                 if name in runtime_writes_to: continue
+                if name in array_vars: continue
                 # Filter out values that can not be computed ahead of time
                 # because they depends on unknown external values (like the
                 # voltage or the cell diameter).
@@ -285,10 +492,30 @@ def optimize_nmodl(input_file, output_file, external_refs, other_nmodl_refs, cel
                 print(f'hardcode ASSIGNED with constant value: {name} = {value} {units}')
 
     # Convert assigned variables into local variables as able.
+    timer.phase('analysis')
     assigned_to_local = set(assigned_vars) - set(external_vars) - set(assigned_const_value)
+    # Find the functions and procedures which will be removed because they're
+    # never called. Their code does not run, so it can not read any variables.
+    unused_blocks = set()
+    if remove_dead_code and not verbatim_vars:
+        while True:
+            block_words = {name: set(re.findall(identifier_regex, block.text))
+                           for name, block in blocks.items()
+                           if name not in unused_blocks and name != 'NET_RECEIVE INITIAL'}
+            for name, block in blocks.items():
+                if name in unused_blocks or not (block.node.is_function_block() or block.node.is_procedure_block()):
+                    continue
+                if name in external_refs or name + suffix in other_nmodl_refs:
+                    continue
+                if any(name in words for other, words in block_words.items() if other != name):
+                    continue
+                unused_blocks.add(name)
+                break # Rescan the remaining blocks.
+            else:
+                break
     # Search for variables whose persistent state is ignored/overwritten.
-    for block_name, read_variables in rw.reads.items():
-        assigned_to_local -= read_variables
+    dataflow_result = dataflow.find_local_variables(AST, assigned_to_local, unused_blocks)
+    assigned_to_local = dataflow_result.variables
     # 
     for name in assigned_to_local:
         print(f'convert from ASSIGNED to LOCAL: {name}')
@@ -310,6 +537,7 @@ def optimize_nmodl(input_file, output_file, external_refs, other_nmodl_refs, cel
 
 
     # Rewrite the NEURON block without the removed variables.
+    timer.phase('rewrite')
     if block := blocks.get('NEURON', None):
         new_block = "NEURON {\n"
         for stmt in block.node.statement_block.statements:
@@ -318,6 +546,8 @@ def optimize_nmodl(input_file, output_file, external_refs, other_nmodl_refs, cel
                 variables = [x for x in variables if x not in parameters]
                 variables = [x for x in variables if x not in assigned_to_local]
                 variables = [x for x in variables if x not in assigned_const_value]
+                if stmt.is_range():
+                    variables = [x for x in variables if x not in demoted_vars]
                 if not variables:
                     continue
                 if   stmt.is_global(): new_block += '    GLOBAL '
@@ -325,6 +555,8 @@ def optimize_nmodl(input_file, output_file, external_refs, other_nmodl_refs, cel
                 new_block += ', '.join(variables) + '\n'
             else:
                 new_block += '    ' + nmodl.to_nmodl(stmt) + '\n'
+        if demoted_vars:
+            new_block += '    GLOBAL ' + ', '.join(sorted(demoted_vars)) + '\n'
         new_block += "}\n"
         block.text = new_block
 
@@ -355,8 +587,10 @@ def optimize_nmodl(input_file, output_file, external_refs, other_nmodl_refs, cel
     # Insert new LOCAL statements to replace the removed assigned variables.
     new_locals = {} # Maps from block name to set of names of new local variables.
     new_locals['INITIAL'] = set(assigned_const_value.keys())
-    for block_name, write_variables in rw.maybes.items():
-        new_locals.setdefault(block_name, set()).update(assigned_to_local & write_variables)
+    for block_name, variables in dataflow_result.blocks.items():
+        new_locals.setdefault(block_name, set()).update(assigned_to_local & variables)
+    for block_name, local_names in cse_locals.items():
+        new_locals.setdefault(block_name, set()).update(local_names)
     # 
     for block_name, local_names in new_locals.items():
         local_names = sorted(local_names)
@@ -375,6 +609,23 @@ def optimize_nmodl(input_file, output_file, external_refs, other_nmodl_refs, cel
     # Substitute the parameters with their values.
     substitutions = dict(parameters)
     substitutions.update(assigned_const_value)
+    # Format the values for printing.
+    substitution_text = {}
+    for name, (value, units) in substitutions.items():
+        # Some NMODL statements care about int vs float, so don't cast integers to float.
+        if float(value) == int(value):
+            value = int(value)
+        substitution_text[name] = str(value) + units
+    # The assignments to these variables are still present in the INITIAL
+    # block, they're just converted to local variables. The compiler should
+    # be able to eliminate the dead/unused code.
+    initial_substitution_text = {name: text for name, text in substitution_text.items()
+                                 if name not in assigned_const_value}
+    # Substitute all of the symbols in a single pass over the text.
+    def substitute(text, substitution_text):
+        if not substitution_text:
+            return text
+        return re.sub(identifier_regex, lambda m: substitution_text.get(m.group(), m.group()), text)
 
     # Delete any references to the substituted symbols out of TABLE statements.
     # First setup a regex to find the TABLE statements.
@@ -406,17 +657,7 @@ def optimize_nmodl(input_file, output_file, external_refs, other_nmodl_refs, cel
                 return f'TABLE {table_vars} FROM' + match['tail']
     # Search for the blocks which contain code.
     for block in blocks.values():
-        if block.node.is_model(): continue
-        if block.node.is_block_comment(): continue
-        if block.node.is_neuron_block(): continue
-        if block.node.is_unit_block(): continue
-        if block.node.is_unit_state(): continue
-        if block.node.is_param_block(): continue
-        if block.node.is_constant_block(): continue
-        if block.node.is_state_block(): continue
-        if block.node.is_assigned_block(): continue
-        if block.node.is_local_list_statement(): continue
-        if block.node.is_define(): continue
+        if not is_code_block(block.node): continue
         # 
         block.text = re.sub(table_regex, rewrite_table_stmt, block.text)
         # Don't substitute function/procedure arguments.
@@ -424,19 +665,11 @@ def optimize_nmodl(input_file, output_file, external_refs, other_nmodl_refs, cel
         if not brace:
             body = declaration
             declaration = ''
-        # 
-        for name, (value, units) in substitutions.items():
-            # The assignment to this variable is still present, it's just
-            # converted to a local variable. The compiler should be able to
-            # eliminate the dead/unused code.
-            if block.node.is_initial_block() and name in assigned_const_value:
-                continue
-            # Some NMODL statements care about int vs float, so don't cast integers to float.
-            if float(value) == int(value):
-                value = int(value)
-            # Substitute the symbol out of general code.
-            value = str(value) + units
-            body  = re.sub(rf'\b{name}\b', value, body)
+        # Substitute the symbols out of general code.
+        if block.node.is_initial_block():
+            body = substitute(body, initial_substitution_text)
+        else:
+            body = substitute(body, substitution_text)
         block.text = declaration + brace + body
 
     # Special case for initial block inside of net receive.
@@ -455,6 +688,92 @@ def optimize_nmodl(input_file, output_file, external_refs, other_nmodl_refs, cel
         assert (depth == 0) and (match.group() == '}')
         block.text = before + initial_block.text + after[match.end():]
 
+    driver = nmodl.NmodlDriver()
+    def parse_block(block):
+        """ Returns a program with a copy of the block, which is only parsed if its text was rewritten. """
+        if block.text == block.node_text:
+            return nmodl.ast.Program([block.node.clone()])
+        return driver.parse_string(block.text)
+
+    def update_block(block, block_ast):
+        block.node = block_ast.blocks[0]
+        block.text = block.node_text = nmodl.to_nmodl(block_ast).strip()
+
+    # Evaluate any constant expressions that were created by hardcoding values,
+    # and then remove the code which they made unreachable or unused.
+    if fold_constants or remove_dead_code:
+        timer.phase('fold constants')
+        num_folded = 0
+        num_removed = 0
+        for block in blocks_list:
+            if not is_code_block(block.node): continue
+            try:
+                block_ast = parse_block(block)
+            except RuntimeError:
+                continue
+            num_block_folded = constant_folding.fold_constants(block_ast) if fold_constants else 0
+            num_block_removed = dead_code.eliminate_dead_code(block_ast) if remove_dead_code else 0
+            if num_block_folded or num_block_removed:
+                num_folded += num_block_folded
+                num_removed += num_block_removed
+                update_block(block, block_ast)
+        if num_folded:
+            print(f'fold constant expressions: {num_folded}')
+        if num_removed:
+            print(f'remove dead code: {num_removed}')
+
+    # Remove the functions and procedures which are no longer used. They can
+    # be called from other blocks of code, from other files, or from VERBATIM.
+    if remove_dead_code and not verbatim_vars:
+        timer.phase('remove unused')
+        while True:
+            block_words = [set(re.findall(identifier_regex, block.text)) for block in blocks_list]
+            for idx, block in enumerate(blocks_list):
+                if not (block.node.is_function_block() or block.node.is_procedure_block()):
+                    continue
+                name = get_block_name(block.node)
+                if name in external_refs or name + suffix in other_nmodl_refs:
+                    continue
+                if any(name in words for words in block_words[:idx] + block_words[idx+1:]):
+                    continue
+                kind = 'FUNCTION' if block.node.is_function_block() else 'PROCEDURE'
+                print(f'remove unused {kind}: {name}')
+                del blocks_list[idx]
+                break # Rescan the remaining blocks.
+            else:
+                break
+
+    # Tabulate the rate equations which only depend on the membrane voltage.
+    if tabulate:
+        timer.phase('tabulate')
+        reserved_names = set()
+        for block in blocks_list:
+            reserved_names.update(re.findall(identifier_regex, block.text))
+        tabulator = rate_tables.RateTabulator(reserved_names, table_range, table_size)
+        for block in blocks_list:
+            if not (block.node.is_breakpoint_block() or block.node.is_derivative_block() or
+                    block.node.is_kinetic_block() or block.node.is_procedure_block() or
+                    block.node.is_function_block()):
+                continue
+            try:
+                block_ast = parse_block(block)
+            except RuntimeError:
+                continue
+            if tabulator.tabulate(block_ast):
+                update_block(block, block_ast)
+        for text, reason in tabulator.rejected.items():
+            print(f'warning: can not tabulate {text}: {reason}')
+        for table in tabulator.tables.values():
+            print(f'tabulate {table.name}(v) = {table.expression}, max error: {table.max_error:.3g}',
+                  f'({table.max_error / table.max_value:.3g} relative)' if table.max_value else '')
+            text = table.to_nmodl()
+            blocks_list.append(SimpleNamespace(node=driver.parse_string(text).blocks[0], text=text, node_text=None))
+        if tabulator.tables:
+            # NEURON clamps the voltage to the range of the table, which changes
+            # the results wherever the original expressions kept on changing.
+            print(f'warning: tabulated rates are constant outside of v = {table_range[0]:g} to {table_range[1]:g} mV')
+
+    timer.phase('write')
     # Find any local statements in the top level scope and move them to the top
     # of the file. Local variables must be declared before they're used, and
     # inlining functions can cause them to be used before they were originally declared.
@@ -468,6 +787,17 @@ def optimize_nmodl(input_file, output_file, external_refs, other_nmodl_refs, cel
     # Break up very long lines into multiple lines as able.
     nmodl_text = re.sub(r'.{500}\b', lambda m: m.group() + '\n', nmodl_text)
 
+    footprint = (footprint, memory_footprint.measure_nmodl(nmodl_text))
+
+    # Leave the output file untouched if it's not changing, so that its
+    # modification time does not trigger a needless recompile.
+    try:
+        if output_file.read_text() == nmodl_text:
+            timer.stop()
+            return footprint
+    except (OSError, UnicodeDecodeError):
+        pass
     with output_file.open('w') as f:
         f.write(nmodl_text)
-
+    timer.stop()
+    return footprint
@@ -0,0 +1,128 @@
+"""
+Measure where the preprocessor spends its time and memory.
+
+Each file is processed in a sequence of phases, for example "parse" and then
+"inline". A PhaseTimer records the duration of each phase and the peak memory
+usage of the process at the end of it. Profiling is disabled by default, and
+then the PhaseTimers do nothing.
+
+Worker processes record their own phases, and the main process collects them.
+"""
+from pathlib import Path
+import cProfile
+import json
+import os
+import sys
+import time
+
+try:
+    import resource
+except ImportError:
+    resource = None # Not available on Windows.
+
+enabled      = False
+cprofile_dir = None # Directory to save cProfile statistics into, or None.
+events       = [] # The phases which were recorded by this process.
+
+def enable(cprofile_directory=None):
+    """ Start recording. This is also the initializer for worker processes. """
+    global enabled, cprofile_dir
+    enabled = True
+    cprofile_dir = cprofile_directory
+    if cprofile_dir is not None:
+        Path(cprofile_dir).mkdir(parents=True, exist_ok=True)
+
+def disable():
+    """ Stop recording and discard any events which were not collected. """
+    global enabled, cprofile_dir
+    enabled = False
+    cprofile_dir = None
+    events.clear()
+
+def max_rss() -> int:
+    """ Returns the peak resident set size of this process in bytes, or None if unknown. """
+    if resource is None:
+        return None
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Linux reports the peak RSS in kilobytes, macOS reports it in bytes.
+    return rss if sys.platform == 'darwin' else rss * 1024
+
+class PhaseTimer:
+    """ Records a sequence of phases for one file. Starting a phase ends the previous phase. """
+    def __init__(self, file_name):
+        self.file_name  = str(file_name)
+        self.phase_name = None
+        self.start_time = None
+        self.start_perf = None
+
+    def phase(self, name):
+        if not enabled:
+            return
+        self.stop()
+        self.phase_name = name
+        self.start_time = time.time()
+        self.start_perf = time.perf_counter()
+
+    def stop(self):
+        if not enabled or self.phase_name is None:
+            return
+        events.append({
+            'file':     self.file_name,
+            'phase':    self.phase_name,
+            'start':    self.start_time,
+            'duration': time.perf_counter() - self.start_perf,
+            'max_rss':  max_rss(),
+            'pid':      os.getpid(),
+        })
+        self.phase_name = None
+
+def collect() -> list:
+    """ Remove and return all of the events which this process has recorded. """
+    collected = list(events)
+    events.clear()
+    return collected
+
+def call(file_name, function, *args, **kwargs):
+    """ Call the function, and run the cProfile profiler on it if requested. """
+    if not enabled or cprofile_dir is None:
+        return function(*args, **kwargs)
+    profiler = cProfile.Profile()
+    try:
+        return profiler.runcall(function, *args, **kwargs)
+    finally:
+        profiler.dump_stats(Path(cprofile_dir).joinpath(Path(file_name).name + '.prof'))
+
+def save(path, all_events, format='json'):
+    """
+    Write the events to a file.
+
+    The "json" format lists every phase and also the total time spent in each
+    phase and on each file, sorted from the slowest to the fastest.
+    The "chrome" format can be viewed with "chrome://tracing" or "ui.perfetto.dev".
+    """
+    start = min((x['start'] for x in all_events), default=0.0)
+    if format == 'chrome':
+        data = {'traceEvents': [{
+                'name': x['phase'],
+                'cat':  x['file'],
+                'ph':   'X',
+                'ts':   1e6 * (x['start'] - start),
+                'dur':  1e6 * x['duration'],
+                'pid':  x['pid'],
+                'tid':  0,
+                'args': {'file': x['file'], 'max_rss': x['max_rss']},
+            } for x in all_events]}
+    else:
+        phase_totals = {}
+        file_totals  = {}
+        for x in all_events:
+            phase_totals[x['phase']] = phase_totals.get(x['phase'], 0.0) + x['duration']
+            file_totals[x['file']]   = file_totals.get(x['file'], 0.0) + x['duration']
+        by_time = lambda totals: dict(sorted(totals.items(), key=lambda item: -item[1]))
+        data = {
+            'phases':       [dict(x, start=x['start'] - start) for x in all_events],
+            'phase_totals': by_time(phase_totals),
+            'file_totals':  by_time(file_totals),
+        }
+    with open(path, 'wt') as f:
+        json.dump(data, f, indent=4)
@@ -0,0 +1,462 @@
+"""
+Optimize all of the mechanisms in a project.
+
+This is the importable interface to the program. The command line interface is
+a thin wrapper around the function optimize_project(), which can also be called
+many times from one long-running python process.
+"""
+from concurrent.futures import ProcessPoolExecutor
+from types import SimpleNamespace
+from pathlib import Path
+import json
+import os
+import shutil
+import subprocess
+import time
+
+from nmodl_preprocessor import optimize_nmodl
+from nmodl_preprocessor import nmodl_to_python
+from nmodl_preprocessor import profiling
+from nmodl_preprocessor.compile_cache import CompileCache
+from nmodl_preprocessor.memory_footprint import save_report
+from nmodl_preprocessor.manifest import Manifest, CompileRecord, copy_if_changed, read_inputs, hash_inputs
+from nmodl_preprocessor.project_files import scan_project, include_suffixes
+from nmodl_preprocessor.reference_index import ReferenceIndex, SymbolCounts
+
+def optimize_project(project_dir, model_dirs=(), *, compile=False, jobs=1, compile_jobs=None,
+                     cse=False, hoist=False, demote_range=False, conserve=False,
+                     tables=False, table_range=(-100.0, 100.0), table_size=200,
+                     initial_samples=64, initial_tolerance=1e-12, per_temperature=False, cache=None, cache_size=1000,
+                     profile=None, profile_format='json', cprofile=None, log=None,
+                     reference_index=None):
+    """
+    Optimize the mechanisms in the project and save them into the directory
+    "project_dir/.preprocessed". Nothing is printed, instead each message is
+    passed to the optional callback log(text).
+
+    Argument model_dirs is a list of the directories of nmodl files. By default
+             the mechanisms are found by searching the project_dir.
+    Argument compile runs nrnivmodl on the optimized mechanisms.
+    Argument cache is the directory of the shared compiled-object cache, and
+             cache_size is its maximum size in megabytes.
+    Argument reference_index is an existing ReferenceIndex to reuse instead of
+             loading it from the output directory, see watch_project().
+    The remaining arguments correspond to the command line options.
+
+    Returns a namespace with the attributes:
+        project_dir, model_dirs, output_dir
+        nmodl_files, include_files, code_files, misc_files
+        celsius             - the detected temperature, or None
+        temperatures        - every temperature which the project assigns
+        builds              - list of the builds, the first build is the main one,
+                              followed by one build for each temperature if
+                              per_temperature is enabled. Each build has the
+                              attributes output_dir, celsius, mechanisms, and memory_report.
+        mechanisms          - the mechanisms of the main build, mapping from file
+                              name to a namespace with the attributes input_file,
+                              output_file, up_to_date, decisions, log, and footprint.
+        messages            - list of every message
+    """
+    if compile_jobs is None:
+        compile_jobs = os.cpu_count() or 1
+    project_dir = Path(project_dir).resolve()
+    assert project_dir.exists(), f'directory not found: "{project_dir}"'
+    assert project_dir.is_dir(), "project_dir is not a directory"
+    assert jobs >= 1, "jobs must be a positive number"
+    assert compile_jobs >= 1, "compile jobs must be a positive number"
+    assert cache_size > 0, "cache size must be a positive number"
+    assert table_range[0] < table_range[1], "invalid table range"
+    assert table_size >= 1, "table size must be a positive number"
+    assert initial_samples >= 0, "initial samples must not be negative"
+    assert initial_tolerance >= 0, "initial tolerance must not be negative"
+
+    messages = []
+    def print(*strings):
+        text = ' '.join(str(x) for x in strings)
+        messages.append(text)
+        if log is not None:
+            log(text)
+
+    # Optional optimizations which are passed through to optimize_nmodl().
+    options = {'cse': cse, 'hoist': hoist, 'conserve': conserve,
+               'initial_samples': initial_samples, 'initial_tolerance': initial_tolerance}
+    if tables:
+        options.update(tabulate=True, table_range=tuple(table_range), table_size=table_size)
+    if initial_samples and nmodl_to_python.numpy is None:
+        print('warning: numpy is not installed, so the INITIAL block is run once instead of on random samples')
+
+    # Measure where the time goes, if requested.
+    was_profiling = profiling.enabled
+    if profile or cprofile:
+        profiling.enable(cprofile)
+    profile_events = [] # The phases which were recorded by the worker processes.
+    timer = profiling.PhaseTimer(project_dir)
+
+    # Walk the project directory once, skipping over hidden and build directories.
+    timer.phase('scan')
+    project_files = scan_project(project_dir)
+
+    # Find all of the mechanism files.
+    # Check the arguments.
+    model_dirs = [x for x in model_dirs if str(x).strip()]
+    if model_dirs:
+        model_dir = [Path(x).resolve() for x in model_dirs]
+        nmodl_files = []
+        for path in model_dir:
+            assert path.exists(), f'directory not found: "{path}"'
+            nmodl_files.extend(path.glob('*.mod'))
+        nmodl_files.sort()
+    # Use the project_dir by default.
+    elif nmodl_files := [x for x in project_files.nmodl if x.parent == project_dir]:
+        model_dir = [project_dir]
+    # Recursively search for the model directory.
+    elif nmodl_files := project_files.nmodl:
+        model_dir = sorted(set(path.parent for path in nmodl_files))
+        assert len(model_dir) == 1, "Multiple nmodl directories found"
+    # Quietly do nothing.
+    else:
+        model_dir = []
+        nmodl_files = []
+
+    # Setup the output directory.
+    output_dir = project_dir.joinpath('.preprocessed')
+    if not output_dir.exists():
+        output_dir.mkdir()
+    else:
+        assert output_dir.is_dir(), "output_dir is not a directory"
+        assert output_dir not in model_dir, "operation would overwrite its inputs"
+
+    # Copy any C/C++ files that might have been included into the mechanisms.
+    include_files = []
+    for path in model_dir:
+        include_files.extend(x for x in path.iterdir() if x.suffix in include_suffixes and x.is_file())
+    include_files.sort()
+
+    #
+    code_files = list(project_files.code)
+
+    # Any other C/C++ files in the project are treated as miscellaneous files.
+    misc_files  = set(project_files.misc)
+    misc_files |= set(project_files.include) - set(include_files)
+    misc_files  = sorted(misc_files)
+
+    # Search the projects source code.
+    # Only rescan the files which have changed since the last run.
+    timer.phase('references')
+    if reference_index is None:
+        reference_index = ReferenceIndex(output_dir.joinpath('references.json'))
+    references = {} # The set of words used in each projects file.
+    file_assignments = {} # The uses of the mechanism variables in each code file.
+    nmodl_text = {} # The contents of each mechanism file, read only once.
+    temperatures = set() # Find all assignments to celsius.
+    for path in nmodl_files:
+        with open(path, 'rb') as f:
+            nmodl_text[path] = f.read()
+    for path in (nmodl_files + code_files + include_files + misc_files):
+        try:
+            entry = reference_index.scan(path, nmodl_text.get(path))
+        except OSError:
+            if path.suffix == '.mod':
+                raise
+            else:
+                if path in include_files: include_files.remove(path)
+                if path in code_files:    code_files.remove(path)
+                if path in misc_files:    misc_files.remove(path)
+                continue
+        # Ignore binary files (anything that's not valid utf-8).
+        if path in misc_files and not entry.is_text:
+            misc_files.remove(path)
+            continue
+        references[path] = entry.words
+        file_assignments[path] = entry.assignments
+        temperatures.update(entry.temperatures)
+    reference_index.retain(references)
+    reference_index.save()
+    timer.stop()
+    all_temperatures = sorted(temperatures)
+
+    print(f"Project Directory: {project_dir}")
+    for x in model_dir:
+        print(f"Model Directory: {x}")
+    print(f"Output Directory: {output_dir}")
+
+    for path in nmodl_files:
+        print(f'Mechanism: {path}')
+
+    for path in include_files:
+        print(f'Include: {path}')
+
+    for path in code_files:
+        print(f'Source Code: {path}')
+
+    for path in misc_files:
+        print(f'Misc File: {path}')
+
+    #
+    external_symbols = SymbolCounts((path, references[path]) for path in (code_files + include_files + misc_files))
+    nmodl_symbols = SymbolCounts((path, references[path]) for path in (nmodl_files + include_files) if path.suffix in {'.mod', '.inc'})
+
+    if not external_symbols.is_referenced("celsius"):
+        celsius = 6.3
+        print(f'Default temperature: celsius = {celsius}')
+    elif len(temperatures) == 1:
+        celsius = temperatures.pop()
+        print(f'Detected temperature: celsius = {celsius}')
+    elif len(temperatures) > 1:
+        celsius = None
+        print(f'Detected multiple temperatures:', ', '.join(str(x) for x in temperatures))
+    else:
+        celsius = None
+        print(f'Detected temperature but could not read it')
+
+    # Find the mechanism variables which the source code only ever assigns numbers to.
+    if demote_range:
+        range_assignments = {} # Maps from variable name to [forall_values, section_values].
+        other_uses = set()
+        for path in code_files:
+            for name, (forall_values, section_values, num_other) in file_assignments[path].items():
+                if num_other:
+                    other_uses.add(name)
+                    continue
+                uses = range_assignments.setdefault(name, [set(), set()])
+                uses[0].update(forall_values)
+                uses[1].update(section_values)
+        # Any mention in a C/C++ or miscellaneous file could be a use.
+        for path in include_files + misc_files:
+            other_uses.update(references[path])
+        range_assignments = {name: [sorted(x) for x in uses] for name, uses in range_assignments.items()
+                             if name not in other_uses}
+    else:
+        range_assignments = None
+
+    # Find the temperatures to make separate builds for.
+    temperature_builds = {} # Maps from temperature to output directory.
+    if per_temperature and celsius is None and len(temperatures) > 1:
+        for value in sorted(temperatures):
+            temperature_builds[value] = output_dir.joinpath(f'celsius_{value:g}')
+    # Delete any builds which are left over from temperatures that are no longer used.
+    for x in output_dir.glob('celsius_*'):
+        if x.is_dir() and x not in temperature_builds.values():
+            shutil.rmtree(x)
+
+    def print_log(text):
+        """ Print the captured output of optimize_nmodl(). """
+        for line in text.splitlines():
+            print(line)
+
+    def preprocess(output_dir, celsius):
+        """ Optimize all of the mechanisms for the given temperature and save them into output_dir. """
+        if not output_dir.exists():
+            output_dir.mkdir()
+        # Delete any mod files which are left over from mechanisms that no longer exist.
+        for x in output_dir.glob('*.mod'):
+            if x.name not in {path.name for path in nmodl_files}:
+                x.unlink()
+        manifest = Manifest(output_dir)
+        # Copy any C/C++ files that might have been included.
+        for path in include_files:
+            copy_if_changed(path, output_dir.joinpath(path.name))
+        # Process the NMODL files.
+        optimize_args = []
+        input_keys = {} # Maps from output file to the hash of its inputs.
+        mechanisms = {} # Maps from file name to the results of optimizing it.
+        for path in nmodl_files:
+            output_file = output_dir.joinpath(path.name)
+            mechanisms[path.name] = SimpleNamespace(input_file=path, output_file=output_file,
+                    up_to_date=False, decisions=[], log='', footprint=(None, None))
+            if path.name in {'vecst.mod', 'stats.mod'}:
+                copy_if_changed(path, output_file)
+                continue
+            #
+            # Only the symbols which could refer to this mechanism can affect it.
+            inputs = read_inputs(path, nmodl_text[path])
+            external_refs    = external_symbols.relevant(inputs.words)
+            other_nmodl_refs = nmodl_symbols.relevant(inputs.words, exclude=path)
+            # Skip the mechanisms whose inputs have not changed since the last run.
+            key = hash_inputs(inputs, external_refs, other_nmodl_refs, celsius, range_assignments, **options)
+            if manifest.is_current(output_file, key):
+                print(f'{path.name}: up to date')
+                mechanisms[path.name].up_to_date = True
+                mechanisms[path.name].footprint = manifest.footprint(output_file) or (None, None)
+                continue
+            optimize_args.append((path, output_file, external_refs, other_nmodl_refs, celsius, nmodl_text[path]))
+            input_keys[output_file] = key
+        #
+        def finish(x, result):
+            """ Record the result of optimizing one file, in order. """
+            text, footprint, error, events = result
+            profile_events.extend(events)
+            print_log(text)
+            if error is not None:
+                manifest.save()
+                raise error
+            mechanism = mechanisms[x[0].name]
+            mechanism.log = text
+            prefix = x[0].name + ': '
+            mechanism.decisions = [line[len(prefix):] for line in text.splitlines() if line.startswith(prefix)]
+            mechanism.footprint = footprint or (None, None)
+            manifest.update(x[1], input_keys[x[1]], footprint)
+        if jobs == 1:
+            for x in optimize_args:
+                finish(x, optimize_nmodl.optimize_nmodl_captured(*x, range_assignments=range_assignments, **options))
+        else:
+            # Each worker captures its own output and the main process prints it
+            # in order, so that the messages for each file stay together.
+            initializer = (profiling.enable, (cprofile,)) if profiling.enabled else (None, ())
+            with ProcessPoolExecutor(max_workers=jobs, initializer=initializer[0], initargs=initializer[1]) as pool:
+                futures = [pool.submit(optimize_nmodl.optimize_nmodl_captured, *x,
+                                       range_assignments=range_assignments, **options)
+                        for x in optimize_args]
+                for x, future in zip(optimize_args, futures):
+                    finish(x, future.result())
+        manifest.retain(output_dir.joinpath(path.name) for path in nmodl_files)
+        manifest.save()
+        # Report how much memory each instance of the mechanisms uses.
+        report = save_report(output_dir, {name: x.footprint for name, x in mechanisms.items()
+                                          if name not in {'vecst.mod', 'stats.mod'}})
+        total = report['total_bytes_per_instance']
+        print(f"Memory per instance of all mechanisms: {total['before']} bytes before, {total['after']} bytes after")
+        return SimpleNamespace(output_dir=output_dir, celsius=celsius, mechanisms=mechanisms, memory_report=report)
+
+    def compile_mechanisms(output_dir, cwd):
+        """
+        Compile the NMODL files into the special linked library using nrnivmodl.
+        Make only recompiles the mechanisms whose files changed, because unchanged
+        files keep their modification times. If nothing changed then skip nrnivmodl.
+        """
+        record = CompileRecord(output_dir, cwd)
+        if record.is_current():
+            print(f'nrnivmodl: up to date: {record.build_dir}')
+            return
+        record.discard()
+        timer = profiling.PhaseTimer(output_dir)
+        # Reuse the files which were compiled for identical mechanisms.
+        if cache:
+            timer.phase('compile cache')
+            compile_cache = CompileCache(cache, cache_size * 1e6)
+            cache_keys = {} # Maps from mod file to its cache key.
+            for path in record.mod_files:
+                cache_keys[path] = key = compile_cache.key(path, record.include_files)
+                # Don't replace existing files which are already up to date.
+                obj_file = record.build_dir.joinpath(path.stem + '.o')
+                if obj_file.exists() and obj_file.stat().st_mtime >= path.stat().st_mtime:
+                    continue
+                compile_cache.restore(path, record.build_dir, key)
+            print(f'compile cache: {compile_cache.num_hits} hits, {compile_cache.num_misses} misses')
+        timer.phase('nrnivmodl')
+        env = dict(os.environ)
+        env["MAKEFLAGS"] = f" -j{compile_jobs} --max-load 0.0"
+        command = ["nrnivmodl"] + [str(x) for x in record.mod_files]
+        with subprocess.Popen(command, cwd=cwd, env=env, stdin=subprocess.DEVNULL,
+                stdout=subprocess.PIPE, stderr=subprocess.STDOUT, text=True, errors='replace') as process:
+            for line in process.stdout:
+                print(line.rstrip('\n'))
+        if process.returncode != 0:
+            raise subprocess.CalledProcessError(process.returncode, command)
+        if cache:
+            timer.phase('compile cache')
+            for path, key in cache_keys.items():
+                compile_cache.store(path, record.build_dir, key)
+            compile_cache.evict()
+        timer.stop()
+        record.save()
+
+    try:
+        builds = [preprocess(output_dir, celsius)]
+        for value, build_dir in temperature_builds.items():
+            print(f'Temperature Build: celsius = {value}: {build_dir}')
+            builds.append(preprocess(build_dir, value))
+
+        # Save the mapping from each temperature to its build directory.
+        temperatures_file = output_dir.joinpath('temperatures.json')
+        if temperature_builds:
+            with open(temperatures_file, 'wt') as f:
+                json.dump({str(value): str(path) for value, path in temperature_builds.items()}, f, indent=4)
+        elif temperatures_file.exists():
+            temperatures_file.unlink()
+
+        if compile:
+            compile_mechanisms(output_dir, project_dir)
+            for build_dir in temperature_builds.values():
+                compile_mechanisms(build_dir, build_dir)
+
+        if profile:
+            profiling.save(profile, profiling.collect() + profile_events, profile_format)
+    finally:
+        if not was_profiling:
+            profiling.disable()
+
+    return SimpleNamespace(
+            project_dir     = project_dir,
+            model_dirs      = model_dir,
+            output_dir      = output_dir,
+            nmodl_files     = nmodl_files,
+            include_files   = include_files,
+            code_files      = code_files,
+            misc_files      = misc_files,
+            celsius         = celsius,
+            temperatures    = all_temperatures,
+            builds          = builds,
+            mechanisms      = builds[0].mechanisms,
+            messages        = messages)
+
+def snapshot(project_dir, model_dirs=()) -> dict:
+    """ Returns the modification time and size of every file in the project. """
+    project_files = scan_project(project_dir)
+    paths = project_files.nmodl + project_files.include + project_files.code + project_files.misc
+    for directory in model_dirs:
+        if str(directory).strip() and Path(directory).is_dir():
+            paths.extend(x for x in Path(directory).iterdir() if x.is_file())
+    files = {}
+    for path in paths:
+        try:
+            stat = path.stat()
+        except OSError:
+            continue
+        files[path] = (stat.st_mtime_ns, stat.st_size)
+    return files
+
+def watch_project(project_dir, model_dirs=(), *, interval=1.0, log=None, **kwargs):
+    """
+    Optimize the project, and then poll it for changes and re-optimize it after
+    every change, until interrupted. The keyword arguments are passed through to
+    optimize_project().
+
+    The reference index is kept in memory, so only the changed files are rescanned.
+    Only the mechanisms which are affected by the changes are re-optimized and
+    recompiled: the manifest hashes each mechanism's own text, its INCLUDE files,
+    and the symbols in the project's other files which refer to it.
+    """
+    project_dir = Path(project_dir).resolve()
+    def print(*strings):
+        if log is not None:
+            log(' '.join(str(x) for x in strings))
+    output_dir = project_dir.joinpath('.preprocessed')
+    output_dir.mkdir(exist_ok=True)
+    reference_index = ReferenceIndex(output_dir.joinpath('references.json'))
+    files = None
+    try:
+        while True:
+            new_files = snapshot(project_dir, model_dirs)
+            if files is not None:
+                changed = sorted(path for path in new_files.keys() | files.keys()
+                                 if new_files.get(path) != files.get(path))
+                if not changed:
+                    time.sleep(interval)
+                    continue
+                for path in changed:
+                    print(f'Changed: {path}')
+            files = new_files
+            start_time = time.perf_counter()
+            try:
+                result = optimize_project(project_dir, model_dirs, log=log,
+                                          reference_index=reference_index, **kwargs)
+            except Exception as error:
+                print(f'error: {type(error).__name__}: {error}')
+            else:
+                optimized = [name for name, x in result.mechanisms.items() if not x.up_to_date]
+                print(f'Optimized {len(optimized)} of {len(result.mechanisms)} mechanisms',
+                      f'in {time.perf_counter() - start_time:.2f} seconds')
+            print('Watching for changes, press Ctrl-C to stop.')
+    except KeyboardInterrupt:
+        pass
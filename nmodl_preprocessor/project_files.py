@@ -0,0 +1,62 @@
+from types import SimpleNamespace
+from pathlib import Path
+import os
+import platform
+
+nmodl_suffixes   = {'.mod'}
+include_suffixes = {'.c', '.h', '.cpp', '.hpp', '.inc'}
+code_suffixes    = {'.hoc', '.oc', '.ses', '.py'}
+ignore_misc      = {'.o', '.pyc', '.png', '.jpg', '.html', '.md', '.pdf'}
+
+def is_excluded_dir(name):
+    """ Hidden directories, python caches, and nrnivmodl's build directory. """
+    return name.startswith('.') or name.startswith('__') or name == platform.machine()
+
+def scan_project(project_dir):
+    """
+    Walk the project directory once and sort its files into buckets by type.
+
+    Returns a namespace with sorted lists of paths:
+        nmodl   - ".mod" files
+        include - C/C++ source code and ".inc" files
+        code    - hoc, session, and python files
+        misc    - any other files which might reference a mechanism
+    """
+    files = SimpleNamespace(nmodl=[], include=[], code=[], misc=[])
+    visited = set() # Guard against symbolic links looping back on themselves.
+    stack = [Path(project_dir)]
+    while stack:
+        directory = stack.pop()
+        try:
+            real_path = directory.resolve()
+            if real_path in visited:
+                continue
+            visited.add(real_path)
+            entries = list(os.scandir(directory))
+        except OSError:
+            continue
+        for entry in entries:
+            try:
+                if entry.is_dir():
+                    if not is_excluded_dir(entry.name):
+                        stack.append(Path(entry.path))
+                    continue
+                elif not entry.is_file():
+                    continue
+            except OSError:
+                continue
+            path   = Path(entry.path)
+            suffix = path.suffix
+            if suffix in nmodl_suffixes:
+                files.nmodl.append(path)
+            elif suffix in include_suffixes:
+                files.include.append(path)
+            elif suffix in code_suffixes:
+                files.code.append(path)
+            elif suffix in ignore_misc:
+                pass
+            elif not entry.name.startswith('.') and not entry.name.startswith('__'):
+                files.misc.append(path)
+    for bucket in vars(files).values():
+        bucket.sort()
+    return files
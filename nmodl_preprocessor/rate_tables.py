@@ -0,0 +1,171 @@
+"""
+Tabulate the rate equations which only depend on the membrane voltage.
+
+After the parameters and temperature are hardcoded, many of the gating rate
+equations are functions of nothing but the membrane voltage, for example
+"0.125*exp(-(v+65)/80)". This module moves each of these expressions into a new
+FUNCTION with a TABLE statement, so that NEURON can precompute it over a range of
+voltages and then use linear interpolation instead of re-evaluating it.
+
+Outside of the table's range NEURON uses the value at the nearest end of the table.
+"""
+import math
+import nmodl
+import nmodl.ast
+import nmodl.dsl
+ANT = nmodl.ast.AstNodeType
+
+from nmodl_preprocessor.utils import *
+from nmodl_preprocessor.nmodl_to_python import PyGenerator, nmodl_builtins
+from nmodl_preprocessor.common_subexpressions import (
+        expensive_functions, is_pure, make_name, parse_expression, read_variables,
+        replace_expressions)
+
+# Number of points to check in between each pair of table entries.
+error_samples = 8
+
+class RateTable:
+    """ A tabulated function of the membrane voltage. """
+    def __init__(self, name, expression, table_range, table_size):
+        self.name           = name
+        self.expression     = expression    # NMODL text in terms of "v".
+        self.table_range    = table_range   # Pair of (min, max) voltages.
+        self.table_size     = table_size    # Number of intervals in the table.
+        self.max_error      = None          # Absolute error of the interpolation.
+        self.max_value      = None          # Largest absolute value in the table.
+
+    def to_nmodl(self):
+        v_min, v_max = self.table_range
+        return (f'FUNCTION {self.name}(v) {{\n'
+                f'    TABLE FROM {v_min:g} TO {v_max:g} WITH {self.table_size}\n'
+                f'    {self.name} = {self.expression}\n'
+                '}')
+
+    def measure_error(self):
+        """
+        Evaluate the expression at and in between every table entry, and
+        measure the maximum error of NEURON's linear interpolation.
+
+        Raises ValueError if the expression is not finite over the whole range.
+        """
+        program = nmodl.NmodlDriver().parse_string(f'PROCEDURE table() {{\nx = {self.expression}\n}}')
+        expression = program.blocks[0].statement_block.statements[0].expression.rhs
+        x = PyGenerator()
+        expression.accept(x)
+        function = eval('lambda v: ' + x.pycode, dict(nmodl_builtins))
+        def evaluate(v):
+            try:
+                value = float(function(v))
+            except (ArithmeticError, ValueError, TypeError, NameError):
+                value = math.nan
+            if not math.isfinite(value):
+                raise ValueError(f'not finite at v = {v:g}')
+            return value
+        v_min, v_max = self.table_range
+        dx = (v_max - v_min) / self.table_size
+        table = [evaluate(v_min + i * dx) for i in range(self.table_size + 1)]
+        self.max_value = max(abs(value) for value in table)
+        self.max_error = 0.0
+        for i in range(self.table_size):
+            for j in range(1, error_samples):
+                frac = j / error_samples
+                exact = evaluate(v_min + (i + frac) * dx)
+                interp = table[i] + frac * (table[i + 1] - table[i])
+                self.max_error = max(self.max_error, abs(interp - exact))
+
+class RateTabulator:
+    """
+    Replace the voltage-only expressions in blocks of code with calls to
+    tabulated functions. Identical expressions share the same table.
+    """
+    def __init__(self, reserved_names, table_range, table_size):
+        self.reserved_names = reserved_names # New names are added to this set.
+        self.table_range    = tuple(table_range)
+        self.table_size     = int(table_size)
+        self.tables         = {} # Maps from expression text to RateTable.
+        self.rejected       = {} # Maps from expression text to the reason why.
+        assert self.table_range[0] < self.table_range[1], "invalid table range"
+        assert self.table_size >= 1, "invalid table size"
+
+    def tabulate(self, program) -> int:
+        """
+        Tabulate the expressions in all of the blocks of the given program.
+        The AST is modified in place.
+
+        Returns the number of expressions which were replaced.
+        """
+        num_replaced = 0
+        for block in program.blocks:
+            if statement_block := getattr(block, 'statement_block', None):
+                num_replaced += self.tabulate_block(statement_block)
+        return num_replaced
+
+    def tabulate_block(self, statement_block) -> int:
+        lookup = lambda ast_node_type: nmodl.dsl.visitor.AstLookupVisitor().lookup(statement_block, ast_node_type)
+        # Don't modify any blocks with unknown side effects or existing tables.
+        if lookup(ANT.VERBATIM) or lookup(ANT.TABLE_STATEMENT):
+            return 0
+        local_vars = {STR(x.name.get_node_name()) for x in lookup(ANT.LOCAL_VAR)}
+        # Find all of the local variables which are simply copies of the voltage.
+        # This is how the inliner passes the voltage into the rate procedures.
+        num_writes = {}
+        copies_of_v = set()
+        for node in lookup(ANT.BINARY_EXPRESSION):
+            if node.op.eval() != '=' or not node.lhs.is_var_name():
+                continue
+            name = STR(node.lhs.name.get_node_name())
+            num_writes[name] = num_writes.get(name, 0) + 1
+            if node.rhs.is_var_name() and STR(node.rhs.name.get_node_name()) == 'v':
+                copies_of_v.add(name)
+        for node in lookup(ANT.FROM_STATEMENT):
+            name = STR(node.name.get_node_name())
+            num_writes[name] = num_writes.get(name, 0) + 1
+        if 'v' in num_writes or 'v' in local_vars:
+            return 0
+        voltage_vars = {'v'} | {name for name in copies_of_v
+                                if num_writes[name] == 1 and name in local_vars}
+        #
+        num_replaced = 0
+        def replace(expr):
+            nonlocal num_replaced
+            if not self.is_candidate(expr, voltage_vars):
+                return None
+            if (table := self.get_table(expr, voltage_vars)) is None:
+                return None
+            num_replaced += 1
+            return parse_expression(f'{table.name}(v)')
+        replace_expressions(statement_block, replace)
+        return num_replaced
+
+    def is_candidate(self, expr, voltage_vars):
+        if not is_pure(expr):
+            return False
+        variables = read_variables(expr)
+        if not variables or not variables <= voltage_vars:
+            return False
+        # Only tabulate expressions which are expensive to compute.
+        lookup = nmodl.dsl.visitor.AstLookupVisitor().lookup
+        return (any(STR(x.name.get_node_name()) in expensive_functions for x in lookup(expr, ANT.FUNCTION_CALL)) or
+                any(x.op.eval() == '^' for x in lookup(expr, ANT.BINARY_EXPRESSION)))
+
+    def get_table(self, expr, voltage_vars):
+        """ Returns the RateTable for the given expression, or None if it can not be tabulated. """
+        # Rewrite the expression in terms of "v".
+        expr = expr.clone()
+        for node in nmodl.dsl.visitor.AstLookupVisitor().lookup(expr, ANT.VAR_NAME):
+            if STR(node.name.get_node_name()) in voltage_vars:
+                node.name = nmodl.ast.Name(nmodl.ast.String('v'))
+        text = STR(nmodl.to_nmodl(expr))
+        if text in self.rejected:
+            return None
+        if table := self.tables.get(text):
+            return table
+        table = RateTable(None, text, self.table_range, self.table_size)
+        try:
+            table.measure_error()
+        except (ValueError, RuntimeError, SyntaxError) as error:
+            self.rejected[text] = str(error)
+            return None
+        table.name = make_name(self.reserved_names, 'rate_table_')
+        self.tables[text] = table
+        return table
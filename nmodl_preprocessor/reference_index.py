@@ -0,0 +1,230 @@
+"""
+Persistent index of the symbols used in each of the project's files.
+
+The index is saved to disk so that repeated runs only need to rescan the files
+which have changed since the last run. Files are identified by their path,
+modification time, and size.
+"""
+from pathlib import Path
+import json
+import os
+import re
+
+word_regex = re.compile(br'\b\w+\b')
+float_regex = br'[+-]?((\d+\.?\d*)|(\.\d+))\b([Ee][+-]?\d+)?\b'
+celsius_regex = re.compile(br'\bcelsius\s*=\s*' + float_regex)
+# Find the mechanism variables, which always have an underscore and a suffix,
+# and the blocks of code which apply to every section, and the conditions which
+# select only some of the sections.
+token_regex = re.compile(br'(?P<forall>\bforall\b)|(?P<condition>\b(if|ifsec|issection)\b)|'
+                         br'(?P<open>\{)|(?P<close>\})|(?P<newline>\n)|(?P<word>\b[A-Za-z]\w*_\w+\b)')
+brace_regex = re.compile(br'\s*\{')
+# Increment this whenever the way that files are scanned changes, to discard the
+# existing indexes.
+index_version = 2
+# Assignment of a number, for example the " = 0.12" in "gbar_hh = 0.12".
+assignment_regex = re.compile(br'[ \t]*=[ \t]*(?P<value>' + float_regex + br')[ \t]*(\r?\n|$|[;}\'"])')
+
+class FileEntry:
+    """ Summary of a single file. """
+    __slots__ = ('mtime', 'size', 'is_text', 'words', 'temperatures', 'assignments')
+
+    def __init__(self, mtime, size, is_text, words, temperatures, assignments):
+        self.mtime          = mtime
+        self.size           = size
+        self.is_text        = is_text       # Is the file valid utf-8?
+        self.words          = words         # Set of words used in the file.
+        self.temperatures   = temperatures  # List of values assigned to celsius.
+        self.assignments    = assignments   # Uses of the mechanism variables, see find_assignments().
+
+    @classmethod
+    def from_file(cls, path, stat, text=None):
+        if text is None:
+            with open(path, 'rb') as f:
+                text = f.read()
+        try:
+            text.decode()
+            is_text = True
+        except UnicodeDecodeError:
+            is_text = False
+        # Remove line comments.
+        # TODO: Also remove multi-line comments.
+        if path.suffix in ['.hoc', '.oc', '.ses', '.h', '.c', '.hpp', '.cpp']:
+            text = re.sub(br'//.*', b'', text)
+        elif path.suffix in ['.py']:
+            text = re.sub(br'#.*', b'', text)
+        elif path.suffix in ['.mod', '.inc']:
+            text = re.sub(br':.*', b'', text)
+        # TODO: Special cases for NMODL VERBATIM statements, which can access more
+        # symbols than regular NMODL code.
+        pass
+        # Scan for words.
+        words = set()
+        for match in re.finditer(word_regex, text):
+            try:
+                words.add(match.group().decode())
+            except UnicodeDecodeError:
+                pass
+        # Search for assignments to celsius in the code files.
+        temperatures = []
+        if path.suffix in {'.hoc', '.ses', '.py'}:
+            for match in re.finditer(celsius_regex, text):
+                temperatures.append(float(match.group().decode().partition('=')[2]))
+        # Search for assignments to the mechanism variables in the code files.
+        assignments = {}
+        if path.suffix in {'.hoc', '.oc', '.ses', '.py'}:
+            assignments = find_assignments(text, is_python=(path.suffix == '.py'))
+        return cls(stat.st_mtime_ns, stat.st_size, is_text, words, temperatures, assignments)
+
+    def to_json(self):
+        return [self.mtime, self.size, self.is_text, sorted(self.words), self.temperatures, self.assignments]
+
+    @classmethod
+    def from_json(cls, data):
+        mtime, size, is_text, words, temperatures, assignments = data
+        return cls(mtime, size, is_text, set(words), temperatures, assignments)
+
+def find_assignments(text, is_python=False) -> dict:
+    """
+    Classify every use of the variables with underscores in their names, which
+    includes all of the mechanisms' RANGE variables.
+
+    Returns a dict mapping from variable name to the triple of:
+        [values assigned to every section with "forall",
+         values assigned to the currently accessed section,
+         number of other uses]
+    """
+    assignments = {}
+    forall_uses = [] # List of (uses, value, forall body) to classify at the end.
+    # Each level of braces is either outside of any "forall" block (None), or
+    # inside of the body of a "forall" statement. The body is a dict which is
+    # marked 'conditional' if the statement only applies to some of the sections.
+    scope_stack = [None]
+    pending = None # The body of a "forall" statement which has not started yet.
+    for match in re.finditer(token_regex, text):
+        if match['forall']:
+            pending = {'conditional': False, 'start': match.end()}
+        elif match['condition']:
+            # For example: "forall ifsec "dend" {...}" or "forall { if (...) {...} }"
+            if body := pending or scope_stack[-1]:
+                body['conditional'] = True
+        elif match['open']:
+            # Any section selector between "forall" and the brace is conditional.
+            if pending and text[pending['start'] : match.start()].strip():
+                pending['conditional'] = True
+            scope_stack.append(pending or scope_stack[-1])
+            pending = None
+        elif match['close']:
+            if len(scope_stack) > 1:
+                scope_stack.pop()
+        elif match['newline']:
+            # The body of a "forall" statement without braces is on the same line.
+            if pending and not re.match(brace_regex, text[match.end():]):
+                pending = None
+        else:
+            uses = assignments.setdefault(match['word'].decode(errors='replace'), [[], [], 0])
+            line_start = text.rfind(b'\n', 0, match.start()) + 1
+            before = text[line_start : match.start()]
+            body = pending or scope_stack[-1]
+            pending = None
+            value = None
+            # Assignments to "section.variable" are specific to that section.
+            if not before.rstrip().endswith(b'.'):
+                if assignment := re.match(assignment_regex, text[match.end():]):
+                    value = float(assignment['value'])
+            if value is None:
+                uses[2] += 1
+            elif body is not None:
+                # A condition later in the body can still make it conditional.
+                forall_uses.append((uses, value, body))
+            elif is_python:
+                uses[2] += 1 # Python variable, not a hoc variable.
+            else:
+                uses[1].append(value)
+    for uses, value, body in forall_uses:
+        if body['conditional']:
+            uses[2] += 1
+        else:
+            uses[0].append(value)
+    return assignments
+
+class ReferenceIndex:
+    def __init__(self, index_file):
+        self.path = Path(index_file)
+        self.files = {} # Maps from path to FileEntry.
+        try:
+            with open(self.path, 'rt') as f:
+                data = json.load(f)
+            if data.get('version') != index_version:
+                raise ValueError('outdated index')
+            self.files = {Path(path): FileEntry.from_json(entry) for path, entry in data['files'].items()}
+        except (OSError, ValueError, TypeError):
+            self.files = {}
+
+    def scan(self, path, text=None) -> FileEntry:
+        """
+        Get the summary of a file, rescanning it only if it has changed.
+        Optional argument text is the contents of the file, if already known.
+        """
+        path = Path(path)
+        stat = os.stat(path)
+        entry = self.files.get(path)
+        if entry is None or entry.mtime != stat.st_mtime_ns or entry.size != stat.st_size:
+            entry = self.files[path] = FileEntry.from_file(path, stat, text)
+        return entry
+
+    def retain(self, paths):
+        """ Forget about all files except for these ones. """
+        paths = set(paths)
+        self.files = {k: v for k, v in self.files.items() if k in paths}
+
+    def save(self):
+        data = {'version': index_version,
+                'files': {str(path): entry.to_json() for path, entry in self.files.items()}}
+        tmp_path = self.path.with_name(self.path.name + '.tmp')
+        with open(tmp_path, 'wt') as f:
+            json.dump(data, f)
+        os.replace(tmp_path, self.path)
+
+class SymbolCounts:
+    """ Inverted index from each symbol to the number of files which use it. """
+    def __init__(self, references=()):
+        self.counts   = {} # Maps from symbol to number of files.
+        self.files    = {} # Maps from path to set of symbols.
+        self.prefixes = {} # Maps from word to the set of symbols which could refer to it.
+        for path, words in references:
+            self.add(path, words)
+
+    def add(self, path, words):
+        assert path not in self.files
+        self.files[path] = words
+        for x in words:
+            count = self.counts[x] = self.counts.get(x, 0) + 1
+            if count > 1 or x[:1].isdigit():
+                continue # Already indexed, or a number instead of a symbol.
+            # A symbol can refer to a word either directly or after removing a
+            # mechanism's suffix from the symbol.
+            self.prefixes.setdefault(x, set()).add(x)
+            idx = x.find('_', 1)
+            while idx > 0:
+                self.prefixes.setdefault(x[:idx], set()).add(x)
+                idx = x.find('_', idx + 1)
+
+    def is_referenced(self, symbol, exclude=None) -> bool:
+        """ Is this symbol used in any file, not counting the excluded file? """
+        count = self.counts.get(symbol, 0)
+        if exclude is not None and symbol in self.files.get(exclude, ()):
+            count -= 1
+        return count > 0
+
+    def relevant(self, words, exclude=None) -> set:
+        """
+        Returns the symbols which could refer to any of the words, and which are
+        used in any file, not counting the excluded file.
+        """
+        relevant = set()
+        for word in words:
+            for symbol in self.prefixes.get(word, ()):
+                if self.is_referenced(symbol, exclude):
+                    relevant.add(symbol)
+        return relevant
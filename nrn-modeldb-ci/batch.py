@@ -0,0 +1,190 @@
+"""
+Preprocess a directory of projects, for example the models from ModelDB.
+
+Each subdirectory of the projects directory is optimized and compiled in place
+by running nmodl_preprocessor on it. Several projects are processed at the same
+time, using a bounded pool of workers.
+
+The status of each project is saved into a JSON manifest as soon as it finishes,
+including its run time, the number of optimizations of each kind, and the error
+message if it failed. If the batch is interrupted then running it again with the
+same manifest resumes it: the projects which already succeeded are skipped.
+
+Exit status: 0 if every project succeeded, or 1 if any of the projects failed.
+"""
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from pathlib import Path
+import argparse
+import json
+import os
+import re
+import shlex
+import subprocess
+import sys
+import time
+
+parser = argparse.ArgumentParser(description=__doc__,
+    formatter_class=argparse.RawDescriptionHelpFormatter)
+
+parser.add_argument('projects_dir', type=str,
+        help="directory containing one subdirectory for each project")
+
+parser.add_argument('-o', '--manifest', type=str,
+        default='batch.json',
+        help="JSON manifest file, which is also used to resume (default: batch.json)")
+
+parser.add_argument('-j', '--jobs', type=int,
+        default=os.cpu_count() or 1, metavar='N',
+        help="number of projects to process in parallel (default: number of CPUs)")
+
+parser.add_argument('--preprocessor-args', type=str,
+        default='',
+        help="extra arguments for nmodl_preprocessor, for example \"--cse --hoist\"")
+
+parser.add_argument('--timeout', type=float,
+        default=None, metavar='SECONDS',
+        help="maximum time for each project")
+
+parser.add_argument('--retry-failed', action='store_true',
+        help="also process the projects which failed in a previous run")
+
+parser.add_argument('--restart', action='store_true',
+        help="discard the existing manifest and process every project")
+
+args = parser.parse_args()
+
+assert args.jobs >= 1, "jobs must be a positive number"
+assert args.timeout is None or args.timeout > 0, "timeout must be a positive number"
+
+preprocessor_args = shlex.split(args.preprocessor_args)
+# Share the CPUs between the projects which are compiled at the same time.
+if not any(x.startswith('--compile-jobs') for x in preprocessor_args):
+    preprocessor_args += ['--compile-jobs', str(max(1, (os.cpu_count() or 1) // args.jobs))]
+
+# Matches the messages about each mechanism, for example "hh.mod: inline FUNCTION: vtrap".
+decision_regex = re.compile(r'^(\w[\w.-]*\.mod): ([^:]+)(?:: (.*))?$')
+
+def count_optimizations(lines) -> dict:
+    """
+    Count the optimizations of each kind in the messages of nmodl_preprocessor.
+    Messages which report a number, for example "fold constant expressions: 4",
+    count as that many optimizations.
+    """
+    counts = {}
+    for line in lines:
+        match = decision_regex.match(line)
+        if not match:
+            continue
+        kind, value = match.group(2), match.group(3)
+        if kind in {'up to date', 'warning'}:
+            continue
+        amount = int(value) if value and value.isdigit() else 1
+        counts[kind] = counts.get(kind, 0) + amount
+    return dict(sorted(counts.items()))
+
+def preprocess(project_dir) -> dict:
+    """ Run nmodl_preprocessor on one project. Returns its entry for the manifest. """
+    command = [sys.executable, '-m', 'nmodl_preprocessor', str(project_dir)] + preprocessor_args
+    start = time.time()
+    try:
+        result = subprocess.run(command, cwd=project_dir, stdin=subprocess.DEVNULL,
+                                stdout=subprocess.PIPE, stderr=subprocess.STDOUT,
+                                text=True, errors='replace', timeout=args.timeout)
+    except subprocess.TimeoutExpired as error:
+        output = error.output or ''
+        if isinstance(output, bytes):
+            output = output.decode(errors='replace')
+        status, returncode = 'timeout', None
+    else:
+        output = result.stdout
+        status, returncode = ('ok' if result.returncode == 0 else 'failed'), result.returncode
+    lines = output.splitlines()
+    mechanisms = {match.group(1) for match in map(decision_regex.match, lines) if match}
+    up_to_date = {line.split(':', 1)[0] for line in lines if line.endswith(': up to date')}
+    warnings   = [line for line in lines if decision_regex.match(line) and ': warning: ' in line]
+    entry = {
+        'status':        status,
+        'returncode':    returncode,
+        'start':         start,
+        'seconds':       time.time() - start,
+        'mechanisms':    len(mechanisms),
+        'up_to_date':    len(up_to_date & mechanisms),
+        'optimizations': count_optimizations(lines),
+        'warnings':      warnings,
+    }
+    if status != 'ok':
+        entry['error'] = '\n'.join(lines[-20:])
+    return entry
+
+def save(manifest):
+    """ Write the manifest into a temporary file and then move it into place, so it's never left incomplete. """
+    tmp_path = manifest_path.with_name(manifest_path.name + '.tmp')
+    with open(tmp_path, 'wt') as f:
+        json.dump(manifest, f, indent=4)
+    os.replace(tmp_path, manifest_path)
+
+projects_dir  = Path(args.projects_dir).resolve()
+manifest_path = Path(args.manifest).resolve()
+assert projects_dir.is_dir(), f'directory not found: "{projects_dir}"'
+
+settings = {'preprocessor_args': args.preprocessor_args}
+
+# Load the results of the previous runs.
+if manifest_path.exists() and not args.restart:
+    with open(manifest_path, 'rt') as f:
+        manifest = json.load(f)
+    assert manifest.get('settings') == settings, (
+            "the manifest was made with different settings, use --restart to discard it")
+else:
+    manifest = {'settings': settings, 'projects': {}}
+results = manifest['projects']
+
+projects = sorted(x for x in projects_dir.iterdir() if x.is_dir() and not x.name.startswith('.'))
+retry = {'failed', 'timeout'} if args.retry_failed else set()
+todo = [x for x in projects if x.name not in results or results[x.name]['status'] in retry]
+print('Num Projects:', len(projects))
+print('Num Finished:', len(projects) - len(todo))
+sys.stdout.flush()
+
+start_time = time.time()
+pool = ThreadPoolExecutor(max_workers=args.jobs)
+futures = {}
+try:
+    for project_dir in todo:
+        futures[pool.submit(preprocess, project_dir)] = project_dir
+    for count, future in enumerate(as_completed(futures), 1):
+        project_dir = futures[future]
+        results[project_dir.name] = entry = future.result()
+        save(manifest)
+        print(f'[{count}/{len(todo)}] {project_dir.name}: {entry["status"]} in {entry["seconds"]:.1f} seconds')
+        sys.stdout.flush()
+except KeyboardInterrupt:
+    # The subprocesses also receive the interrupt. The unfinished projects are
+    # not recorded in the manifest, so they will run again when resumed.
+    for future in futures:
+        future.cancel()
+    pool.shutdown(wait=True)
+    print('Interrupted, run again to resume.')
+    sys.exit(130)
+pool.shutdown()
+
+# Summarize all of the projects, including the ones from previous runs.
+statuses = {}
+totals = {}
+for name, entry in results.items():
+    statuses[entry['status']] = statuses.get(entry['status'], 0) + 1
+    for kind, amount in entry['optimizations'].items():
+        totals[kind] = totals.get(kind, 0) + amount
+manifest['num_projects']  = len(results)
+manifest['statuses']      = dict(sorted(statuses.items()))
+manifest['optimizations'] = dict(sorted(totals.items(), key=lambda item: -item[1]))
+save(manifest)
+
+print(f'Elapsed Time: {time.time() - start_time:.1f} seconds')
+for status, count in sorted(statuses.items()):
+    print(f'Num {status.capitalize()}:', count)
+for kind, amount in manifest['optimizations'].items():
+    print(f'  {kind}: {amount}')
+
+if any(entry['status'] != 'ok' for entry in results.values()):
+    sys.exit(1)
@@ -0,0 +1,230 @@
+"""
+Benchmark the original and preprocessed builds of a directory of projects.
+
+Each project is copied twice into the work directory. One copy is compiled with
+nrnivmodl as is, and the other copy is optimized with nmodl_preprocessor. Then
+the simulation of each copy is run several times, alternating between the two
+copies in a random order so that any drift in the machine's performance affects
+both of them equally. The first runs of each copy are discarded as warmup.
+
+For each project this reports the median wall time and peak memory usage, and
+the bootstrap confidence interval of the ratio of preprocessed / original.
+A regression is significant if the whole confidence interval is slower or larger
+than the threshold.
+
+Exit status: 0 if there were no regressions, 1 if there were any significant
+regressions, or 2 if any of the projects failed to build or run.
+"""
+from pathlib import Path
+import argparse
+import json
+import math
+import os
+import random
+import shlex
+import shutil
+import statistics
+import subprocess
+import sys
+import time
+
+parser = argparse.ArgumentParser(description=__doc__,
+    formatter_class=argparse.RawDescriptionHelpFormatter)
+
+parser.add_argument('projects_dir', type=str,
+        help="directory containing one subdirectory for each project")
+
+parser.add_argument('-o', '--output', type=str,
+        default='benchmark.json',
+        help="JSON report file (default: benchmark.json)")
+
+parser.add_argument('--work-dir', type=str,
+        default='benchmark_work',
+        help="directory to build and run the copies of the projects in (default: benchmark_work)")
+
+parser.add_argument('--command', type=str,
+        default='nrniv -nobanner -nogui mosinit.hoc',
+        help="command which runs a simulation, in the project's directory (default: %(default)s)")
+
+parser.add_argument('--preprocessor-args', type=str,
+        default='',
+        help="extra arguments for nmodl_preprocessor, for example \"--cse --hoist\"")
+
+parser.add_argument('--runs', type=int,
+        default=10,
+        help="number of measured runs of each build (default: 10)")
+
+parser.add_argument('--warmup', type=int,
+        default=1,
+        help="number of unmeasured runs of each build (default: 1)")
+
+parser.add_argument('--bootstrap', type=int,
+        default=10000,
+        help="number of bootstrap resamples (default: 10000)")
+
+parser.add_argument('--confidence', type=float,
+        default=0.95,
+        help="confidence level of the intervals (default: 0.95)")
+
+parser.add_argument('--threshold', type=float,
+        default=0.0,
+        help="smallest slowdown or memory increase to flag, in percent (default: 0)")
+
+parser.add_argument('--seed', type=int,
+        default=None,
+        help="random seed for the run order and the bootstrap")
+
+args = parser.parse_args()
+
+assert args.runs >= 2, "runs must be at least 2"
+assert args.warmup >= 0, "warmup must not be negative"
+assert 0 < args.confidence < 1, "confidence must be between 0 and 1"
+
+rng = random.Random(args.seed)
+
+builds = ('original', 'preprocessed')
+
+def ignore_build_files(directory, names):
+    """ Don't copy any previous builds into the work directory. """
+    return [x for x in names if x in {'.preprocessed', 'x86_64', 'arm64', 'aarch64', 'i686'}]
+
+def find_mod_files(project_dir) -> list:
+    """ Use the same search as nmodl_preprocessor: the top level directory, else any one directory. """
+    mod_files = sorted(project_dir.glob('*.mod'))
+    if not mod_files:
+        mod_files = sorted(x for x in project_dir.rglob('*.mod') if not any(
+                part.startswith('.') for part in x.relative_to(project_dir).parts))
+    return mod_files
+
+def setup(project_dir, work_dir):
+    """ Copy and compile both builds of a project. Returns a dict of build directories. """
+    build_dirs = {}
+    for build in builds:
+        build_dir = work_dir.joinpath(build, project_dir.name)
+        if build_dir.exists():
+            shutil.rmtree(build_dir)
+        shutil.copytree(project_dir, build_dir, symlinks=True, ignore=ignore_build_files)
+        build_dirs[build] = build_dir
+    mod_files = [str(x) for x in find_mod_files(build_dirs['original'])]
+    subprocess.run(['nrnivmodl'] + mod_files, cwd=build_dirs['original'],
+                   stdout=subprocess.DEVNULL, check=True)
+    subprocess.run([sys.executable, '-m', 'nmodl_preprocessor', str(build_dirs['preprocessed'])] +
+                   shlex.split(args.preprocessor_args), cwd=build_dirs['preprocessed'],
+                   stdout=subprocess.DEVNULL, check=True)
+    return build_dirs
+
+def measure(build_dir):
+    """ Run the simulation once. Returns the pair (wall time in seconds, peak RSS in bytes). """
+    start = time.perf_counter()
+    process = subprocess.Popen(shlex.split(args.command), cwd=build_dir,
+                               stdin=subprocess.DEVNULL, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    # Wait for this specific child to get its own resource usage.
+    pid, status, usage = os.wait4(process.pid, 0)
+    wall_time = time.perf_counter() - start
+    process.returncode = os.WEXITSTATUS(status) if os.WIFEXITED(status) else -1
+    if process.returncode != 0:
+        raise subprocess.CalledProcessError(process.returncode, args.command)
+    # Linux reports the peak RSS in kilobytes, macOS reports it in bytes.
+    peak_rss = usage.ru_maxrss if sys.platform == 'darwin' else usage.ru_maxrss * 1024
+    return wall_time, peak_rss
+
+def bootstrap_ratio(original, preprocessed):
+    """ Returns the confidence interval of median(preprocessed) / median(original). """
+    ratios = []
+    for _ in range(args.bootstrap):
+        a = statistics.median(rng.choices(original, k=len(original)))
+        b = statistics.median(rng.choices(preprocessed, k=len(preprocessed)))
+        ratios.append(b / a if a else math.nan)
+    ratios = sorted(x for x in ratios if not math.isnan(x))
+    if not ratios:
+        return [math.nan, math.nan]
+    alpha = (1 - args.confidence) / 2
+    lower = ratios[int(alpha * (len(ratios) - 1))]
+    upper = ratios[int(math.ceil((1 - alpha) * (len(ratios) - 1)))]
+    return [lower, upper]
+
+def compare(samples):
+    """ Summarize one metric of both builds. Argument samples maps from build to list of values. """
+    original, preprocessed = samples['original'], samples['preprocessed']
+    median_original     = statistics.median(original)
+    median_preprocessed = statistics.median(preprocessed)
+    lower, upper = bootstrap_ratio(original, preprocessed)
+    return {
+        'original':     {'median': median_original,     'samples': original},
+        'preprocessed': {'median': median_preprocessed, 'samples': preprocessed},
+        'ratio':        median_preprocessed / median_original if median_original else math.nan,
+        'ratio_ci':     [lower, upper],
+        'regression':   lower > 1 + args.threshold / 100,
+        'improvement':  upper < 1,
+    }
+
+def benchmark(project_dir, work_dir):
+    build_dirs = setup(project_dir, work_dir)
+    wall_time = {build: [] for build in builds}
+    peak_rss  = {build: [] for build in builds}
+    for run in range(args.warmup + args.runs):
+        order = list(builds)
+        rng.shuffle(order)
+        for build in order:
+            seconds, rss = measure(build_dirs[build])
+            if run >= args.warmup:
+                wall_time[build].append(seconds)
+                peak_rss[build].append(rss)
+    return {'wall_time': compare(wall_time), 'peak_rss': compare(peak_rss)}
+
+projects_dir = Path(args.projects_dir).resolve()
+work_dir = Path(args.work_dir).resolve()
+assert projects_dir.is_dir(), f'directory not found: "{projects_dir}"'
+assert projects_dir not in work_dir.parents, "work_dir must not be inside of projects_dir"
+
+projects = sorted(x for x in projects_dir.iterdir() if x.is_dir() and not x.name.startswith('.'))
+print('Num Projects:', len(projects))
+
+results = {}
+num_regressions = 0
+num_failures = 0
+for project_dir in projects:
+    try:
+        results[project_dir.name] = result = benchmark(project_dir, work_dir)
+    except (subprocess.CalledProcessError, OSError) as error:
+        results[project_dir.name] = {'error': str(error)}
+        num_failures += 1
+        print(f'{project_dir.name}: error: {error}')
+        continue
+    time_ci = result['wall_time']['ratio_ci']
+    rss_ci  = result['peak_rss']['ratio_ci']
+    flags = [metric for metric in ('wall_time', 'peak_rss') if result[metric]['regression']]
+    num_regressions += bool(flags)
+    print(f'{project_dir.name}:',
+          f'time {100 * (result["wall_time"]["ratio"] - 1):+.1f}%',
+          f'[{100 * (time_ci[0] - 1):+.1f}%, {100 * (time_ci[1] - 1):+.1f}%],',
+          f'memory {100 * (result["peak_rss"]["ratio"] - 1):+.1f}%',
+          f'[{100 * (rss_ci[0] - 1):+.1f}%, {100 * (rss_ci[1] - 1):+.1f}%]',
+          ('REGRESSION: ' + ', '.join(flags)) if flags else '')
+    sys.stdout.flush()
+
+report = {
+    'settings': {
+        'command':           args.command,
+        'preprocessor_args': args.preprocessor_args,
+        'runs':              args.runs,
+        'warmup':            args.warmup,
+        'bootstrap':         args.bootstrap,
+        'confidence':        args.confidence,
+        'threshold':         args.threshold,
+        'seed':              args.seed,
+    },
+    'projects': results,
+    'num_regressions': num_regressions,
+    'num_failures': num_failures,
+}
+with open(args.output, 'wt') as f:
+    json.dump(report, f, indent=4)
+
+print('Num Regressions:', num_regressions)
+print('Num Failures:', num_failures)
+
+if num_failures:
+    sys.exit(2)
+elif num_regressions:
+    sys.exit(1)
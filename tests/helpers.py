@@ -0,0 +1,23 @@
+"""
+Shared helpers for the tests.
+"""
+from pathlib import Path
+import re
+
+from nmodl_preprocessor.optimize_nmodl import optimize_nmodl
+
+def optimize(tmp_path, nmodl_text, celsius=6.3, **kwargs) -> str:
+    """ Optimize the NMODL text and return the optimized text. """
+    input_file  = Path(tmp_path).joinpath('input', 'test.mod')
+    output_file = Path(tmp_path).joinpath('output', 'test.mod')
+    input_file.parent.mkdir()
+    output_file.parent.mkdir()
+    input_file.write_text(nmodl_text)
+    optimize_nmodl(input_file, output_file, set(), set(), celsius=celsius, **kwargs)
+    return output_file.read_text()
+
+def get_block(nmodl_text, keyword) -> str:
+    """ Returns the text of the top-level block which starts with the keyword. """
+    start = re.search(rf'^{keyword}\b', nmodl_text, re.MULTILINE).start()
+    end   = re.search(r'^}', nmodl_text[start:], re.MULTILINE).end()
+    return nmodl_text[start : start + end]
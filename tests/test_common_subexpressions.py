@@ -0,0 +1,52 @@
+import nmodl
+
+from nmodl_preprocessor.common_subexpressions import eliminate_common_subexpressions
+
+def eliminate(nmodl_text):
+    program = nmodl.NmodlDriver().parse_string(nmodl_text)
+    block = program.blocks[0].statement_block
+    new_locals = eliminate_common_subexpressions(block, {'v', 'a', 'b', 'c'})
+    return new_locals, nmodl.to_nmodl(block)
+
+def test_conditional_uses_are_not_hoisted():
+    new_locals, text = eliminate("""
+        PROCEDURE f() {
+            IF (v > 0) {
+                a = exp(v)
+            }
+            IF (v < -10) {
+                b = exp(v)
+            }
+        }
+    """)
+    assert new_locals == {}
+    assert text.count('exp(v)') == 2
+
+def test_uses_in_one_branch():
+    new_locals, text = eliminate("""
+        PROCEDURE f() {
+            c = 1
+            IF (v > 0) {
+                a = exp(v)
+                b = exp(v)
+            }
+        }
+    """)
+    assert new_locals == {'cse_0': 'exp(v)'}
+    # The new variable is computed inside of the branch.
+    assert text.index('cse_0 = exp(v)') > text.index('IF')
+
+def test_uses_in_every_branch():
+    new_locals, text = eliminate("""
+        PROCEDURE f() {
+            IF (v > 0) {
+                a = exp(v)
+            } ELSE {
+                b = exp(v)
+            }
+            c = exp(v)
+        }
+    """)
+    assert new_locals == {'cse_0': 'exp(v)'}
+    assert text.count('exp(v)') == 1
+    assert text.index('cse_0 = exp(v)') < text.index('IF')
@@ -0,0 +1,111 @@
+import nmodl
+import nmodl.ast
+import nmodl.symtab
+
+from helpers import optimize, get_block
+from nmodl_preprocessor.conservation import eliminate_conserved_states
+
+def kinetic_mechanism(kinetic_text, states='C1 C2 O', solve='sparse'):
+    return f"""
+        NEURON {{
+            SUFFIX test
+            NONSPECIFIC_CURRENT i
+        }}
+        PARAMETER {{
+            kf = 0.2
+            kb = 0.1
+        }}
+        ASSIGNED {{ v i }}
+        STATE {{ {states} }}
+        BREAKPOINT {{
+            SOLVE kstates METHOD {solve}
+            i = O * v * 1e-6
+        }}
+        INITIAL {{
+            SOLVE kstates STEADYSTATE {solve}
+        }}
+        KINETIC kstates {{
+            {kinetic_text}
+        }}
+    """
+
+three_states = """
+    ~ C1 <-> C2 (kf, kb)
+    ~ C2 <-> O (kf, kb)
+    CONSERVE C1 + C2 + O = 1
+"""
+
+def eliminate(nmodl_text, external_refs=set()):
+    program = nmodl.NmodlDriver().parse_string(nmodl_text)
+    nmodl.symtab.SymtabVisitor().visit_program(program)
+    result = eliminate_conserved_states(program, external_refs)
+    return result, nmodl.to_nmodl(program)
+
+def test_eliminate_state():
+    result, text = eliminate(kinetic_mechanism(three_states))
+    assert result.states == {'O': '(1-C1-C2)'}
+    assert result.blocks == ['kstates']
+    assert result.rejected == {}
+    assert 'C1 C2 O' not in text
+    derivative = get_block(text, 'DERIVATIVE')
+    assert 'flux_0 = kf*C1-kb*C2' in derivative
+    assert 'flux_1 = kf*C2-kb*(1-C1-C2)' in derivative
+    assert "C1' = -flux_0" in derivative
+    assert "C2' = flux_0-flux_1" in derivative
+    assert "O'" not in derivative
+    assert 'CONSERVE' not in derivative
+    assert 'i = (1-C1-C2)*v*1e-6' in get_block(text, 'BREAKPOINT')
+    assert 'SOLVE kstates METHOD derivimplicit' in get_block(text, 'BREAKPOINT')
+    assert 'SOLVE kstates STEADYSTATE derivimplicit' in get_block(text, 'INITIAL')
+
+def test_method_change_is_reported(tmp_path, capsys):
+    output = optimize(tmp_path, kinetic_mechanism(three_states), conserve=True)
+    stdout = capsys.readouterr().out
+    assert 'eliminate conserved STATE: O = (1-C1-C2)' in stdout
+    assert 'solve kstates with derivimplicit instead of sparse' in stdout
+    assert 'KINETIC' not in output
+
+def test_not_sparse():
+    result, text = eliminate(kinetic_mechanism(three_states, solve='cnexp'))
+    assert result.states == {}
+    assert result.rejected == {'kstates': 'not solved with the sparse method'}
+    assert 'KINETIC kstates' in text
+
+def test_flux():
+    result, text = eliminate(kinetic_mechanism(three_states + "\ni = f_flux"))
+    assert result.rejected == {'kstates': 'uses f_flux or b_flux'}
+    assert 'KINETIC kstates' in text
+
+def test_compartment():
+    result, text = eliminate(kinetic_mechanism("COMPARTMENT 2 { C1 C2 O }\n" + three_states))
+    assert result.rejected['kstates'].startswith('unsupported statement COMPARTMENT')
+    assert 'KINETIC kstates' in text
+
+def test_array():
+    result, text = eliminate(kinetic_mechanism("""
+        ~ C[0] <-> C[1] (kf, kb)
+        ~ C[1] <-> O (kf, kb)
+        CONSERVE C[0] + C[1] + O = 1
+    """, states='C[2] O'))
+    assert result.rejected == {'kstates': 'reaction with an array variable'}
+    assert 'KINETIC kstates' in text
+
+def test_not_conserved():
+    result, text = eliminate(kinetic_mechanism("""
+        ~ C1 <-> C2 (kf, kb)
+        ~ C2 <-> O (kf, kb)
+        ~ O << (kf)
+        CONSERVE C1 + C2 + O = 1
+    """))
+    assert result.rejected == {'kstates': 'reactions do not conserve C1+C2+O'}
+    assert 'KINETIC kstates' in text
+
+def test_external_state():
+    # The other state variables can still be eliminated.
+    result, text = eliminate(kinetic_mechanism(three_states), external_refs={'O'})
+    assert result.states == {'C2': '(1-C1-O)'}
+    # None of the states can be eliminated.
+    result, text = eliminate(kinetic_mechanism(three_states), external_refs={'C1', 'C2', 'O'})
+    assert result.states == {}
+    assert result.rejected == {'kstates': 'no STATE can be eliminated from C1+C2+O'}
+    assert 'KINETIC kstates' in text
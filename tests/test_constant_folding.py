@@ -0,0 +1,79 @@
+import nmodl
+
+from nmodl_preprocessor.constant_folding import fold_constants
+from nmodl_preprocessor.dead_code import eliminate_dead_code
+
+def fold(statements):
+    """ Fold the constants in a PROCEDURE and return the pair of (number of folds, lines). """
+    program = nmodl.NmodlDriver().parse_string('PROCEDURE f() {\n' + statements + '\n}')
+    num_folded = fold_constants(program)
+    lines = [x.strip() for x in nmodl.to_nmodl(program).splitlines()[1:-1]]
+    return num_folded, lines
+
+def test_integer_division():
+    # The generated code might use integer division.
+    assert fold('a = 7/2') == (0, ['a = 7/2'])
+    assert fold('a = 7.0/2') == (1, ['a = 3.5'])
+
+def test_abs_is_not_folded():
+    # The C/C++ function may return an integer.
+    assert fold('a = abs(-3.5)') == (0, ['a = abs(-3.5)'])
+    assert fold('a = sqrt(4.0)') == (1, ['a = 2.0'])
+
+def test_negative_literals():
+    assert fold('a = 2-5') == (1, ['a = (-3)'])
+    assert fold('a = 2.5*(0-1)') == (1, ['a = (-2.5)'])
+    assert fold('a = x^(1-3)') == (1, ['a = x^(-2)'])
+
+def test_comparisons():
+    assert fold('a = 3 < 4') == (1, ['a = 1'])
+    assert fold('a = 1.5 > 2.5') == (1, ['a = 0'])
+    assert fold('a = (1 < 2) && (3 == 3.0)') == (1, ['a = 1'])
+
+def test_not_finite():
+    assert fold('a = exp(1000)') == (0, ['a = exp(1000)'])
+    assert fold('a = log(-1)') == (0, ['a = log(-1)'])
+    assert fold('a = 1e308*10') == (0, ['a = 1e308*10'])
+    assert fold('a = 1.0/0') == (0, ['a = 1.0/0'])
+    # Integer results are also limited to the range of the C/C++ integers.
+    assert fold('a = 65536*65536') == (0, ['a = 65536*65536'])
+
+def test_verbatim():
+    text = """
+        PROCEDURE f() {
+            IF (1 > 2) {
+                a = 1
+            } ELSE {
+                a = 2
+            }
+            VERBATIM
+            return 0;
+            ENDVERBATIM
+        }
+    """
+    program = nmodl.NmodlDriver().parse_string(text)
+    assert fold_constants(program) == 1
+    # The condition is folded, but the VERBATIM block could depend on the code
+    # so none of it is removed.
+    assert eliminate_dead_code(program) == 0
+    output = nmodl.to_nmodl(program)
+    assert 'IF (0)' in output
+    assert 'a = 1' in output
+    assert 'return 0;' in output
+
+def test_constant_condition():
+    program = nmodl.NmodlDriver().parse_string("""
+        PROCEDURE f() {
+            IF (1 > 2) {
+                a = 1
+            } ELSE {
+                a = 2
+            }
+        }
+    """)
+    assert fold_constants(program) == 1
+    assert eliminate_dead_code(program) > 0
+    output = nmodl.to_nmodl(program)
+    assert 'IF' not in output
+    assert 'a = 1' not in output
+    assert 'a = 2' in output
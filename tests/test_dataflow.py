@@ -0,0 +1,45 @@
+import nmodl
+
+from nmodl_preprocessor.dataflow import find_local_variables
+
+def test_nested_local_does_not_hide_outer_read():
+    program = nmodl.NmodlDriver().parse_string("""
+        NEURON {
+            SUFFIX test
+            NONSPECIFIC_CURRENT i
+        }
+        ASSIGNED { v i acc tmp }
+        BREAKPOINT {
+            acc = acc + 1
+            i = acc*1e-6
+            IF (v > 100) {
+                LOCAL acc
+                acc = 2
+                tmp = acc
+                i = tmp
+            }
+        }
+    """)
+    result = find_local_variables(program, {'acc', 'tmp'})
+    assert result.variables == {'tmp'}
+
+def test_net_receive_initial():
+    # The INITIAL block inside of NET_RECEIVE runs separately from it.
+    program = nmodl.NmodlDriver().parse_string("""
+        NEURON {
+            POINT_PROCESS syn
+        }
+        ASSIGNED { tlast }
+        NET_RECEIVE(w) {
+            INITIAL {
+                tlast = t
+            }
+            FOR_NETCONS(x) {
+                x = w
+            }
+        }
+    """)
+    result = find_local_variables(program, {'tlast'})
+    assert result.variables == {'tlast'}
+    assert result.blocks['NET_RECEIVE'] == set()
+    assert result.blocks['NET_RECEIVE INITIAL'] == {'tlast'}
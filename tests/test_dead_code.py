@@ -0,0 +1,43 @@
+import nmodl
+
+from nmodl_preprocessor.dead_code import eliminate_dead_code
+
+def test_nested_local_does_not_hide_outer_assignment():
+    program = nmodl.NmodlDriver().parse_string("""
+        NEURON {
+            SUFFIX test
+            RANGE g
+        }
+        ASSIGNED { v g }
+        BREAKPOINT {
+            g = 0
+            IF (v > 0) {
+                LOCAL g
+                g = 1
+            }
+        }
+    """)
+    eliminate_dead_code(program)
+    text = nmodl.to_nmodl(program)
+    breakpoint_block = text[text.index('BREAKPOINT'):]
+    # The assignment to the RANGE variable is kept, the inner local variable is removed.
+    assert 'g = 0' in breakpoint_block
+    assert 'g = 1' not in breakpoint_block
+    assert 'LOCAL' not in breakpoint_block
+
+def test_unread_local_variables():
+    program = nmodl.NmodlDriver().parse_string("""
+        BREAKPOINT {
+            LOCAL a, b
+            a = 1
+            b = 2
+            IF (b > 0) {
+                LOCAL a
+                a = b
+            }
+        }
+    """)
+    eliminate_dead_code(program)
+    text = nmodl.to_nmodl(program)
+    assert 'a = ' not in text
+    assert 'b = 2' in text
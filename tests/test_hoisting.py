@@ -0,0 +1,46 @@
+from helpers import optimize, get_block
+
+def test_voltage_parameter_is_not_invariant(tmp_path):
+    # Legacy mechanisms often declare the voltage in the PARAMETER block.
+    output = optimize(tmp_path, """
+        NEURON {
+            SUFFIX test
+            NONSPECIFIC_CURRENT i
+            GLOBAL q
+        }
+        PARAMETER {
+            v (mV)
+            q = 2
+        }
+        ASSIGNED { i vfac qfac }
+        BREAKPOINT {
+            vfac = exp(v/10)
+            qfac = exp(q)
+            i = vfac * qfac * 1e-6
+        }
+    """, hoist=True)
+    assert 'exp(v/10)' in get_block(output, 'BREAKPOINT')
+    assert 'exp(v/10)' not in output.partition('INITIAL')[2]
+
+def test_hoisted_variable_is_global(tmp_path):
+    # The hoisted value is the same for every instance, so it's not stored per instance.
+    output = optimize(tmp_path, """
+        NEURON {
+            THREADSAFE
+            SUFFIX test
+            NONSPECIFIC_CURRENT i
+            GLOBAL q10
+        }
+        PARAMETER {
+            q10 = 3
+        }
+        ASSIGNED { v i tadj }
+        BREAKPOINT {
+            tadj = q10^((celsius - 23)/10)
+            i = tadj * v * 1e-6
+        }
+    """, celsius=None, hoist=True)
+    assert 'tadj = ' not in get_block(output, 'BREAKPOINT')
+    assert 'tadj = ' in get_block(output, 'INITIAL')
+    assert 'tadj' in get_block(output, 'ASSIGNED')
+    assert 'RANGE' not in get_block(output, 'NEURON')
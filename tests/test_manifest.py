@@ -0,0 +1,48 @@
+import platform
+
+from nmodl_preprocessor.manifest import CompileRecord, Manifest, read_inputs, hash_inputs
+
+def test_compile_record_includes(tmp_path):
+    output_dir = tmp_path.joinpath('output')
+    output_dir.mkdir()
+    output_dir.joinpath('test.mod').write_text('NEURON { SUFFIX test }\n')
+    output_dir.joinpath('test.inc').write_text('x = 1\n')
+    tmp_path.joinpath(platform.machine()).mkdir()
+    tmp_path.joinpath(platform.machine(), 'special').touch()
+    CompileRecord(output_dir, tmp_path).save()
+    assert CompileRecord(output_dir, tmp_path).is_current()
+    # Changing an included file requires recompiling the mechanisms.
+    output_dir.joinpath('test.inc').write_text('x = 2\n')
+    assert not CompileRecord(output_dir, tmp_path).is_current()
+
+def test_hash_inputs(tmp_path):
+    tmp_path.joinpath('test.mod').write_text('NEURON { SUFFIX test RANGE gbar }\nINCLUDE "test.inc"\n')
+    tmp_path.joinpath('test.inc').write_text('PARAMETER { gbar = 1 }\n')
+    inputs = read_inputs(tmp_path.joinpath('test.mod'))
+    assert 'gbar' in inputs.words
+    key = hash_inputs(inputs, {'gbar_test'}, set(), 6.3, {}, cse=False)
+    assert key == hash_inputs(read_inputs(tmp_path.joinpath('test.mod')), {'gbar_test'}, set(), 6.3, {}, cse=False)
+    # Everything which can change the output changes the hash.
+    assert key != hash_inputs(inputs, {'gbar_test'}, set(), 6.3, {}, cse=True)
+    assert key != hash_inputs(inputs, {'gbar_test'}, set(), 37, {}, cse=False)
+    assert key != hash_inputs(inputs, set(), set(), 6.3, {}, cse=False)
+    assert key != hash_inputs(inputs, {'gbar_test'}, set(), 6.3, {'gbar_test': 2}, cse=False)
+    tmp_path.joinpath('test.inc').write_text('PARAMETER { gbar = 2 }\n')
+    assert key != hash_inputs(read_inputs(tmp_path.joinpath('test.mod')), {'gbar_test'}, set(), 6.3, {}, cse=False)
+    # Assignments to other mechanisms do not.
+    assert key == hash_inputs(inputs, {'gbar_test'}, set(), 6.3, {'gnabar_hh': 2}, cse=False)
+
+def test_manifest(tmp_path):
+    output_file = tmp_path.joinpath('test.mod')
+    output_file.write_text('NEURON { SUFFIX test }\n')
+    manifest = Manifest(tmp_path)
+    assert not manifest.is_current(output_file, 'key')
+    manifest.update(output_file, 'key', ({'bytes': 16}, {'bytes': 8}))
+    manifest.save()
+    manifest = Manifest(tmp_path)
+    assert manifest.is_current(output_file, 'key')
+    assert not manifest.is_current(output_file, 'other key')
+    assert manifest.footprint(output_file) == [{'bytes': 16}, {'bytes': 8}]
+    # Modifying the output file requires optimizing it again.
+    output_file.write_text('NEURON { SUFFIX modified }\n')
+    assert not manifest.is_current(output_file, 'key')
@@ -0,0 +1,43 @@
+import json
+
+from nmodl_preprocessor.memory_footprint import measure_nmodl, save_report
+
+def test_measure():
+    footprint = measure_nmodl("""
+        NEURON {
+            SUFFIX test
+            USEION na READ ena WRITE ina
+            RANGE gbar, g, tau
+            POINTER p
+        }
+        PARAMETER { gbar = 0.1 tau = 2 q = 3 }
+        ASSIGNED { v ena ina g x[4] p }
+        STATE { m h[2] }
+        BREAKPOINT {
+            ina = gbar * m * h[0] * (v - ena)
+        }
+    """)
+    # The GLOBAL parameter "q" and the ASSIGNED array "x" are not stored per instance.
+    assert footprint['range_parameters'] == 2
+    assert footprint['assigned'] == 4
+    assert footprint['states'] == 3
+    assert footprint['derivatives'] == 3
+    assert footprint['arrays'] == {'h': 2}
+    assert footprint['doubles'] == 12
+    # Both ion variables and the derivative of the ion current.
+    assert footprint['ion_pointers'] == 3
+    assert footprint['pointers'] == 1
+    assert footprint['bytes'] == 12 * 8 + 4 * 8
+
+def test_invalid():
+    assert measure_nmodl('NEURON {') is None
+
+def test_report(tmp_path):
+    before = measure_nmodl('NEURON { SUFFIX a RANGE g } PARAMETER { g = 1 } ASSIGNED { v }')
+    after  = measure_nmodl('NEURON { SUFFIX a } PARAMETER { g = 1 } ASSIGNED { v }')
+    report = save_report(tmp_path, {'a.mod': (before, after), 'b.mod': (None, after)})
+    assert report == json.loads(tmp_path.joinpath('memory.json').read_text())
+    assert report['mechanisms']['a.mod']['saved_bytes'] == 8
+    assert 'saved_bytes' not in report['mechanisms']['b.mod']
+    # Mechanisms which could not be measured are left out of the total.
+    assert report['total_bytes_per_instance'] == {'before': 16, 'after': 8, 'saved_bytes': 8}
@@ -0,0 +1,44 @@
+import math
+
+import nmodl
+
+from nmodl_preprocessor.nmodl_to_python import evaluate_samples
+
+def initial_block(nmodl_text):
+    program = nmodl.NmodlDriver().parse_string(nmodl_text)
+    return next(x for x in program.blocks if x.is_initial_block())
+
+def test_unexercised_branch():
+    # None of the samples are larger than 1e6, but the branch may still be taken.
+    node = initial_block("""
+        INITIAL {
+            x = 2
+            y = 3
+            IF (v > 1e6) {
+                x = 1
+            } ELSE {
+                z = 4
+            }
+        }
+    """)
+    results = evaluate_samples(node, {'v': math.nan}, {'v'}, 100, 1e-9)
+    assert math.isnan(results['x'])
+    assert results['y'] == 3
+    assert results['z'] == 4
+
+def test_unexercised_function_call():
+    program = nmodl.NmodlDriver().parse_string("""
+        PROCEDURE reset() {
+            x = 1
+        }
+        INITIAL {
+            x = 2
+            IF (v > 1e6) {
+                reset()
+            }
+        }
+    """)
+    functions = {x.get_node_name(): x for x in program.blocks if x.is_procedure_block()}
+    node = next(x for x in program.blocks if x.is_initial_block())
+    results = evaluate_samples(node, {'v': math.nan}, {'v'}, 100, 1e-9, functions)
+    assert math.isnan(results['x'])
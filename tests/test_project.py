@@ -0,0 +1,104 @@
+import json
+
+from nmodl_preprocessor import nmodl_to_python
+from nmodl_preprocessor.project import optimize_project
+
+leak_text = """
+NEURON {
+    SUFFIX leak
+    NONSPECIFIC_CURRENT i
+    RANGE g, e
+}
+PARAMETER {
+    g = .001 (S/cm2)
+    e = -70 (mV)
+}
+ASSIGNED { v (mV) i (mA/cm2) }
+BREAKPOINT {
+    i = g * (v - e)
+}
+"""
+
+def make_project(tmp_path, hoc_text='', **mod_files):
+    """ Create a project directory with the given hoc code and mod files. """
+    project_dir = tmp_path.joinpath('project')
+    project_dir.mkdir()
+    project_dir.joinpath('init.hoc').write_text(hoc_text)
+    for name, text in (mod_files or {'leak': leak_text}).items():
+        project_dir.joinpath(name + '.mod').write_text(text)
+    return project_dir
+
+def test_missing_numpy_warning(tmp_path, monkeypatch):
+    project_dir = make_project(tmp_path)
+    monkeypatch.setattr(nmodl_to_python, 'numpy', None)
+    result = optimize_project(project_dir)
+    assert any(x.startswith('warning: numpy is not installed') for x in result.messages)
+    result = optimize_project(project_dir, initial_samples=0)
+    assert not any(x.startswith('warning: numpy') for x in result.messages)
+
+def test_up_to_date(tmp_path):
+    project_dir = make_project(tmp_path)
+    result = optimize_project(project_dir)
+    assert not result.mechanisms['leak.mod'].up_to_date
+    output_file = result.mechanisms['leak.mod'].output_file
+    mtime = output_file.stat().st_mtime_ns
+    # The second run does not optimize or rewrite the mechanism.
+    result = optimize_project(project_dir)
+    assert result.mechanisms['leak.mod'].up_to_date
+    assert 'leak.mod: up to date' in result.messages
+    assert output_file.stat().st_mtime_ns == mtime
+    # Changing an option or the project's code requires optimizing it again.
+    result = optimize_project(project_dir, cse=True)
+    assert not result.mechanisms['leak.mod'].up_to_date
+    project_dir.joinpath('init.hoc').write_text('forall g_leak = 0.002\n')
+    result = optimize_project(project_dir, cse=True)
+    assert not result.mechanisms['leak.mod'].up_to_date
+    assert optimize_project(project_dir, cse=True).mechanisms['leak.mod'].up_to_date
+
+q10_text = """
+NEURON {
+    SUFFIX q10
+    NONSPECIFIC_CURRENT i
+}
+PARAMETER { celsius (degC) }
+ASSIGNED { v (mV) i (mA/cm2) tadj }
+BREAKPOINT {
+    tadj = 3^((celsius - 20.0)/10)
+    i = tadj * 1e-6 * v
+}
+"""
+
+def test_per_temperature(tmp_path):
+    project_dir = make_project(tmp_path, 'celsius = 20\ncelsius = 30\n', q10=q10_text)
+    output_dir = project_dir.joinpath('.preprocessed')
+    result = optimize_project(project_dir, per_temperature=True)
+    assert result.temperatures == [20, 30]
+    assert [x.celsius for x in result.builds] == [None, 20, 30]
+    assert [x.output_dir for x in result.builds] == [
+            output_dir, output_dir.joinpath('celsius_20'), output_dir.joinpath('celsius_30')]
+    assert json.loads(output_dir.joinpath('temperatures.json').read_text()) == {
+            '20.0': str(output_dir.joinpath('celsius_20')),
+            '30.0': str(output_dir.joinpath('celsius_30'))}
+    # The main build works at any temperature, the others have it hardcoded.
+    assert 'tadj = 3^((celsius-20.0)/10)' in output_dir.joinpath('q10.mod').read_text()
+    assert 'tadj = 1.0' in output_dir.joinpath('celsius_20', 'q10.mod').read_text()
+    assert 'tadj = 3.0' in output_dir.joinpath('celsius_30', 'q10.mod').read_text()
+    # The builds are removed when the project only uses one temperature.
+    project_dir.joinpath('init.hoc').write_text('celsius = 20\n')
+    result = optimize_project(project_dir, per_temperature=True)
+    assert [x.celsius for x in result.builds] == [20]
+    assert not output_dir.joinpath('temperatures.json').exists()
+    assert not output_dir.joinpath('celsius_30').exists()
+
+def test_memory_report(tmp_path):
+    # The RANGE parameters are never assigned, so they're hardcoded.
+    project_dir = make_project(tmp_path)
+    result = optimize_project(project_dir)
+    before, after = result.mechanisms['leak.mod'].footprint
+    assert (before['range_parameters'], after['range_parameters']) == (2, 0)
+    assert result.builds[0].memory_report['total_bytes_per_instance'] == {'before': 32, 'after': 16, 'saved_bytes': 16}
+    assert 'Memory per instance of all mechanisms: 32 bytes before, 16 bytes after' in result.messages
+    # The footprints are remembered for the mechanisms which are up to date.
+    result = optimize_project(project_dir)
+    assert result.mechanisms['leak.mod'].up_to_date
+    assert result.builds[0].memory_report['total_bytes_per_instance']['saved_bytes'] == 16
@@ -0,0 +1,116 @@
+import nmodl
+import pytest
+
+from helpers import optimize, get_block
+from nmodl_preprocessor.rate_tables import RateTable, RateTabulator
+
+def tabulate(nmodl_text):
+    program = nmodl.NmodlDriver().parse_string(nmodl_text)
+    tabulator = RateTabulator(set(), (-100, 100), 200)
+    num_replaced = tabulator.tabulate(program)
+    return tabulator, num_replaced, nmodl.to_nmodl(program)
+
+def test_tabulate(tmp_path, capsys):
+    output = optimize(tmp_path, """
+        NEURON {
+            SUFFIX test
+            NONSPECIFIC_CURRENT i
+        }
+        PARAMETER { vhalf = -40 }
+        ASSIGNED { v i g minf gmax }
+        BREAKPOINT {
+            minf = 1 / (1 + exp(-(v - vhalf) / 10))
+            g = exp(v * gmax)
+            i = g * minf * (v + 2) * 1e-6
+        }
+    """, tabulate=True)
+    stdout = capsys.readouterr().out
+    breakpoint = get_block(output, 'BREAKPOINT')
+    # The parameter is hardcoded, so the rate only depends on the voltage.
+    assert 'minf = rate_table_0(v)' in breakpoint
+    # Expressions which depend on other variables or are cheap to compute are not tabulated.
+    assert 'exp(v*gmax)' in breakpoint
+    assert '(v+2)' in breakpoint
+    function = get_block(output, 'FUNCTION rate_table_0')
+    assert 'TABLE FROM -100 TO 100 WITH 200' in function
+    assert 'rate_table_0 = 1/(1+exp(-(v--40)/10))' in function
+    assert 'tabulate rate_table_0(v) = 1/(1+exp(-(v--40)/10)), max error:' in stdout
+    assert 'warning: tabulated rates are constant outside of v = -100 to 100 mV' in stdout
+
+def test_copy_of_voltage():
+    tabulator, num_replaced, text = tabulate("""
+        PROCEDURE rates(vm) {
+            LOCAL x, y
+            x = vm
+            y = exp(x / 10)
+        }
+    """)
+    # The argument is not known to be the voltage, but the local copy of it is.
+    assert num_replaced == 0
+    tabulator, num_replaced, text = tabulate("""
+        PROCEDURE rates() {
+            LOCAL x, y
+            x = v
+            y = exp(x / 10)
+        }
+    """)
+    assert num_replaced == 1
+    assert list(tabulator.tables) == ['exp(v/10)']
+    assert 'y = rate_table_0(v)' in text
+
+def test_skip_verbatim():
+    tabulator, num_replaced, text = tabulate("""
+        PROCEDURE rates() {
+            LOCAL y
+            y = exp(v / 10)
+            VERBATIM
+            ENDVERBATIM
+        }
+    """)
+    assert num_replaced == 0
+    assert tabulator.tables == {}
+
+def test_skip_existing_table():
+    tabulator, num_replaced, text = tabulate("""
+        FUNCTION rate(v) {
+            TABLE FROM -100 TO 100 WITH 200
+            rate = exp(v / 10)
+        }
+    """)
+    assert num_replaced == 0
+    assert tabulator.tables == {}
+
+def test_skip_written_voltage():
+    tabulator, num_replaced, text = tabulate("""
+        PROCEDURE rates() {
+            LOCAL y
+            v = 0
+            y = exp(v / 10)
+        }
+    """)
+    assert num_replaced == 0
+
+def test_error_bound():
+    # The error of linear interpolation of v^2 is largest in the middle of each interval.
+    table = RateTable('f', 'v^2', (0, 10), 10)
+    table.measure_error()
+    assert table.max_value == 100
+    assert table.max_error == pytest.approx(0.25)
+    # Linear functions are exact.
+    table = RateTable('f', '3*v+1', (0, 10), 10)
+    table.measure_error()
+    assert table.max_error == pytest.approx(0, abs=1e-12)
+    # Halving the interval quarters the error.
+    table = RateTable('f', 'v^2', (0, 10), 20)
+    table.measure_error()
+    assert table.max_error == pytest.approx(0.0625)
+
+def test_not_finite():
+    tabulator, num_replaced, text = tabulate("""
+        PROCEDURE rates() {
+            LOCAL y
+            y = exp(1 / v)
+        }
+    """)
+    assert num_replaced == 0
+    assert tabulator.rejected == {'exp(1/v)': 'not finite at v = 0'}
@@ -0,0 +1,27 @@
+from nmodl_preprocessor.reference_index import find_assignments, SymbolCounts
+
+def test_forall_assignment():
+    assert find_assignments(b'forall gbar_hh = 0.1\n') == {'gbar_hh': [[0.1], [], 0]}
+    assert find_assignments(b'forall {\n    gbar_hh = 0.1\n}\n') == {'gbar_hh': [[0.1], [], 0]}
+    assert find_assignments(b'gbar_hh = 0.1\n') == {'gbar_hh': [[], [0.1], 0]}
+
+def test_conditional_forall_assignment():
+    # These assignments only apply to some of the sections.
+    examples = [
+        b'forall ifsec "dend" { gbar_hh = 0.1 }\n',
+        b'forall ifsec "dend" gbar_hh = 0.1\n',
+        b'forall {\n    if (issection("dend.*")) {\n        gbar_hh = 0.1\n    }\n}\n',
+        b'forall {\n    gbar_hh = 0.1\n    if (x) { y = 1 }\n}\n',
+        b'forall for (x) {\n    gbar_hh = 0.1\n}\n',
+    ]
+    for text in examples:
+        assert find_assignments(text) == {'gbar_hh': [[], [], 1]}, text
+
+def test_relevant_symbols():
+    symbols = SymbolCounts([
+        ('a.mod', {'gbar', 'gbar_hh', 'm_inf_hh', '1_0'}),
+        ('b.hoc', {'gbar_hh', 'gnabar_hh', 'x'}),
+    ])
+    assert symbols.relevant({'gbar', 'm', 'x', '1'}) == {'gbar', 'gbar_hh', 'm_inf_hh', 'x'}
+    assert symbols.relevant({'gbar', 'm', 'x'}, exclude='a.mod') == {'gbar_hh', 'x'}
+    assert symbols.is_referenced('celsius') is False
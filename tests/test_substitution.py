@@ -0,0 +1,44 @@
+from helpers import optimize, get_block
+
+def test_single_pass(tmp_path):
+    # The substituted text is not substituted again, even though it contains
+    # the name of another parameter.
+    output = optimize(tmp_path, """
+        NEURON {
+            SUFFIX test
+            NONSPECIFIC_CURRENT i
+        }
+        PARAMETER {
+            e = -70 (mV)
+            mV = 3
+            g = 2
+            gbar = 0.001
+        }
+        ASSIGNED { v (mV) i }
+        BREAKPOINT {
+            i = gbar * g * (v - e) * mV
+        }
+    """, fold_constants=False)
+    # Only whole words are substituted, "g" is not part of "gbar".
+    assert 'i = 0.001*2*(v--70(mV))*3' in get_block(output, 'BREAKPOINT')
+    assert 'v (mV)' in get_block(output, 'ASSIGNED')
+
+def test_initial_keeps_assignments(tmp_path):
+    # The ASSIGNED variables with constant values are substituted everywhere
+    # except the INITIAL block, which still assigns them.
+    output = optimize(tmp_path, """
+        NEURON {
+            SUFFIX test
+            NONSPECIFIC_CURRENT i
+        }
+        PARAMETER { q = 2 }
+        ASSIGNED { v i tadj }
+        INITIAL {
+            tadj = q * 3
+        }
+        BREAKPOINT {
+            i = tadj * v
+        }
+    """, fold_constants=False, remove_dead_code=False)
+    assert 'tadj = 2*3' in get_block(output, 'INITIAL')
+    assert 'i = 6*v' in get_block(output, 'BREAKPOINT')
@@ -0,0 +1,21 @@
+from helpers import optimize, get_block
+
+def test_assigned_celsius(tmp_path, capsys):
+    # Some mechanisms declare the temperature as ASSIGNED instead of PARAMETER.
+    output = optimize(tmp_path, """
+        NEURON {
+            SUFFIX test
+            NONSPECIFIC_CURRENT i
+            RANGE q10
+        }
+        ASSIGNED { v celsius i q10 }
+        INITIAL {
+            q10 = 3^((celsius - 6.3)/10)
+        }
+        BREAKPOINT {
+            i = q10 * celsius * 1e-6
+        }
+    """, celsius=16.3)
+    # The INITIAL block is evaluated at the given temperature, not at zero.
+    assert 'hardcode ASSIGNED with constant value: q10 = 3.0' in capsys.readouterr().out
+    assert get_block(output, 'BREAKPOINT').split() == ['BREAKPOINT', '{', 'i', '=', '4.89e-05', '}']